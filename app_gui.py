@@ -6,9 +6,10 @@ from PySide6.QtWidgets import (QApplication, QMainWindow, QSystemTrayIcon,
                               QMenu, QStyle, QMessageBox, QDialog, QVBoxLayout, 
                               QHBoxLayout, QLabel, QLineEdit, QPushButton, 
                               QGroupBox, QCheckBox, QStatusBar, QTextEdit, QDialogButtonBox,
-                              QListWidget, QListWidgetItem)
-from PySide6.QtCore import Qt, QTimer
-from PySide6.QtGui import QIcon, QAction
+                              QListWidget, QListWidgetItem, QWidget, QGridLayout,
+                              QPlainTextEdit, QComboBox)
+from PySide6.QtCore import Qt, QTimer, Signal, QPointF, QObject
+from PySide6.QtGui import QIcon, QAction, QPainter, QPen, QColor, QTextCursor
 import requests
 import json
 import re
@@ -16,7 +17,10 @@ import time
 import subprocess
 import signal
 import logging
+import multiprocessing
+from logging.handlers import RotatingFileHandler
 from datetime import datetime
+from collections import deque
 
 # 添加资源管理函数
 def resource_path(relative_path):
@@ -29,25 +33,33 @@ def resource_path(relative_path):
     
     return os.path.join(base_path, relative_path)
 
+LOG_MAX_BYTES = 5 * 1024 * 1024  # log.txt 达到该大小后轮转
+LOG_BACKUP_COUNT = 3             # 保留的历史日志文件数
+
+def app_dir():
+    """程序所在目录：打包后为exe所在目录（单文件版的__file__位于每次启动都会清空的临时目录）"""
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.dirname(os.path.abspath(__file__))
+
 # 设置日志
 def setup_logging():
-    # 获取exe所在目录
-    if getattr(sys, 'frozen', False):
-        exe_dir = os.path.dirname(sys.executable)
-    else:
-        exe_dir = os.path.dirname(os.path.abspath(__file__))
+    handlers = [logging.StreamHandler()]  # 同时输出到控制台
     
-    log_file = os.path.join(exe_dir, 'log.txt')
+    # 进程池的子进程（spawn）会重新导入本模块，只有主进程写log.txt，
+    # 避免多个进程同时轮转同一个文件（Windows下会出现PermissionError并丢失日志）
+    if multiprocessing.current_process().name == 'MainProcess':
+        log_file = os.path.join(app_dir(), 'log.txt')
+        # 按大小轮转，长时间运行也不会无限增长
+        handlers.insert(0, RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES,
+                                               backupCount=LOG_BACKUP_COUNT, encoding='utf-8'))
     
     # 配置日志
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(levelname)s - %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
-        handlers=[
-            logging.FileHandler(log_file, encoding='utf-8', mode='a'),  # 追加模式
-            logging.StreamHandler()  # 同时输出到控制台
-        ]
+        handlers=handlers
     )
     
     return logging.getLogger(__name__)
@@ -116,6 +128,74 @@ def import_server_module():
             logger.error(f"导入 server_main 模块失败: {e}")
             return None
 
+UPDATE_INFO_URL = "https://note.youdao.com/yws/api/note/a6504e3acf68f82cbc84f706fdff52ab?sev=j1&editorType=1&unloginId=a2043894-f5d6-4d93-3ce0-4528f77c1e8f&editorVersion=new-json-editor&sec=v1"
+
+def fetch_version_list():
+    """请求更新说明并解析出所有版本信息（在后台线程中执行，不操作界面）"""
+    versions = []
+    response = requests.get(UPDATE_INFO_URL, timeout=10)
+    
+    if response.status_code != 200:
+        raise RuntimeError(f"获取更新信息失败，状态码: {response.status_code}")
+    
+    data = response.json()
+    logger.info("获取到更新信息响应")
+    
+    content_str = data.get("content", "{}")
+    
+    # 解析内容
+    content_data = json.loads(content_str)
+    
+    # 提取所有8的值
+    eight_values = []
+    
+    # 遍历所有包含版本信息的条目
+    for item in content_data.get("5", []):
+        if "5" in item:
+            for sub_item in item.get("5", []):
+                if "7" in sub_item:
+                    for text_item in sub_item.get("7", []):
+                        if "8" in text_item:
+                            text_content = text_item.get("8", "")
+                            # 去除转义字符
+                            clean_text = text_content.replace("\\\"", "\"").replace("\\\\", "\\")
+                            eight_values.append(clean_text)
+    
+    # 将所有8的值拼接成一个完整的JSON字符串
+    full_json_str = "".join(eight_values)
+    
+    # 尝试解析为JSON数组
+    try:
+        # 使用正则表达式提取所有JSON对象
+        json_pattern = r'\{[^{}]*\}'
+        json_matches = re.findall(json_pattern, full_json_str)
+        
+        for json_str in json_matches:
+            try:
+                version_info = json.loads(json_str)
+                if 'version' in version_info:
+                    versions.append(version_info)
+                    logger.info(f"成功解析版本信息: {version_info.get('version')}")
+            except json.JSONDecodeError:
+                # 尝试手动提取键值对
+                try:
+                    manual_info = {}
+                    # 提取键值对
+                    pairs = re.findall(r'\"([^\"]+)\"\s*:\s*\"([^\"]*)\"', json_str)
+                    for key, value in pairs:
+                        manual_info[key] = value
+                    if 'version' in manual_info:
+                        versions.append(manual_info)
+                        logger.info(f"手动解析版本信息: {manual_info.get('version')}")
+                except Exception as manual_error:
+                    logger.error(f"手动解析失败: {manual_error}")
+    
+    except Exception as e:
+        logger.error(f"解析完整JSON失败: {e}")
+    
+    logger.info(f"共找到 {len(versions)} 个版本条目")
+    return versions
+
 class UpdateDialog(QDialog):
     def __init__(self, version_info, current_version, parent=None):
         super().__init__(parent)
@@ -365,7 +445,196 @@ class SettingsDialog(QDialog):
         # 保存原始端口号用于比较
         self.original_port = settings.get("port", "5000")
 
+class LogSignalEmitter(QObject):
+    record_emitted = Signal(int, str)
+
+class QtLogHandler(logging.Handler):
+    """把日志记录通过信号交给界面线程，可在任意线程中调用"""
+    
+    def __init__(self):
+        super().__init__()
+        self.emitter = LogSignalEmitter()
+        self.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%H:%M:%S'))
+    
+    def emit(self, record):
+        try:
+            self.emitter.record_emitted.emit(record.levelno, self.format(record))
+        except Exception:
+            self.handleError(record)
+
+class LogView(QWidget):
+    """固定容量的日志视图：日志存放在环形缓冲区中，每帧批量追加，支持按级别和文本过滤"""
+    
+    CAPACITY = 2000       # 最多保留的日志条数
+    FLUSH_INTERVAL = 16   # 批量追加的间隔（毫秒，约一帧）
+    LEVELS = [("全部", logging.NOTSET), ("INFO", logging.INFO),
+              ("WARNING", logging.WARNING), ("ERROR", logging.ERROR)]
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.entries = deque(maxlen=self.CAPACITY)
+        self.pending = deque(maxlen=self.CAPACITY)
+        self.min_level = logging.NOTSET
+        self.filter_text = ""
+        
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        
+        filter_layout = QHBoxLayout()
+        self.level_combo = QComboBox()
+        for title, level in self.LEVELS:
+            self.level_combo.addItem(title, level)
+        filter_layout.addWidget(self.level_combo)
+        self.filter_edit = QLineEdit()
+        self.filter_edit.setPlaceholderText("过滤日志...")
+        filter_layout.addWidget(self.filter_edit)
+        layout.addLayout(filter_layout)
+        
+        self.text_view = QPlainTextEdit()
+        self.text_view.setReadOnly(True)
+        self.text_view.setMaximumBlockCount(self.CAPACITY)
+        self.text_view.setPlaceholderText("服务器日志将显示在这里...")
+        layout.addWidget(self.text_view)
+        
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(self.FLUSH_INTERVAL)
+        self.flush_timer.timeout.connect(self.flush)
+        
+        self.level_combo.currentIndexChanged.connect(self.on_filter_changed)
+        self.filter_edit.textChanged.connect(self.on_filter_changed)
+    
+    def add_entry(self, level, text):
+        """记录一条日志，实际显示推迟到下一帧统一处理"""
+        self.entries.append((level, text))
+        self.pending.append((level, text))
+        if not self.flush_timer.isActive():
+            self.flush_timer.start()
+    
+    def matches(self, level, text):
+        return level >= self.min_level and (not self.filter_text or self.filter_text in text.lower())
+    
+    def flush(self):
+        lines = [text for level, text in self.pending if self.matches(level, text)]
+        self.pending.clear()
+        if lines:
+            self.text_view.appendPlainText("\n".join(lines))
+    
+    def on_filter_changed(self):
+        """过滤条件变化时从环形缓冲区重建视图"""
+        self.min_level = self.level_combo.currentData()
+        self.filter_text = self.filter_edit.text().strip().lower()
+        self.pending.clear()
+        self.text_view.setPlainText("\n".join(text for level, text in self.entries if self.matches(level, text)))
+        self.text_view.moveCursor(QTextCursor.End)
+
+class Sparkline(QWidget):
+    """迷你折线图，显示最近若干次采样"""
+    
+    def __init__(self, color, samples=60, parent=None):
+        super().__init__(parent)
+        self.color = QColor(color)
+        self.values = deque(maxlen=samples)
+        self.setMinimumSize(120, 28)
+    
+    def add_value(self, value):
+        self.values.append(value)
+        self.update()
+    
+    def paintEvent(self, event):
+        if len(self.values) < 2:
+            return
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(QPen(self.color, 1.5))
+        width, height = self.width() - 2, self.height() - 2
+        peak = max(self.values) or 1
+        step = width / (self.values.maxlen - 1)
+        # 新数据总在最右侧，采样不足时左边留空
+        left = 1 + width - step * (len(self.values) - 1)
+        painter.drawPolyline([QPointF(left + i * step, 1 + height - value / peak * height)
+                              for i, value in enumerate(self.values)])
+        painter.end()
+
+def format_hit_rate(rate):
+    return f"{rate * 100:.0f}%" if rate is not None else "-"
+
+def format_latency(seconds):
+    return f"{seconds:.2f} s" if seconds is not None else "-"
+
+class DashboardPanel(QGroupBox):
+    """服务器负载面板：显示 /stats/summary 的最新数值和变化趋势"""
+    
+    def __init__(self, parent=None):
+        super().__init__("运行状态", parent)
+        layout = QGridLayout()
+        self.values = {}
+        self.charts = {}
+        rows = [
+            ("active_jobs", "处理中任务", "#3b82f6"),
+            ("queue_depth", "排队任务", "#f59e0b"),
+            ("throughput", "下载速率", "#10b981"),
+            ("latency_p95", "p95 延迟", "#ef4444"),
+        ]
+        for row, (key, title, color) in enumerate(rows):
+            self.values[key] = QLabel("-")
+            self.charts[key] = Sparkline(color)
+            layout.addWidget(QLabel(title), row, 0)
+            layout.addWidget(self.values[key], row, 1)
+            layout.addWidget(self.charts[key], row, 2)
+        self.cache_label = QLabel("缓存命中率: -")
+        layout.addWidget(self.cache_label, len(rows), 0, 1, 3)
+        layout.setColumnStretch(2, 1)
+        self.setLayout(layout)
+    
+    def update_stats(self, stats):
+        """刷新面板，stats为None表示本次拉取失败"""
+        if stats is None:
+            for label in self.values.values():
+                label.setText("-")
+            self.cache_label.setText("缓存命中率: 统计不可用")
+            return
+        queue_depth = sum(stats.get('queue_depth', {}).values())
+        throughput = stats.get('throughput', 0) / (1024 * 1024)
+        latency = stats.get('latency_p95')
+        self.values["active_jobs"].setText(str(stats.get('active_jobs', 0)))
+        self.values["queue_depth"].setText(str(queue_depth))
+        self.values["throughput"].setText(f"{throughput:.2f} MB/s")
+        self.values["latency_p95"].setText(format_latency(latency))
+        self.charts["active_jobs"].add_value(stats.get('active_jobs', 0))
+        self.charts["queue_depth"].add_value(queue_depth)
+        self.charts["throughput"].add_value(throughput)
+        self.charts["latency_p95"].add_value(latency or 0)
+        hit_rates = stats.get('cache_hit_rate', {})
+        self.cache_label.setText(
+            f"缓存命中率: 元数据 {format_hit_rate(hit_rates.get('metadata'))}"
+            f" | 源文件 {format_hit_rate(hit_rates.get('source'))}"
+            f" | 封面 {format_hit_rate(hit_rates.get('cover'))}"
+        )
+
+def stats_tooltip(stats):
+    """托盘提示中的负载摘要"""
+    if stats is None:
+        return "Metadata Processing Server\n统计不可用"
+    queue_depth = sum(stats.get('queue_depth', {}).values())
+    throughput = stats.get('throughput', 0) / (1024 * 1024)
+    return (f"Metadata Processing Server\n"
+            f"任务 {stats.get('active_jobs', 0)} | 排队 {queue_depth} | {throughput:.2f} MB/s\n"
+            f"p95 延迟 {format_latency(stats.get('latency_p95'))}")
+
 class MusicMetadataApp(QMainWindow):
+    # 后台线程通过信号把结果交回界面线程
+    update_checked = Signal(list, bool)
+    update_check_failed = Signal(str, bool)
+    server_module_failed = Signal()
+    server_started = Signal(bool)
+    stats_fetched = Signal(object)
+    
+    UPDATE_CACHE_TTL = 6 * 3600  # 更新检查结果的缓存时间（秒）
+    SERVER_READY_TIMEOUT = 15    # 等待服务器就绪的最长时间（秒）
+    STATS_POLL_INTERVAL = 2000   # 仪表盘刷新间隔（毫秒）
+    STATS_HIDDEN_INTERVAL = 10   # 窗口隐藏时只刷新托盘提示，降低轮询频率（秒）
+    
     def __init__(self):
         super().__init__()
         self.tray_icon = None
@@ -377,126 +646,127 @@ class MusicMetadataApp(QMainWindow):
         self.server_running = False  # 服务器运行状态标志
         self.server_stop_event = threading.Event()  # 用于停止服务器的信号
         self.server_module = None  # 服务器模块
+        self.update_check_running = False
+        self.update_checked_at = 0  # 上次成功检查更新的时间
+        self.stats_poll_running = False
+        self.stats_polled_at = 0
+        self.stats_session = requests.Session()  # 复用连接，轮询时无需每次握手
         
         # 记录启动日志
         logger.info("应用程序启动")
         
-        # 导入服务器模块
-        self.server_module = import_server_module()
-        if self.server_module is None:
-            logger.error("无法导入服务器模块，应用程序无法启动")
-            QMessageBox.critical(None, "错误", "无法加载服务器模块，请确保 server_main.py 文件存在")
-            sys.exit(1)
+        self.update_checked.connect(self.on_update_checked)
+        self.update_check_failed.connect(self.on_update_check_failed)
+        self.server_module_failed.connect(self.on_server_module_failed)
+        self.server_started.connect(self.on_server_started)
+        self.stats_fetched.connect(self.on_stats_fetched)
         
-        # 检查更新
-        if not self.check_for_updates():
-            return  # 如果有新版本，更新对话框会处理退出
+        self.stats_timer = QTimer(self)
+        self.stats_timer.timeout.connect(self.poll_stats)
         
         self.load_settings()
         self.init_ui()
         self.init_tray()
         
-        # 启动服务器
+        # 日志（包括服务器线程的日志）经信号显示到日志视图
+        self.log_handler = QtLogHandler()
+        self.log_handler.emitter.record_emitted.connect(self.log_view.add_entry)
+        logging.getLogger().addHandler(self.log_handler)
+        
+        # 服务器和更新检查都在后台启动，窗口可以立即显示
         self.start_server()
+        self.load_update_cache()
+        self.start_update_check(manual=False)
+    
+    def update_cache_path(self):
+        return os.path.join(app_dir(), "update_cache.json")
     
-    def check_for_updates(self):
-        """检查更新，返回False表示需要更新，True表示不需要更新"""
+    def load_update_cache(self):
+        """读取上次检查更新的结果，版本历史无需等待网络即可使用"""
         try:
-            logger.info("开始检查更新...")
-            # 请求更新信息
-            response = requests.get(
-                "https://note.youdao.com/yws/api/note/a6504e3acf68f82cbc84f706fdff52ab?sev=j1&editorType=1&unloginId=a2043894-f5d6-4d93-3ce0-4528f77c1e8f&editorVersion=new-json-editor&sec=v1",
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                logger.info("获取到更新信息响应")
-                
-                content_str = data.get("content", "{}")
-                
-                # 解析内容
-                content_data = json.loads(content_str)
-                
-                # 提取所有8的值
-                eight_values = []
-                
-                # 遍历所有包含版本信息的条目
-                for item in content_data.get("5", []):
-                    if "5" in item:
-                        for sub_item in item.get("5", []):
-                            if "7" in sub_item:
-                                for text_item in sub_item.get("7", []):
-                                    if "8" in text_item:
-                                        text_content = text_item.get("8", "")
-                                        # 去除转义字符
-                                        clean_text = text_content.replace("\\\"", "\"").replace("\\\\", "\\")
-                                        eight_values.append(clean_text)
-                
-                # 将所有8的值拼接成一个完整的JSON字符串
-                full_json_str = "".join(eight_values)
-                
-                # 尝试解析为JSON数组
-                try:
-                    # 使用正则表达式提取所有JSON对象
-                    json_pattern = r'\{[^{}]*\}'
-                    json_matches = re.findall(json_pattern, full_json_str)
-                    
-                    for json_str in json_matches:
-                        try:
-                            version_info = json.loads(json_str)
-                            if 'version' in version_info:
-                                self.all_versions.append(version_info)
-                                logger.info(f"成功解析版本信息: {version_info.get('version')}")
-                        except json.JSONDecodeError:
-                            # 尝试手动提取键值对
-                            try:
-                                manual_info = {}
-                                # 提取键值对
-                                pairs = re.findall(r'\"([^\"]+)\"\s*:\s*\"([^\"]*)\"', json_str)
-                                for key, value in pairs:
-                                    manual_info[key] = value
-                                if 'version' in manual_info:
-                                    self.all_versions.append(manual_info)
-                                    logger.info(f"手动解析版本信息: {manual_info.get('version')}")
-                            except Exception as manual_error:
-                                logger.error(f"手动解析失败: {manual_error}")
-                
-                except Exception as e:
-                    logger.error(f"解析完整JSON失败: {e}")
-                
-                logger.info(f"共找到 {len(self.all_versions)} 个版本条目")
-                
-                # 获取最后一个条目（最新版本）
-                if self.all_versions:
-                    # 按版本号排序，确保最后一个是最新版本
-                    self.all_versions.sort(key=lambda x: self.version_to_tuple(x.get('version', '0.0.0')))
-                    latest_version_info = self.all_versions[-1]
-                    latest_version = latest_version_info.get("version", "")
-                    
-                    logger.info(f"最新版本: {latest_version}, 当前版本: {self.current_version}")
-                    
-                    # 比较版本
-                    if self.compare_versions(latest_version, self.current_version) > 0:
-                        logger.info("检测到新版本，显示更新对话框")
-                        # 显示更新对话框
-                        dialog = UpdateDialog(latest_version_info, self.current_version, self)
-                        dialog.exec()
-                        # 无论用户点击更新按钮还是关闭按钮，都会退出程序
-                        return False
-                    else:
-                        logger.info("当前已是最新版本")
-                        QMessageBox.information(self, "检查更新", "当前已是最新版本！")
-                else:
-                    logger.warning("未找到有效的版本信息")
-                    QMessageBox.warning(self, "检查更新", "未找到有效的版本信息！")
-        
+            with open(self.update_cache_path(), 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            versions = cache.get("versions", [])
+            self.update_checked_at = cache.get("checked_at", 0)
+            if versions:
+                self.all_versions = versions
+                logger.info(f"从缓存加载 {len(versions)} 个版本条目")
+                # 缓存中已有新版本时无需等待网络请求
+                QTimer.singleShot(0, lambda: self.apply_version_list(versions, False))
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            logger.error(f"检查更新失败: {e}")
-            QMessageBox.warning(self, "检查更新", f"检查更新失败: {str(e)}")
-            # 更新检查失败不影响主程序运行
+            logger.warning(f"读取更新缓存失败: {e}")
+    
+    def save_update_cache(self, versions):
+        try:
+            with open(self.update_cache_path(), 'w', encoding='utf-8') as f:
+                json.dump({"checked_at": self.update_checked_at, "versions": versions}, f, ensure_ascii=False)
+        except Exception as e:
+            logger.warning(f"保存更新缓存失败: {e}")
+    
+    def start_update_check(self, manual=False):
+        """在后台线程中检查更新，结果通过信号回到界面线程"""
+        if self.update_check_running:
+            return
         
-        return True
+        if not manual and time.time() - self.update_checked_at < self.UPDATE_CACHE_TTL:
+            logger.info("更新检查结果仍在缓存有效期内，跳过网络请求")
+            return
+        
+        self.update_check_running = True
+        logger.info("开始检查更新...")
+        
+        def worker():
+            try:
+                self.update_checked.emit(fetch_version_list(), manual)
+            except Exception as e:
+                self.update_check_failed.emit(str(e), manual)
+        
+        threading.Thread(target=worker, daemon=True).start()
+    
+    def on_update_checked(self, versions, manual):
+        """处理后台检查更新的结果（界面线程）"""
+        self.update_check_running = False
+        if versions:
+            self.update_checked_at = time.time()
+            self.save_update_cache(versions)
+        self.apply_version_list(versions, manual)
+    
+    def apply_version_list(self, versions, manual):
+        """根据版本列表判断是否需要更新"""
+        if not versions:
+            logger.warning("未找到有效的版本信息")
+            if manual:
+                QMessageBox.warning(self, "检查更新", "未找到有效的版本信息！")
+            return
+        
+        # 按版本号排序，确保最后一个是最新版本
+        versions = sorted(versions, key=lambda x: self.version_to_tuple(x.get('version', '0.0.0')))
+        self.all_versions = versions
+        
+        latest_version_info = versions[-1]
+        latest_version = latest_version_info.get("version", "")
+        logger.info(f"最新版本: {latest_version}, 当前版本: {self.current_version}")
+        
+        # 比较版本
+        if self.compare_versions(latest_version, self.current_version) > 0:
+            logger.info("检测到新版本，显示更新对话框")
+            # 显示更新对话框，无论用户点击更新按钮还是关闭按钮，都会退出程序
+            dialog = UpdateDialog(latest_version_info, self.current_version, self)
+            dialog.exec()
+            os._exit(0)
+        
+        logger.info("当前已是最新版本")
+        if manual:
+            QMessageBox.information(self, "检查更新", "当前已是最新版本！")
+    
+    def on_update_check_failed(self, error, manual):
+        self.update_check_running = False
+        logger.error(f"检查更新失败: {error}")
+        # 更新检查失败不影响主程序运行
+        if manual:
+            QMessageBox.warning(self, "检查更新", f"检查更新失败: {error}")
     
     def version_to_tuple(self, version_str):
         """将版本字符串转换为元组以便比较"""
@@ -570,19 +840,25 @@ class MusicMetadataApp(QMainWindow):
     
     def init_ui(self):
         self.setWindowTitle("Metadata Processing Server")
-        self.setGeometry(300, 300, 500, 400)
+        self.setGeometry(300, 300, 560, 560)
         
         # 设置窗口图标
         self.setWindowIcon(self.get_icon())
         
-        # 创建中央部件
-        central_widget = QTextEdit()
-        central_widget.setReadOnly(True)
-        central_widget.setPlaceholderText("服务器日志将显示在这里...")
+        # 创建中央部件：上方为运行状态面板，下方为日志
+        central_widget = QWidget()
+        central_layout = QVBoxLayout(central_widget)
+        
+        self.dashboard = DashboardPanel()
+        central_layout.addWidget(self.dashboard)
+        
+        self.log_view = LogView()
+        central_layout.addWidget(self.log_view)
+        
         self.setCentralWidget(central_widget)
         
         # 创建状态栏
-        self.statusBar().showMessage("服务器运行中")
+        self.statusBar().showMessage("服务器启动中...")
         
         # 创建菜单栏
         menubar = self.menuBar()
@@ -610,14 +886,17 @@ class MusicMetadataApp(QMainWindow):
         help_menu.addAction(version_history_action)
         
         # 添加服务器信息提示
-        self.centralWidget().append("服务器已自动启动")
-        self.centralWidget().append("如需重启服务器，请重启本程序")
-        self.centralWidget().append("主机地址固定为: 127.0.0.1 (localhost)")
-        self.centralWidget().append(f"端口号: {self.settings['port']}")
-        self.centralWidget().append("请在作品中设置相同的端口号")
+        self.append_log("服务器已自动启动")
+        self.append_log("如需重启服务器，请重启本程序")
+        self.append_log("主机地址固定为: 127.0.0.1 (localhost)")
+        self.append_log(f"端口号: {self.settings['port']}")
+        self.append_log("请在作品中设置相同的端口号")
         
         logger.info("UI初始化完成")
     
+    def append_log(self, text):
+        self.log_view.add_entry(logging.INFO, text)
+    
     def init_tray(self):
         if not QSystemTrayIcon.isSystemTrayAvailable():
             logger.warning("系统托盘不可用")
@@ -672,9 +951,7 @@ class MusicMetadataApp(QMainWindow):
     def manual_check_update(self):
         """手动检查更新"""
         logger.info("手动检查更新")
-        if not self.check_for_updates():
-            # 如果检测到更新，直接退出程序
-            os._exit(0)
+        self.start_update_check(manual=True)
     
     def show_version_history(self):
         """显示版本历史对话框"""
@@ -712,7 +989,7 @@ class MusicMetadataApp(QMainWindow):
                 )
             
             # 添加重启提示到日志
-            self.centralWidget().append("设置已保存，请重启程序使更改生效")
+            self.append_log("设置已保存，请重启程序使更改生效")
     
     def start_server(self):
         # 确保缓存目录存在
@@ -721,47 +998,107 @@ class MusicMetadataApp(QMainWindow):
             os.makedirs(cache_dir)
             logger.info(f"创建缓存目录: {cache_dir}")
         
+        self.statusBar().showMessage("服务器启动中...")
+        
+        # 导入服务器模块和运行服务器都在后台线程中进行
+        self.server_thread = threading.Thread(
+            target=self.run_server_thread,
+            args=(self.settings["host"], int(self.settings["port"]), cache_dir, dict(self.settings)),
+            daemon=True
+        )
+        self.server_thread.start()
+        
+        # 另起线程轮询 /status 判断服务器是否就绪
+        threading.Thread(target=self.wait_for_server, daemon=True).start()
+    
+    def run_server_thread(self, host, port, cache_dir, settings):
+        """后台线程：导入服务器模块并运行服务器"""
+        if self.server_module is None:
+            self.server_module = import_server_module()
+            if self.server_module is None:
+                self.server_module_failed.emit()
+                return
         try:
-            # 创建新的服务器线程
-            self.server_thread = threading.Thread(
-                target=self.server_module.run_server,
-                args=(self.settings["host"], int(self.settings["port"]), cache_dir),
-                daemon=True
-            )
-            self.server_thread.start()
+            self.server_module.run_server(host, port, cache_dir, settings)
+        except Exception as e:
+            logger.error(f"服务器运行失败: {e}")
+    
+    def wait_for_server(self):
+        """后台线程：以快速退避轮询服务器状态，直到就绪、服务器线程退出或超时"""
+        deadline = time.monotonic() + self.SERVER_READY_TIMEOUT
+        delay = 0.05
+        while time.monotonic() < deadline:
+            if self.check_server_status(quiet=True):
+                self.server_started.emit(True)
+                return
+            if self.server_thread is not None and not self.server_thread.is_alive():
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+        self.server_started.emit(False)
+    
+    def on_server_module_failed(self):
+        logger.error("无法导入服务器模块，应用程序无法启动")
+        QMessageBox.critical(None, "错误", "无法加载服务器模块，请确保 server_main.py 文件存在")
+        QApplication.exit(1)
+    
+    def on_server_started(self, success):
+        """服务器启动结果（界面线程）"""
+        if success:
+            server_url = f"http://{self.settings['host']}:{self.settings['port']}"
+            self.statusBar().showMessage(f"服务器运行在 {server_url}")
+            self.server_running = True
             
-            # 等待一段时间让服务器启动
-            time.sleep(2)
+            # 添加日志
+            self.append_log(f"服务器启动成功 - {server_url}")
+            logger.info(f"服务器启动成功: {server_url}")
             
-            # 检查服务器是否成功启动
-            if self.check_server_status():
-                server_url = f"http://{self.settings['host']}:{self.settings['port']}"
-                self.statusBar().showMessage(f"服务器运行在 {server_url}")
-                self.server_running = True
-                
-                # 添加日志
-                self.centralWidget().append(f"服务器启动成功 - {server_url}")
-                logger.info(f"服务器启动成功: {server_url}")
-            else:
-                self.statusBar().showMessage("服务器启动失败")
-                self.centralWidget().append("错误: 服务器启动失败，端口可能被占用")
-                self.server_running = False
-                logger.error("服务器启动失败，端口可能被占用")
-                
-        except Exception as e:
-            self.statusBar().showMessage(f"服务器启动失败: {str(e)}")
-            self.centralWidget().append(f"错误: {str(e)}")
+            # 开始定时刷新运行状态
+            self.stats_timer.start(self.STATS_POLL_INTERVAL)
+            self.poll_stats()
+        else:
+            self.statusBar().showMessage("服务器启动失败")
+            self.append_log("错误: 服务器启动失败，端口可能被占用")
             self.server_running = False
-            logger.error(f"服务器启动失败: {e}")
+            logger.error("服务器启动失败，端口可能被占用")
+    
+    def poll_stats(self):
+        """定时器回调：在后台线程拉取统计，界面线程从不等待网络"""
+        if self.stats_poll_running:
+            return  # 上一次请求尚未返回，跳过本次
+        if not self.isVisible() and time.monotonic() - self.stats_polled_at < self.STATS_HIDDEN_INTERVAL:
+            return
+        self.stats_poll_running = True
+        self.stats_polled_at = time.monotonic()
+        url = f"http://{self.settings['host']}:{self.settings['port']}/stats/summary"
+        
+        def worker():
+            try:
+                response = self.stats_session.get(url, timeout=2)
+                stats = response.json() if response.status_code == 200 else None
+            except Exception:
+                stats = None
+            self.stats_fetched.emit(stats)
+        
+        threading.Thread(target=worker, daemon=True).start()
     
-    def check_server_status(self):
+    def on_stats_fetched(self, stats):
+        """统计拉取结果（界面线程）"""
+        self.stats_poll_running = False
+        if self.isVisible():
+            self.dashboard.update_stats(stats)
+        if self.tray_icon:
+            self.tray_icon.setToolTip(stats_tooltip(stats))
+    
+    def check_server_status(self, quiet=False):
         """检查服务器是否正常运行"""
         try:
             url = f"http://{self.settings['host']}:{self.settings['port']}/status"
             response = requests.get(url, timeout=2)
             return response.status_code == 200
         except Exception as e:
-            logger.warning(f"服务器状态检查失败: {e}")
+            if not quiet:
+                logger.warning(f"服务器状态检查失败: {e}")
             return False
     
     def closeEvent(self, event):
@@ -780,6 +1117,8 @@ class MusicMetadataApp(QMainWindow):
     
     def quit_application(self):
         logger.info("应用程序退出")
+        self.stats_timer.stop()
+        logging.getLogger().removeHandler(self.log_handler)
         # 停止服务器
         try:
             # 尝试通过HTTP请求优雅停止
@@ -797,6 +1136,9 @@ class MusicMetadataApp(QMainWindow):
         QApplication.quit()
 
 def main():
+    # 打包环境下进程池子进程需要由freeze_support接管
+    multiprocessing.freeze_support()
+    
     # 隐藏控制台窗口
     import ctypes
     if hasattr(ctypes, 'windll'):
@@ -3,7 +3,7 @@ import sys
 import os
 import tempfile
 
-def build_final():
+def build_final(onedir=False):
     # 检查图标文件是否存在
     icon_paths = [
         "icon.ico",
@@ -44,7 +44,10 @@ def build_final():
         
         cmd = [
             sys.executable, "-m", "PyInstaller",
-            "--onefile",
+            # --onedir 构建无需每次启动时解压到 _MEIPASS，启动更快
+            "--onedir" if onedir else "--onefile",
+            # UPX 压缩会增加每次启动时的解压耗时
+            "--noupx",
             "--windowed",
             "--name=MusicMetadataProcessor",
             "--clean",
@@ -74,7 +77,9 @@ def build_final():
             "--hidden-import=urllib3.util.retry",
             "--hidden-import=urllib3.util.connection",
             "--hidden-import=urllib3.contrib",
-            "--hidden-import=urllib3.contrib.pyopenssl",
+            # 可选的HTTP/2上游下载（upstream_http2），未安装时PyInstaller仅给出警告
+            "--hidden-import=httpx",
+            "--hidden-import=h2",
             "--hidden-import=PySide6",
             "--hidden-import=PySide6.QtWidgets",
             "--hidden-import=PySide6.QtCore",
@@ -83,22 +88,8 @@ def build_final():
             "--hidden-import=charset_normalizer",
             "--hidden-import=idna",
             "--hidden-import=email",
-            "--hidden-import=email.mime",
-            "--hidden-import=email.mime.text",
-            "--hidden-import=email.mime.multipart",
-            "--hidden-import=OpenSSL",
-            "--hidden-import=OpenSSL.SSL",
-            "--hidden-import=OpenSSL.crypto",
-            "--hidden-import=cryptography",
-            "--hidden-import=cryptography.hazmat",
-            "--hidden-import=cryptography.hazmat.backends",
-            "--hidden-import=cryptography.hazmat.primitives",
-            "--hidden-import=cryptography.hazmat.primitives.asymmetric",
-            "--hidden-import=cryptography.x509",
             "--hidden-import=werkzeug",
             "--hidden-import=werkzeug.serving",
-            "--hidden-import=asgiref.sync",
-            "--hidden-import=dotenv",
             "--hidden-import=base64",
             "--hidden-import=uuid",
             "--hidden-import=json",
@@ -106,6 +97,7 @@ def build_final():
             "--hidden-import=threading",
             "--hidden-import=time",
             "--hidden-import=logging",
+            "--hidden-import=logging.handlers",
             "--hidden-import=mimetypes",
             "--hidden-import=traceback",
             "--hidden-import=shutil",
@@ -113,6 +105,7 @@ def build_final():
             "--hidden-import=atexit",
             "--hidden-import=concurrent",
             "--hidden-import=concurrent.futures",
+            "--hidden-import=multiprocessing.shared_memory",
             "--hidden-import=urllib.parse",
             "--hidden-import=tempfile",
             
@@ -123,7 +116,6 @@ def build_final():
             "--exclude-module=_curses",
             "--exclude-module=watchdog",
             "--exclude-module=socks",
-            "--exclude-module=h2",
             "--exclude-module=brotli",
             "--exclude-module=brotlicffi",
             "--exclude-module=zstandard",
@@ -133,11 +125,13 @@ def build_final():
             "--exclude-module=pydoc",
             "--exclude-module=doctest",
             "--exclude-module=pdb",
-            "--exclude-module=multiprocessing",
+            "--exclude-module=OpenSSL",
+            "--exclude-module=cryptography",
+            "--exclude-module=dotenv",
+            "--exclude-module=asgiref",
             
             # 添加额外的二进制文件（如果需要）
             "--collect-binaries=mutagen",
-            "--collect-binaries=cryptography",
             
             "app_gui.py"
         ]
@@ -160,7 +154,10 @@ def build_final():
         
         # 检查构建是否成功
         if result.returncode == 0:
-            dist_path = os.path.join("dist", "MusicMetadataProcessor.exe")
+            if onedir:
+                dist_path = os.path.join("dist", "MusicMetadataProcessor", "MusicMetadataProcessor.exe")
+            else:
+                dist_path = os.path.join("dist", "MusicMetadataProcessor.exe")
             if os.path.exists(dist_path):
                 print(f"\n✅ 构建成功！可执行文件位置: {dist_path}")
                 print(f"文件大小: {os.path.getsize(dist_path) / (1024*1024):.2f} MB")
@@ -189,4 +186,4 @@ def build_final():
             print(f"清理临时文件时出错: {e}")
 
 if __name__ == "__main__":
-    sys.exit(build_final())
+    sys.exit(build_final(onedir="--onedir" in sys.argv[1:]))
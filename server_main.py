@@ -1,81 +1,903 @@
+import io
 import os
+import sys
 import uuid
-import requests
 import json
 import re
-from flask import Flask, request, jsonify, send_file
+import base64
+import hashlib
+import itertools
+import struct
+import unicodedata
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
-from mutagen import File
-from mutagen.id3 import ID3, TIT2, TPE1, TALB, TYER, USLT, APIC, TDRC, delete, COMM
-from mutagen.mp3 import MP3
-from mutagen.flac import FLAC, Picture
-from mutagen.oggvorbis import OggVorbis
-from mutagen.mp4 import MP4
-from mutagen.wave import WAVE
-from mutagen.aiff import AIFF
+from werkzeug.wsgi import ClosingIterator
 from urllib.parse import urlparse
 import tempfile
 import threading
 import time
 import logging
+from logging.handlers import RotatingFileHandler
 import mimetypes
 import traceback
 import shutil
+import select
+import socket
 import signal
 import atexit
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+# requests 和 mutagen 的各格式模块在首次使用时才导入，加快冷启动
 
 # 全局变量
 app = Flask(__name__)
 CORS(app)
 TEMP_DIR = tempfile.gettempdir()
 FILE_CLEANUP_TIME = 300  # 5分钟
-file_registry = {}
+LOG_MAX_BYTES = 5 * 1024 * 1024  # 日志文件达到该大小后轮转
+LOG_BACKUP_COUNT = 3             # 保留的历史日志文件数
+file_registry = {}  # file_id -> 文件信息，可替换为共享注册表（见create_storage）
 is_shutting_down = False
 logger = logging.getLogger(__name__)
 
 # 创建线程池执行器
 download_executor = ThreadPoolExecutor(max_workers=10)
 metadata_executor = ThreadPoolExecutor(max_workers=5)
+prefetch_executor = ThreadPoolExecutor(max_workers=2)  # 预取任务，并发数很小以免挤占前台请求
+tagging_process_pool = None  # 启用进程池打标签时按需创建
+
+# 服务器可调参数（可由config.json覆盖）
+SERVER_SETTINGS = {
+    'upstream_pool_per_host': 8,      # 每个上游主机的最大连接数
+    'upstream_http2': False,          # 是否启用HTTP/2多路复用（需要安装httpx[http2]）
+    'upstream_warmup': True,          # 下载前是否预热连接
+    'min_segment_size': 1024 * 1024,  # 每个分块的最小字节数，小文件少开连接
+    'bandwidth_limit_kbps': 0,        # 全局下载带宽上限(KB/s)，0表示不限速
+    'small_file_threshold': 16 * 1024 * 1024,  # 小于该大小的文件享有更高带宽权重
+    'small_file_weight': 4.0,         # 小文件的带宽权重（普通文件为1）
+    'io_buffer_size': 512 * 1024,     # 下载/合并时使用的读写缓冲区大小（字节）
+    'verify_etag': False,             # 把形如MD5的强ETag当作内容MD5校验（S3分片上传和部分CDN的ETag不是MD5，默认关闭）
+    'tagging_backend': 'thread',      # 打标签后端: thread(线程池) 或 process(进程池，绕开GIL)
+    'tagging_workers': 0,             # 进程池大小，0表示使用CPU核心数
+    'output_dedup': True,             # 相同来源和元数据的请求复用已处理的文件
+    'download_workers': 10,           # 下载线程池大小（分块下载、封面下载）
+    'metadata_workers': 5,            # 打标签线程池大小
+    'json_backend': 'auto',           # 请求体JSON解析: auto(安装了orjson时使用) 或 json(标准库)
+    'upload_spool_threshold': 8 * 1024 * 1024,  # 上传内容超过该大小后直接写入磁盘
+    'registry_backend': 'memory',     # 文件注册表: memory(本进程) / sqlite / s3，多实例部署时使用后两者
+    'registry_path': '',              # SQLite注册表文件，留空使用缓存目录下的file_registry.sqlite3
+    'blob_backend': 'local',          # 输出文件存储: local / s3
+    'blob_dir': '',                   # local存储的共享目录，留空表示只保留在本机
+    's3_bucket': '',                  # S3兼容存储（需要安装boto3）
+    's3_prefix': 'music-metadata/',
+    's3_endpoint_url': '',            # 留空使用AWS，也可以指向MinIO等兼容服务
+    's3_region': '',
+    's3_access_key': '',              # 留空时使用boto3默认的凭据查找顺序
+    's3_secret_key': '',
+    'source_cache_ttl': 24 * 3600,    # 预取的来源文件和封面的缓存时间（秒）
+    'prefetch_workers': 2,            # 同时预取的文件数
+    'prefetch_threads': 2,            # 每个预取文件的分块下载线程数
+    'prefetch_weight': 0.25,          # 限速时预取任务的带宽权重（普通任务为1）
+    'circuit_failure_threshold': 5,   # 同一上游主机连续失败该次数后熔断
+    'circuit_open_seconds': 30,       # 熔断持续时间（秒），到期后放行一个探测请求
+    'negative_cache_ttl': 60,         # 返回404/403/410的URL在该时间内直接失败（秒），0表示不缓存
+    'download_deadline': 300,         # 单个请求下载（含所有重试）的总时限（秒），0表示不限制
+    'mp4_faststart': True,            # 写入MP4标签时把moov移到mdat之前，客户端无需下载完整文件即可开始播放
+    'hot_file_downloads': 3,          # 下载次数达到该值的文件视为热门文件，0表示不启用
+    'hot_file_ttl': 3600,             # 热门文件从最后一次下载起保留的时间（秒）
+}
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept': '*/*'
+}
+
+def configure_server(settings):
+    """从配置字典中读取服务器可调参数"""
+    if not settings:
+        return
+    for key, default in SERVER_SETTINGS.items():
+        if key not in settings or settings[key] in (None, ''):
+            continue
+        try:
+            value = settings[key]
+            if isinstance(default, bool):
+                if isinstance(value, str):
+                    value = value.strip().lower() in ('1', 'true', 'yes', 'on')
+                SERVER_SETTINGS[key] = bool(value)
+            else:
+                SERVER_SETTINGS[key] = type(default)(value)
+        except (TypeError, ValueError):
+            logger.warning(f"忽略无效的配置项 {key}: {settings[key]}")
+
+# 当前线程正在发出的上游请求的截止时间（urllib3在调用线程中重试，重试前据此判断是否还有时间）
+_request_deadline = threading.local()
 
 # 创建带有重试机制的会话
-def create_session():
+def create_session(pool_maxsize=100):
     """创建带有重试机制的请求会话"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    
+    class DeadlineRetry(Retry):
+        """超过请求截止时间后不再重试，退避等待也不超过剩余时间"""
+        
+        def is_exhausted(self):
+            deadline = getattr(_request_deadline, 'value', None)
+            if deadline is not None and time.monotonic() >= deadline:
+                return True
+            return super().is_exhausted()
+        
+        def get_backoff_time(self):
+            backoff = super().get_backoff_time()
+            deadline = getattr(_request_deadline, 'value', None)
+            if deadline is not None:
+                backoff = max(0, min(backoff, deadline - time.monotonic()))
+            return backoff
+    
     session = requests.Session()
-    retry_strategy = Retry(
+    retry_strategy = DeadlineRetry(
         total=3,
         backoff_factor=0.5,
         status_forcelist=[429, 500, 502, 503, 504],
         allowed_methods=["GET"]
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=100, pool_maxsize=100)
+    # 连接池不阻塞：池中连接都被占用时临时新建连接，用完后超出上限的连接直接关闭，
+    # 未及时释放的响应不会让后续请求无限期等待空闲连接
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=1, pool_maxsize=pool_maxsize)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     return session
 
-# 全局会话对象
-download_session = create_session()
+class Http2Response:
+    """把httpx响应包装成与requests响应一致的接口"""
 
-def safe_json_parse(json_string):
-    """安全地解析JSON，处理控制字符和换行符"""
-    try:
-        return json.loads(json_string)
-    except json.JSONDecodeError as e:
-        logger.warning(f"JSON解析失败，尝试清理无效字符: {e}")
-        
-        # 清理无效的控制字符（保留\t, \n, \r）
-        cleaned = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]', '', json_string)
-        
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.raw = None
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            self._response.close()
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self._response.url}", response=self)
+
+    def iter_content(self, chunk_size=8192):
+        return self._response.iter_bytes(chunk_size)
+
+    @property
+    def content(self):
+        return self._response.read()
+
+    def close(self):
+        self._response.close()
+
+# 上游返回这些状态码时短时间内记住结果，重复请求直接失败
+NEGATIVE_CACHE_STATUSES = (403, 404, 410)
+NEGATIVE_CACHE_SIZE = 1024
+
+class HostCircuitBreaker:
+    """按主机统计连续失败次数的熔断器
+
+    连接失败、超时和5xx计为失败，连续失败达到阈值后熔断一段时间，期间对该主机的请求直接失败；
+    熔断到期后只放行一个探测请求，成功则恢复，失败则重新熔断。
+    """
+
+    def __init__(self, failure_threshold=5, open_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self._hosts = {}  # 主机 -> {'failures': 连续失败次数, 'open_until': 熔断到期时间, 'probing': 是否有探测请求}
+        self._lock = threading.Lock()
+
+    def allow(self, host):
+        """是否允许向该主机发出请求"""
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or not state['open_until']:
+                return True
+            if state['probing'] or time.monotonic() < state['open_until']:
+                return False
+            state['probing'] = True
+            return True
+
+    def is_open(self, host):
+        """主机是否处于熔断状态（不占用探测名额）"""
+        with self._lock:
+            state = self._hosts.get(host)
+            return bool(state and state['open_until'] and
+                        (state['probing'] or time.monotonic() < state['open_until']))
+
+    def record_success(self, host):
+        with self._lock:
+            if self._hosts.pop(host, None) is not None:
+                logger.info(f"上游主机已恢复: {host}")
+
+    def record_failure(self, host):
+        with self._lock:
+            state = self._hosts.setdefault(host, {'failures': 0, 'open_until': 0, 'probing': False})
+            state['failures'] += 1
+            if state['probing'] or state['failures'] >= self.failure_threshold:
+                if not state['open_until'] or state['probing']:
+                    logger.warning(f"上游主机连续失败 {state['failures']} 次，熔断 {self.open_seconds} 秒: {host}")
+                state['open_until'] = time.monotonic() + self.open_seconds
+                state['probing'] = False
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            result = {}
+            for host, state in self._hosts.items():
+                if not state['open_until']:
+                    status = 'closed'
+                elif state['probing'] or now >= state['open_until']:
+                    status = 'half_open'
+                else:
+                    status = 'open'
+                result[host] = {
+                    'state': status,
+                    'failures': state['failures'],
+                    'retry_in': round(max(0, state['open_until'] - now), 1) if state['open_until'] else 0
+                }
+            return result
+
+class UpstreamClient:
+    """上游下载客户端：按主机维护独立连接池，可选HTTP/2多路复用
+
+    同一主机的所有分块请求共享一个连接池（保留的空闲连接数有上限），连接在任务之间保持复用，
+    TLS握手只在连接首次建立时发生。启用HTTP/2时同一主机的分块复用同一条连接。
+    """
+
+    def __init__(self, pool_per_host=8, http2=False, failure_threshold=5, open_seconds=30, negative_ttl=60):
+        self.pool_per_host = pool_per_host
+        self.http2 = http2 and self._http2_available()
+        self.breaker = HostCircuitBreaker(failure_threshold, open_seconds)
+        self.negative_ttl = negative_ttl
+        self._negative = {}  # (方法, URL) -> (状态码, 到期时间)
+        self._sessions = {}
+        self._h2_clients = {}
+        self._warmed = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _http2_available():
+        try:
+            import httpx  # noqa: F401
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            logger.warning("未安装httpx[http2]，上游下载使用HTTP/1.1")
+            return False
+
+    @staticmethod
+    def _host_key(url):
+        parsed = urlparse(url)
+        return f"{parsed.scheme}://{parsed.netloc}"
+
+    def session_for(self, url):
+        """获取指定主机的requests会话"""
+        key = self._host_key(url)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = create_session(pool_maxsize=self.pool_per_host)
+                self._sessions[key] = session
+            return session
+
+    def _h2_client_for(self, url):
+        import httpx
+        key = self._host_key(url)
+        with self._lock:
+            client = self._h2_clients.get(key)
+            if client is None:
+                limits = httpx.Limits(max_connections=self.pool_per_host,
+                                      max_keepalive_connections=self.pool_per_host)
+                transport = httpx.HTTPTransport(http2=True, limits=limits, retries=3)
+                client = httpx.Client(http2=True, transport=transport, follow_redirects=True)
+                self._h2_clients[key] = client
+            return client
+
+    def _request(self, method, url, send, timeout, deadline):
+        """经过负缓存和熔断器检查后发出请求，并按结果更新主机状态
+
+        deadline为整个下载任务的截止时间（time.monotonic()），单次请求的超时和urllib3的重试都不会超过它。
+        """
+        key = (method, url)
+        cached = self._negative.get(key)
+        if cached is not None:
+            if time.monotonic() < cached[1]:
+                raise UpstreamUnavailable(f"上游近期返回 {cached[0]}，暂不重试: {url}", cached[0])
+            self._negative.pop(key, None)
+        
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded("下载超出总时限")
+            timeout = min(timeout, remaining)
+        
+        host = self._host_key(url)
+        if not self.breaker.allow(host):
+            raise UpstreamUnavailable(f"上游主机暂时不可用: {host}")
+        
+        _request_deadline.value = deadline
         try:
-            return json.loads(cleaned)
-        except json.JSONDecodeError as e2:
-            logger.error(f"清理后仍然无法解析JSON: {e2}")
+            response = send(timeout)
+        except Exception:
+            self.breaker.record_failure(host)
             raise
+        finally:
+            _request_deadline.value = None
+        
+        if response.status_code >= 500:
+            self.breaker.record_failure(host)
+        else:
+            self.breaker.record_success(host)
+            if response.status_code in NEGATIVE_CACHE_STATUSES and self.negative_ttl > 0:
+                self._remember_failure(key, response.status_code)
+        return response
+
+    def available(self, url):
+        """URL所在主机未熔断，且URL近期没有返回过404/403"""
+        cached = self._negative.get(('GET', url))
+        if cached is not None and time.monotonic() < cached[1]:
+            return False
+        return not self.breaker.is_open(self._host_key(url))
+
+    def _remember_failure(self, key, status):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._negative) >= NEGATIVE_CACHE_SIZE:
+                for stale in [k for k, (_, expires) in self._negative.items() if expires <= now]:
+                    del self._negative[stale]
+                if len(self._negative) >= NEGATIVE_CACHE_SIZE:
+                    del self._negative[next(iter(self._negative))]
+            self._negative[key] = (status, now + self.negative_ttl)
+
+    def get(self, url, headers=None, stream=False, timeout=30, deadline=None):
+        if self.http2 and urlparse(url).scheme == 'https':
+            client = self._h2_client_for(url)
+            
+            def send(timeout):
+                request_obj = client.build_request('GET', url, headers=headers, timeout=timeout)
+                response = Http2Response(client.send(request_obj, stream=True))
+                if not stream:
+                    response.content
+                return response
+        else:
+            session = self.session_for(url)
+            
+            def send(timeout):
+                return session.get(url, headers=headers, stream=stream, timeout=timeout)
+        return self._request('GET', url, send, timeout, deadline)
+
+    def head(self, url, headers=None, timeout=10, allow_redirects=True, deadline=None):
+        if self.http2 and urlparse(url).scheme == 'https':
+            client = self._h2_client_for(url)
+            
+            def send(timeout):
+                return Http2Response(client.head(url, headers=headers, timeout=timeout,
+                                                 follow_redirects=allow_redirects))
+        else:
+            session = self.session_for(url)
+            
+            def send(timeout):
+                return session.head(url, headers=headers, timeout=timeout, allow_redirects=allow_redirects)
+        return self._request('HEAD', url, send, timeout, deadline)
+
+    def warm_up(self, url, timeout=5):
+        """提前建立到上游主机的连接（含TLS握手），后续请求直接复用
+
+        很多CDN的站点根路径本身就返回5xx或403，预热只为建立连接，结果不计入熔断器和负缓存。
+        """
+        key = self._host_key(url)
+        if key in self._warmed or self.breaker.is_open(key):
+            return
+        try:
+            if self.http2 and urlparse(url).scheme == 'https':
+                self._h2_client_for(url).head(key + '/', headers=DEFAULT_HEADERS, timeout=timeout,
+                                               follow_redirects=False).close()
+            else:
+                self.session_for(url).head(key + '/', headers=DEFAULT_HEADERS, timeout=timeout,
+                                           allow_redirects=False).close()
+            self._warmed.add(key)
+        except Exception as e:
+            logger.debug(f"连接预热失败: {key}, {e}")
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            for client in self._h2_clients.values():
+                client.close()
+            self._sessions.clear()
+            self._h2_clients.clear()
+            self._warmed.clear()
+            self._negative.clear()
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'hosts': self.breaker.stats(),
+            'negative_cache': sum(1 for _, expires in list(self._negative.values()) if expires > now)
+        }
+
+# 全局上游客户端
+upstream_client = UpstreamClient()
+
+class DownloadJob:
+    """一次下载任务的上下文，在该任务的所有分块线程之间共享"""
+
+    def __init__(self, job_id=None, weight=1.0, background=False):
+        self.job_id = job_id or str(uuid.uuid4())
+        self.weight = weight
+        self.background = background  # 后台任务（如预取）不享受小文件加权，并让位于前台请求
+        self.file_size = 0
+        self.bytes_downloaded = 0
+        self.source_sha256 = None
+        self.audio_format = None
+        self.format_error = None
+        self.format_checked = threading.Event()
+        self.cancelled = threading.Event()
+        self.error = None  # 最近一次下载失败的原因，用于决定是否回退以及返回的状态码
+        self.deadline = None
+        self.set_timeout(SERVER_SETTINGS['download_deadline'])
+        self.client_socket = None  # 发起请求的客户端连接，断开后取消任务
+        self._next_client_check = 0.0
+        self.tokens = 0.0
+        self.last_refill = time.monotonic()
+
+    def set_timeout(self, seconds):
+        """把截止时间收紧到从现在起seconds秒之后，不会放宽已有的时限；后台任务不设时限"""
+        if self.background or not seconds or seconds <= 0:
+            return
+        deadline = time.monotonic() + seconds
+        self.deadline = deadline if self.deadline is None else min(self.deadline, deadline)
+
+    def set_size(self, file_size):
+        """记录文件大小，并据此调整带宽权重（小文件优先）"""
+        self.file_size = file_size
+        if not self.background and 0 < file_size < SERVER_SETTINGS['small_file_threshold']:
+            self.weight = SERVER_SETTINGS['small_file_weight']
+
+    def check_format(self, head_bytes):
+        """根据文件开头的字节识别音频格式，不支持的格式会取消整个任务"""
+        try:
+            audio_format = sniff_audio_format(head_bytes)
+            if audio_format is None:
+                self.format_error = '不支持的音频格式'
+                self.cancelled.set()
+                raise UnsupportedFormatError(f"无法识别的音频格式，文件头: {bytes(head_bytes[:12])!r}")
+            self.audio_format = audio_format
+            logger.info(f"识别到音频格式: {audio_format}")
+        finally:
+            self.format_checked.set()
+
+    def ensure_active(self):
+        """任务已取消、超出总时限或客户端已断开时抛出异常，在读取每个缓冲区和开始每个步骤前调用"""
+        now = time.monotonic()
+        if self.client_socket is not None and now >= self._next_client_check:
+            self._next_client_check = now + CLIENT_CHECK_INTERVAL
+            if not self.cancelled.is_set() and client_disconnected(self.client_socket):
+                logger.info(f"客户端已断开连接，取消任务: {self.job_id}")
+                self.cancelled.set()
+        if self.cancelled.is_set():
+            raise DownloadCancelled("下载任务已取消")
+        if self.deadline is not None and now >= self.deadline:
+            raise DeadlineExceeded("下载超出总时限")
+
+    def wait_for_format(self, timeout=30):
+        """等待首个分块完成格式识别，格式不受支持时抛出异常"""
+        self.format_checked.wait(timeout)
+        if self.format_error:
+            raise UnsupportedFormatError(self.format_error)
+
+class BandwidthLimiter:
+    """令牌桶限速器：全局带宽上限，按任务权重公平分配
+
+    每个活动任务拥有自己的令牌桶，速率为 全局速率 * 任务权重 / 活动任务权重之和，
+    因此所有任务速率之和不超过全局上限，大文件也无法挤占小任务的份额。
+    """
+
+    STATS_WINDOW = 5  # 吞吐量统计窗口（秒）
+
+    def __init__(self, rate=0):
+        self.rate = rate  # 字节/秒，0表示不限速
+        self._jobs = {}
+        self._lock = threading.Lock()
+        # 按秒累计的字节数 [秒, 字节数]，只保留统计窗口内的几个桶，内存占用固定
+        self._buckets = deque(maxlen=self.STATS_WINDOW + 1)
+        self.total_bytes = 0
+
+    def register(self, job):
+        with self._lock:
+            job.tokens = 0.0
+            job.last_refill = time.monotonic()
+            self._jobs[job.job_id] = job
+
+    def unregister(self, job):
+        with self._lock:
+            self._jobs.pop(job.job_id, None)
+
+    def foreground_jobs(self):
+        """正在进行的前台下载任务数"""
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job.background)
+
+    def _job_rate(self, job):
+        total_weight = sum(j.weight for j in self._jobs.values()) or job.weight
+        return self.rate * job.weight / total_weight
+
+    def consume(self, job, nbytes):
+        """消耗nbytes个令牌，令牌不足时阻塞等待"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if job is not None and self.rate > 0 and job.job_id in self._jobs:
+                    job_rate = self._job_rate(job)
+                    burst = max(nbytes, job_rate * 0.25)
+                    job.tokens = min(burst, job.tokens + (now - job.last_refill) * job_rate)
+                    job.last_refill = now
+                    if job.tokens < nbytes:
+                        wait = (nbytes - job.tokens) / job_rate
+                    else:
+                        job.tokens -= nbytes
+                        wait = 0
+                else:
+                    wait = 0
+                if wait == 0:
+                    self.total_bytes += nbytes
+                    second = int(now)
+                    if self._buckets and self._buckets[-1][0] == second:
+                        self._buckets[-1][1] += nbytes
+                    else:
+                        self._buckets.append([second, nbytes])
+                    if job is not None:
+                        job.bytes_downloaded += nbytes
+                    return
+            time.sleep(min(wait, 0.5))
+
+    def throughput(self):
+        """最近统计窗口内的下载速率（字节/秒）"""
+        with self._lock:
+            cutoff = int(time.monotonic()) - self.STATS_WINDOW
+            return sum(nbytes for second, nbytes in self._buckets if second > cutoff) / self.STATS_WINDOW
+
+    def stats(self):
+        throughput = self.throughput()
+        with self._lock:
+            jobs = [{
+                'job_id': job.job_id,
+                'weight': job.weight,
+                'file_size': job.file_size,
+                'bytes_downloaded': job.bytes_downloaded,
+                'rate_limit': int(self._job_rate(job)) if self.rate > 0 else 0
+            } for job in self._jobs.values()]
+        return {
+            'rate_limit': self.rate,
+            'throughput': int(throughput),
+            'total_bytes': self.total_bytes,
+            'active_jobs': jobs
+        }
+
+# 全局带宽限速器
+bandwidth_limiter = BandwidthLimiter()
+
+# 每个线程复用的预分配I/O缓冲区
+_io_buffers = threading.local()
+IO_BLOCK_ALIGN = 64 * 1024
+THROTTLED_READ_SIZE = 64 * 1024  # 限速时单次读取的上限，保证令牌消耗平滑
+
+def get_io_buffer():
+    """获取当前线程的预分配缓冲区（按64KB对齐）"""
+    size = max(IO_BLOCK_ALIGN, SERVER_SETTINGS['io_buffer_size'] // IO_BLOCK_ALIGN * IO_BLOCK_ALIGN)
+    buffer = getattr(_io_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != size:
+        buffer = memoryview(bytearray(size))
+        _io_buffers.buffer = buffer
+    return buffer
+
+def _response_readinto(response):
+    """返回可直接读入缓冲区的readinto函数；无法直接读取原始流时返回None"""
+    raw = getattr(response, 'raw', None)
+    if raw is None:
+        return None
+    content_encoding = response.headers.get('content-encoding', 'identity').lower()
+    if content_encoding not in ('', 'identity'):
+        return None
+    # urllib3 的 readinto 内部仍会分配临时bytes，优先使用底层 http.client 响应
+    fp = getattr(raw, '_fp', None)
+    if fp is not None and hasattr(fp, 'readinto'):
+        return fp.readinto
+    return raw.readinto
+
+def write_response_to_file(response, f, job=None, hashers=(), sniff=False):
+    """把响应体写入文件：读入复用的缓冲区，缓冲区写满后整块写出，返回写入的字节数
+
+    hashers中的哈希对象随写入增量更新，不需要再读一遍文件。
+    sniff为True时先读取文件开头识别音频格式，不支持的格式在读取剩余内容前就中止。
+    """
+    try:
+        return _write_response_to_file(response, f, job, hashers, sniff and job is not None)
+    except Exception:
+        response.close()
+        raise
+
+def _write_response_to_file(response, f, job, hashers, sniff):
+    buffer = get_io_buffer()
+    buffer_size = len(buffer)
+    readinto = _response_readinto(response)
+    total = 0
+    
+    if readinto is None:
+        # 内容经过压缩或非urllib3响应时，退回到迭代读取
+        return write_chunks_to_file(response.iter_content(chunk_size=buffer_size), f, job, hashers, sniff)
+    
+    step = THROTTLED_READ_SIZE if bandwidth_limiter.rate > 0 else buffer_size
+    filled = 0
+    while True:
+        if job is not None:
+            job.ensure_active()
+        n = readinto(buffer[filled:min(filled + (SNIFF_SIZE if sniff else step), buffer_size)])
+        if not n:
+            break
+        if sniff:
+            job.check_format(buffer[:n])
+            sniff = False
+        bandwidth_limiter.consume(job, n)
+        filled += n
+        total += n
+        if filled == buffer_size:
+            for hasher in hashers:
+                hasher.update(buffer)
+            f.write(buffer)
+            filled = 0
+    if filled:
+        for hasher in hashers:
+            hasher.update(buffer[:filled])
+        f.write(buffer[:filled])
+    
+    # 绕过urllib3读取后需要手动把连接归还连接池
+    if response.raw is not None and getattr(response.raw, '_fp', None) is not None:
+        response.raw.release_conn()
+    return total
+
+def write_chunks_to_file(chunks, f, job=None, hashers=(), sniff=False):
+    """把逐块读取的响应内容写入文件（限速并增量计算哈希），返回写入的字节数"""
+    total = 0
+    for chunk in chunks:
+        if job is not None:
+            job.ensure_active()
+        if chunk:
+            if sniff:
+                job.check_format(chunk)
+                sniff = False
+            bandwidth_limiter.consume(job, len(chunk))
+            for hasher in hashers:
+                hasher.update(chunk)
+            f.write(chunk)
+            total += len(chunk)
+    return total
+
+def copy_file_into(src_path, dst_file, hashers=()):
+    """使用复用缓冲区把文件内容追加到已打开的目标文件，返回复制的字节数"""
+    buffer = get_io_buffer()
+    total = 0
+    with open(src_path, 'rb', buffering=0) as src:
+        while True:
+            n = src.readinto(buffer)
+            if not n:
+                break
+            for hasher in hashers:
+                hasher.update(buffer[:n])
+            dst_file.write(buffer[:n])
+            total += n
+    return total
+
+def file_sha256(file_path):
+    """计算文件的SHA-256"""
+    hasher = hashlib.sha256()
+    buffer = get_io_buffer()
+    with open(file_path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            hasher.update(buffer[:n])
+    return hasher.hexdigest()
+
+class IntegrityError(Exception):
+    """下载内容与上游声明的长度或校验值不一致"""
+
+class UnsupportedFormatError(Exception):
+    """下载内容不是支持的音频格式"""
+
+class DownloadCancelled(Exception):
+    """下载任务已被取消"""
+
+class DeadlineExceeded(Exception):
+    """下载超出了任务的总时限"""
+
+class UpstreamUnavailable(Exception):
+    """上游主机处于熔断状态，或URL近期返回过404/403，请求没有发出"""
+
+    def __init__(self, message, status=503):
+        super().__init__(message)
+        self.status = status
+
+CLIENT_CHECK_INTERVAL = 0.5  # 检查客户端是否断开的最小间隔（秒）
+
+def client_disconnected(sock):
+    """请求体读完之后连接变为可读且读到EOF，说明客户端已关闭连接"""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and not sock.recv(1, socket.MSG_PEEK)
+    except ValueError:
+        # TLS连接不支持MSG_PEEK，无法检测
+        return False
+    except OSError:
+        return True
+
+def job_active(job):
+    """任务未被取消且未超时时返回True，否则把原因记录到job.error（job为None时总是True）"""
+    if job is None:
+        return True
+    try:
+        job.ensure_active()
+        return True
+    except (DownloadCancelled, DeadlineExceeded) as e:
+        job.error = e
+        return False
+
+def run_if_active(job, func, *args):
+    """在线程池中排队的步骤开始前确认所属请求仍然有效，已取消或超时时跳过并返回False"""
+    if not job_active(job):
+        logger.info(f"请求已取消或超时，跳过: {func.__name__}")
+        return False
+    return func(*args)
+
+def download_failure(job):
+    """下载失败时返回给客户端的 (错误信息, 状态码)"""
+    if job.format_error:
+        return job.format_error, 415
+    error = job.error
+    if isinstance(error, DownloadCancelled):
+        return '请求已取消', 499
+    if isinstance(error, UpstreamUnavailable):
+        return ('音乐文件不存在或无权访问', 404) if error.status in NEGATIVE_CACHE_STATUSES else ('上游服务器暂时不可用', 503)
+    if isinstance(error, DeadlineExceeded):
+        return '音乐文件下载超时', 504
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status in NEGATIVE_CACHE_STATUSES:
+        return '音乐文件不存在或无权访问', 404
+    return '音乐文件下载失败', 500
+
+# 格式名 -> 输出文件扩展名（第一个为默认扩展名）
+FORMAT_EXTENSIONS = {
+    'mp3': ('.mp3',),
+    'flac': ('.flac',),
+    'ogg': ('.ogg', '.oga'),
+    'mp4': ('.m4a', '.mp4'),
+    'wav': ('.wav',),
+    'aiff': ('.aiff', '.aif'),
+}
+
+SNIFF_SIZE = 4096  # 识别格式时首次读取的字节数
+
+def id3v2_tag_size(head):
+    """返回文件开头ID3v2标签的总字节数（含标签头和页脚），没有标签时返回0"""
+    if not head.startswith(b'ID3') or len(head) < 10:
+        return 0
+    size = ((head[6] & 0x7f) << 21) | ((head[7] & 0x7f) << 14) | ((head[8] & 0x7f) << 7) | (head[9] & 0x7f)
+    footer = 10 if head[5] & 0x10 else 0
+    return 10 + size + footer
+
+def sniff_audio_format(head):
+    """根据文件开头的字节识别音频容器格式，无法识别或不支持时返回None"""
+    head = bytes(head)
+    if head.startswith(b'ID3') and len(head) >= 10:
+        # 跳过ID3v2标签，查看标签后的真实数据
+        body = head[id3v2_tag_size(head):]
+        if body.startswith(b'fLaC'):
+            return 'flac'
+        return 'mp3'
+    if head.startswith(b'fLaC'):
+        return 'flac'
+    if head.startswith(b'OggS'):
+        # 只支持Vorbis编码的Ogg（Opus、Ogg FLAC等不支持）
+        return 'ogg' if head[28:35] == b'\x01vorbis' else None
+    if head[4:8] in (b'ftyp', b'moov', b'mdat', b'free', b'wide'):
+        return 'mp4'
+    if head.startswith(b'RIFF') and head[8:12] == b'WAVE':
+        return 'wav'
+    if head.startswith(b'FORM') and head[8:12] in (b'AIFF', b'AIFC'):
+        return 'aiff'
+    if len(head) >= 2 and head[0] == 0xff and (head[1] & 0xe0) == 0xe0 and (head[1] & 0x06) != 0:
+        # MPEG音频帧同步字（排除layer为0的ADTS AAC）
+        return 'mp3'
+    return None
+
+def format_from_extension(filename):
+    """根据扩展名推断格式，未知扩展名返回None"""
+    file_ext = os.path.splitext(filename)[1].lower()
+    for audio_format, extensions in FORMAT_EXTENSIONS.items():
+        if file_ext in extensions:
+            return audio_format
+    return None
+
+def filename_for_format(filename, audio_format):
+    """让文件名的扩展名与实际格式一致"""
+    if audio_format is None or format_from_extension(filename) == audio_format:
+        return filename
+    base = os.path.splitext(filename)[0] if format_from_extension(filename) else filename
+    return f"{base}{FORMAT_EXTENSIONS[audio_format][0]}"
+
+def expected_md5(headers):
+    """从Content-MD5或形如MD5的强ETag中取出上游声明的MD5（十六进制），没有则返回None"""
+    content_md5 = headers.get('content-md5')
+    if content_md5:
+        try:
+            return base64.b64decode(content_md5).hex()
+        except ValueError:
+            logger.warning(f"无效的Content-MD5: {content_md5}")
+    etag = headers.get('etag', '')
+    if SERVER_SETTINGS['verify_etag'] and etag and not etag.startswith('W/'):
+        etag = etag.strip('"')
+        if re.fullmatch(r'[0-9a-fA-F]{32}', etag):
+            return etag.lower()
+    return None
+
+def new_hashers(headers):
+    """创建下载时增量计算的哈希对象：总是计算SHA-256，上游提供MD5时同时计算MD5"""
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5() if expected_md5(headers) else None
+    return sha256, md5
+
+def verify_download(headers, bytes_written, md5, expected_size=None):
+    """校验下载的字节数和MD5，不一致时抛出IntegrityError"""
+    if expected_size is None and headers.get('content-encoding', 'identity').lower() in ('', 'identity'):
+        expected_size = int(headers.get('content-length', 0) or 0) or None
+    if expected_size is not None and bytes_written != expected_size:
+        raise IntegrityError(f"下载长度不一致: 期望 {expected_size} bytes, 实际 {bytes_written} bytes")
+    expected = expected_md5(headers)
+    if expected and md5 is not None and md5.hexdigest() != expected:
+        raise IntegrityError(f"MD5校验失败: 期望 {expected}, 实际 {md5.hexdigest()}")
+
+_orjson_module = False  # False表示尚未尝试导入，None表示未安装
+
+def load_orjson():
+    """按需导入orjson，未安装或配置为标准库时返回None"""
+    global _orjson_module
+    if SERVER_SETTINGS['json_backend'] == 'json':
+        return None
+    if _orjson_module is False:
+        try:
+            import orjson
+            _orjson_module = orjson
+        except ImportError:
+            _orjson_module = None
+    return _orjson_module
 
-def download_file_chunk(url, start_byte, end_byte, chunk_file_path):
+def safe_json_parse(json_string):
+    """解析JSON（接受str或bytes），允许字符串中出现未转义的换行符等控制字符
+
+    安装了orjson时优先用它解析；orjson拒绝未转义的控制字符，此时才用标准库的宽松模式再解析一次。
+    字段中控制字符的清理由validate_job_data负责，不再对整个请求体做正则替换。
+    """
+    orjson = load_orjson()
+    if orjson is not None:
+        try:
+            return orjson.loads(json_string)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(json_string, strict=False)
+
+def download_file_chunk(url, start_byte, end_byte, chunk_file_path, job=None):
     """下载文件的指定分块"""
+    response = None
     try:
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
@@ -84,98 +906,273 @@ def download_file_chunk(url, start_byte, end_byte, chunk_file_path):
             'Range': f'bytes={start_byte}-{end_byte}'
         }
         
-        response = download_session.get(url, headers=headers, stream=True, timeout=30)
+        # 只有首个分块负责识别格式，其余分块等格式确认后才发出请求，格式不受支持时不占用连接
+        if job is not None and start_byte > 0:
+            job.wait_for_format()
+        
+        # 排队期间请求可能已被取消或超时
+        if job is not None:
+            job.ensure_active()
+        response = upstream_client.get(url, headers=headers, stream=True, timeout=30,
+                                       deadline=job.deadline if job is not None else None)
         response.raise_for_status()
+        if response.status_code != 206:
+            raise IntegrityError(f"服务器不支持Range请求，返回状态码 {response.status_code}")
         
         with open(chunk_file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+            bytes_written = write_response_to_file(response, f, job, sniff=(start_byte == 0))
+        
+        # 分块长度必须与请求的字节范围一致，防止截断的分块被合并
+        if bytes_written != end_byte - start_byte + 1:
+            raise IntegrityError(f"分块长度不一致: 期望 {end_byte - start_byte + 1} bytes, 实际 {bytes_written} bytes")
         
         return True
     except Exception as e:
         logger.error(f"下载分块失败: {e}")
+        if job is not None:
+            job.error = e
+        # 出错时连接上可能还有未读完的数据，关闭后不会再被放回连接池
+        if response is not None:
+            response.close()
         return False
+    finally:
+        if job is not None and start_byte == 0:
+            job.format_checked.set()
+
+SEGMENTS_PER_WORKER = 4    # 有镜像时每个下载线程平均分到的分块数，分块越多越能按速度分配
+SOURCE_MAX_FAILURES = 3    # 同一来源累计失败该次数后不再领取分块
+
+class SegmentQueue:
+    """分块下载的共享队列：各下载线程领取下一个分块，速度快的来源自然领到更多分块
+
+    下载失败的分块放回队列，由其它线程（可能是其它镜像）重试；
+    队列为空但还有分块在下载时，空闲线程等待，以便接手失败后放回的分块。
+    """
+
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.aborted = False
+        self._pending = deque(range(len(ranges)))
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    def take(self):
+        """领取下一个分块的序号，没有剩余分块或已中止时返回None"""
+        with self._cond:
+            while not self._pending and self._in_flight and not self.aborted:
+                self._cond.wait()
+            if self.aborted or not self._pending:
+                return None
+            self._in_flight += 1
+            return self._pending.popleft()
+
+    def done(self, index, ok):
+        with self._cond:
+            self._in_flight -= 1
+            if not ok:
+                self._pending.appendleft(index)
+            self._cond.notify_all()
+
+    def abort(self):
+        with self._cond:
+            self.aborted = True
+            self._cond.notify_all()
+
+    def remaining(self):
+        with self._cond:
+            return len(self._pending)
+
+def mirror_mismatch(primary_headers, mirror_headers, file_size):
+    """比较镜像与主地址的HEAD响应，内容可能不同时返回原因，一致时返回None"""
+    try:
+        length = int(mirror_headers.get('content-length', 0))
+    except ValueError:
+        length = 0
+    if length != file_size:
+        return f"长度 {length} != {file_size}"
+    md5, mirror_md5 = expected_md5(primary_headers), expected_md5(mirror_headers)
+    if md5 and mirror_md5:
+        return None if md5 == mirror_md5 else "MD5不同"
+    etag, mirror_etag = primary_headers.get('etag', ''), mirror_headers.get('etag', '')
+    if etag and mirror_etag and not etag.startswith('W/') and not mirror_etag.startswith('W/') \
+            and etag != mirror_etag:
+        return "ETag不同"
+    return None
+
+def probe_mirrors(mirrors, headers, primary_headers, file_size, job=None):
+    """并行对镜像发HEAD请求，只保留长度和校验值与主地址一致的镜像"""
+    deadline = job.deadline if job is not None else None
+    futures = [(mirror, download_executor.submit(upstream_client.head, mirror, headers=headers,
+                                                 timeout=10, deadline=deadline))
+               for mirror in mirrors]
+    accepted = []
+    for mirror, future in futures:
+        try:
+            response = future.result()
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"镜像不可用，已忽略: {mirror}, {e}")
+            continue
+        reason = mirror_mismatch(primary_headers, response.headers, file_size)
+        if reason:
+            logger.warning(f"镜像内容与主地址不一致（{reason}），已忽略: {mirror}")
+            continue
+        accepted.append(mirror)
+    return accepted
 
-def download_file_parallel(url, file_path, num_threads=8):
-    """多线程并行下载文件"""
+def _segment_worker(source, segments, chunk_files, job, source_stats, stats_lock):
+    """从分块队列领取分块并从source下载，直到分块领完、来源失效或任务终止"""
+    stats = source_stats[source]
+    while stats['failures'] < SOURCE_MAX_FAILURES:
+        index = segments.take()
+        if index is None:
+            return
+        start_byte, end_byte = segments.ranges[index]
+        started = time.monotonic()
+        ok = download_file_chunk(source, start_byte, end_byte, chunk_files[index], job)
+        segments.done(index, ok)
+        with stats_lock:
+            if ok:
+                stats['segments'] += 1
+                stats['bytes'] += end_byte - start_byte + 1
+                stats['seconds'] += time.monotonic() - started
+                continue
+            stats['failures'] += 1
+        if job is not None and (job.format_error or isinstance(job.error, (DeadlineExceeded, DownloadCancelled))):
+            # 格式不受支持、请求已取消或超时时，其它来源也没有必要继续
+            segments.abort()
+            return
+        if not upstream_client.available(source):
+            stats['failures'] = SOURCE_MAX_FAILURES
+    logger.warning(f"下载来源多次失败，剩余分块交给其它来源: {source}")
+
+def download_file_parallel(url, file_path, num_threads=8, job=None, mirrors=()):
+    """多线程并行下载文件，提供镜像时按各来源的实际速度分配分块"""
+    chunk_files = []
     try:
         logger.info(f"开始多线程下载: {url}")
         
         # 获取文件大小
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': '*/*'
+            'Accept': '*/*',
+            'Accept-Encoding': 'identity'
         }
         
-        response = download_session.head(url, headers=headers, timeout=10)
-        response.raise_for_status()
+        # 主地址不可用时改用第一个可用的镜像作为基准
+        candidates = [url, *mirrors]
+        for index, candidate in enumerate(candidates):
+            try:
+                response = upstream_client.head(candidate, headers=headers, timeout=10,
+                                                deadline=job.deadline if job is not None else None)
+                response.raise_for_status()
+                break
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if index == len(candidates) - 1:
+                    raise
+                logger.warning(f"获取文件信息失败，改用镜像: {candidate}, {e}")
+        url, mirrors = candidates[index], candidates[index + 1:]
         
         file_size = int(response.headers.get('content-length', 0))
         
         if file_size == 0:
             # 如果不支持HEAD或无法获取大小，回退到单线程下载
             logger.warning("无法获取文件大小，使用单线程下载")
-            return download_file_single(url, file_path)
-        
-        logger.info(f"文件大小: {file_size} bytes, 使用 {num_threads} 个线程下载")
+            return download_file_single(url, file_path, job)
+        
+        if job is not None:
+            job.set_size(file_size)
+        
+        # 只使用长度和校验值与基准一致的镜像，保证各来源提供的是同一份字节
+        sources = [url]
+        if mirrors:
+            sources += probe_mirrors(mirrors, headers, response.headers, file_size, job)
+        
+        # 小文件减少分块数量，避免为每个分块单独建立TCP+TLS连接
+        max_segments = max(1, file_size // SERVER_SETTINGS['min_segment_size'])
+        num_threads = max(1, min(num_threads, max_segments))
+        if num_threads == 1 and len(sources) == 1:
+            logger.info(f"文件较小({file_size} bytes)，复用已有连接单线程下载")
+            return download_file_single(url, file_path, job)
+        
+        # 只有一个来源时每个线程一个分块；有镜像时切得更细，由各线程按速度领取
+        if len(sources) > 1:
+            num_threads = min(max(num_threads, len(sources)), max_segments)
+            segment_count = min(max_segments, num_threads * SEGMENTS_PER_WORKER)
+        else:
+            segment_count = num_threads
+        logger.info(f"文件大小: {file_size} bytes, 使用 {num_threads} 个线程从 {len(sources)} 个来源下载 {segment_count} 个分块")
         
-        # 计算每个线程下载的字节范围
-        chunk_size = file_size // num_threads
+        # 计算每个分块的字节范围
+        chunk_size = file_size // segment_count
         ranges = []
         
-        for i in range(num_threads):
+        for i in range(segment_count):
             start_byte = i * chunk_size
-            end_byte = start_byte + chunk_size - 1 if i < num_threads - 1 else file_size - 1
+            end_byte = start_byte + chunk_size - 1 if i < segment_count - 1 else file_size - 1
             ranges.append((start_byte, end_byte))
         
         # 临时分块文件列表
-        chunk_files = []
-        futures = []
+        chunk_files = [f"{file_path}.part{i}" for i in range(segment_count)]
+        segments = SegmentQueue(ranges)
+        source_stats = {source: {'segments': 0, 'bytes': 0, 'seconds': 0.0, 'failures': 0} for source in sources}
+        stats_lock = threading.Lock()
+        
+        # 下载线程轮流分配给各来源，使用线程池并行下载分块
+        futures = [
+            download_executor.submit(_segment_worker, sources[i % len(sources)], segments,
+                                     chunk_files, job, source_stats, stats_lock)
+            for i in range(num_threads)
+        ]
+        for future in futures:
+            future.result()
         
-        # 使用线程池并行下载分块
-        for i, (start_byte, end_byte) in enumerate(ranges):
-            chunk_file_path = f"{file_path}.part{i}"
-            chunk_files.append(chunk_file_path)
-            
-            future = download_executor.submit(
-                download_file_chunk, url, start_byte, end_byte, chunk_file_path
-            )
-            futures.append(future)
+        if len(sources) > 1:
+            for source, stats in source_stats.items():
+                speed = stats['bytes'] / stats['seconds'] / 1024 if stats['seconds'] else 0
+                logger.info(f"来源 {source}: {stats['segments']} 个分块, {speed:.0f} KB/s, 失败 {stats['failures']} 次")
         
-        # 等待所有分块下载完成
-        for future in as_completed(futures):
-            if not future.result():
-                logger.error("某个分块下载失败")
-                # 清理已下载的分块
-                for chunk_file in chunk_files:
-                    if os.path.exists(chunk_file):
-                        os.remove(chunk_file)
-                return False
+        if segments.aborted or segments.remaining():
+            logger.error("某个分块下载失败")
+            # 清理已下载的分块
+            for chunk_file in chunk_files:
+                if os.path.exists(chunk_file):
+                    os.remove(chunk_file)
+            return False
         
-        # 合并分块文件
+        # 合并分块文件，合并的同时按顺序计算整个文件的哈希
         logger.info("开始合并分块文件")
-        with open(file_path, 'wb') as output_file:
+        sha256, md5 = new_hashers(response.headers)
+        hashers = [h for h in (sha256, md5) if h is not None]
+        bytes_written = 0
+        with open(file_path, 'wb', buffering=0) as output_file:
             for chunk_file in chunk_files:
-                with open(chunk_file, 'rb') as input_file:
-                    shutil.copyfileobj(input_file, output_file)
+                bytes_written += copy_file_into(chunk_file, output_file, hashers)
                 # 删除临时分块文件
                 os.remove(chunk_file)
         
+        verify_download(response.headers, bytes_written, md5, expected_size=file_size)
+        if job is not None:
+            job.source_sha256 = sha256.hexdigest()
+        
         logger.info(f"下载完成: {file_path}, 文件大小: {os.path.getsize(file_path)} bytes")
         return True
         
     except Exception as e:
         logger.error(f"多线程下载失败: {e}")
+        if job is not None:
+            job.error = e
         # 清理可能存在的分块文件
-        for i in range(num_threads):
-            chunk_file = f"{file_path}.part{i}"
+        for chunk_file in chunk_files:
             if os.path.exists(chunk_file):
                 os.remove(chunk_file)
         return False
 
-def download_file_single(url, file_path):
+def download_file_single(url, file_path, job=None):
     """单线程下载文件（备用方案）"""
+    response = None
     try:
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
@@ -185,53 +1182,179 @@ def download_file_single(url, file_path):
         }
         
         logger.info(f"开始单线程下载: {url}")
-        response = download_session.get(url, stream=True, headers=headers, timeout=60)
+        response = upstream_client.get(url, stream=True, headers=headers, timeout=60,
+                                       deadline=job.deadline if job is not None else None)
         response.raise_for_status()
         
+        if job is not None and not job.file_size:
+            job.set_size(int(response.headers.get('content-length', 0)))
+        
+        sha256, md5 = new_hashers(response.headers)
+        hashers = [h for h in (sha256, md5) if h is not None]
         with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+            bytes_written = write_response_to_file(response, f, job, hashers, sniff=True)
+        
+        verify_download(response.headers, bytes_written, md5)
+        if job is not None:
+            job.source_sha256 = sha256.hexdigest()
         
         logger.info(f"单线程下载完成: {file_path}, 文件大小: {os.path.getsize(file_path)} bytes")
         return True
         
     except Exception as e:
         logger.error(f"单线程下载失败: {e}")
+        if job is not None:
+            job.error = e
+        if response is not None:
+            response.close()
         return False
 
-def download_file(url, file_path):
-    """下载文件到指定路径（自动选择多线程或单线程）"""
-    # 尝试多线程下载，如果失败则回退到单线程
-    if not download_file_parallel(url, file_path):
-        logger.warning("多线程下载失败，尝试单线程下载")
-        return download_file_single(url, file_path)
-    return True
+def download_file(url, file_path, job=None, num_threads=8, mirrors=()):
+    """下载文件到指定路径（自动选择多线程或单线程），mirrors为提供相同内容的备用地址"""
+    job = job or DownloadJob()
+    bandwidth_limiter.register(job)
+    try:
+        # 尝试多线程下载，如果失败则依次从各来源单线程下载
+        if download_file_parallel(url, file_path, num_threads=num_threads, job=job, mirrors=mirrors):
+            return True
+        for source in (url, *mirrors):
+            if job.format_error or isinstance(job.error, (DeadlineExceeded, DownloadCancelled)):
+                # 格式不受支持、请求已取消或超出总时限时没有必要再下载一遍
+                return False
+            logger.warning(f"多线程下载失败，尝试单线程下载: {source}")
+            if download_file_single(source, file_path, job):
+                return True
+        return False
+    finally:
+        bandwidth_limiter.unregister(job)
+
+# ---------------- 来源文件与封面缓存 ----------------
+# 缓存按URL保存在缓存目录中（不依赖进程内状态），命令行预取和服务器共用同一缓存目录即可生效。
+SOURCE_CACHE_DIR_NAME = 'sources'
+COVER_CACHE_DIR_NAME = 'covers'
+cache_stats = {'source_hits': 0, 'source_misses': 0, 'cover_hits': 0, 'cover_misses': 0}
+
+def _url_cache_key(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+def _cache_expired(timestamp):
+    return time.time() - timestamp > SERVER_SETTINGS['source_cache_ttl']
+
+def source_cache_lookup(url):
+    """返回来源缓存中该URL的文件信息，没有或已过期时返回None"""
+    cache_dir = os.path.join(TEMP_DIR, SOURCE_CACHE_DIR_NAME)
+    try:
+        with open(os.path.join(cache_dir, _url_cache_key(url) + '.json'), 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        info['path'] = os.path.join(cache_dir, info['filename'])
+        if info['url'] == url and not _cache_expired(info['fetched_at']) and os.path.exists(info['path']):
+            cache_stats['source_hits'] += 1
+            return info
+    except (OSError, ValueError, KeyError):
+        pass
+    cache_stats['source_misses'] += 1
+    return None
+
+def source_cache_store(url, file_path, job):
+    """把下载好的来源文件移入来源缓存"""
+    cache_dir = os.path.join(TEMP_DIR, SOURCE_CACHE_DIR_NAME)
+    os.makedirs(cache_dir, exist_ok=True)
+    key = _url_cache_key(url)
+    audio_format = job.audio_format or format_from_extension(urlparse(url).path)
+    filename = key + (FORMAT_EXTENSIONS[audio_format][0] if audio_format else '')
+    info = {
+        'url': url,
+        'filename': filename,
+        'audio_format': audio_format,
+        'sha256': job.source_sha256 or file_sha256(file_path),
+        'size': os.path.getsize(file_path),
+        'fetched_at': time.time()
+    }
+    os.replace(file_path, os.path.join(cache_dir, filename))
+    # 先写临时文件再重命名，读取方不会看到写了一半的索引
+    meta_path = os.path.join(cache_dir, key + '.json')
+    with open(meta_path + '.part', 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False)
+    os.replace(meta_path + '.part', meta_path)
+    return info
+
+def cover_cache_lookup(cover_url):
+    """返回封面缓存中的图片内容，没有或已过期时返回None"""
+    path = os.path.join(TEMP_DIR, COVER_CACHE_DIR_NAME, _url_cache_key(cover_url))
+    try:
+        if not _cache_expired(os.path.getmtime(path)):
+            with open(path, 'rb') as f:
+                data = f.read()
+            cache_stats['cover_hits'] += 1
+            return data
+    except OSError:
+        pass
+    cache_stats['cover_misses'] += 1
+    return None
+
+def cover_cache_store(cover_url, data):
+    """保存封面到封面缓存，失败时只记录日志"""
+    try:
+        cache_dir = os.path.join(TEMP_DIR, COVER_CACHE_DIR_NAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, _url_cache_key(cover_url))
+        with open(path + f'.{uuid.uuid4().hex[:8]}.part', 'wb') as f:
+            f.write(data)
+            part_path = f.name
+        os.replace(part_path, path)
+    except OSError as e:
+        logger.warning(f"保存封面缓存失败: {e}")
+
+def cleanup_url_caches():
+    """删除过期的来源文件和封面缓存"""
+    for dir_name in (SOURCE_CACHE_DIR_NAME, COVER_CACHE_DIR_NAME):
+        cache_dir = os.path.join(TEMP_DIR, dir_name)
+        if not os.path.isdir(cache_dir):
+            continue
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            try:
+                if _cache_expired(os.path.getmtime(path)):
+                    os.remove(path)
+            except OSError as e:
+                logger.warning(f"清理缓存失败: {e}")
 
-def download_cover(cover_url):
-    """下载封面图片"""
+def download_cover(cover_url, job=None):
+    """下载封面图片（优先使用封面缓存），没有封面地址时返回None；job用于遵守所属请求的时限"""
+    if not cover_url:
+        return None
+    cover_data = cover_cache_lookup(cover_url)
+    if cover_data is not None:
+        logger.info(f"命中封面缓存: {cover_url}")
+        return cover_data
     try:
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
+        if job is not None:
+            job.ensure_active()
         logger.info(f"开始下载封面: {cover_url}")
-        response = download_session.get(cover_url, headers=headers, timeout=30)
+        response = upstream_client.get(cover_url, headers=headers, timeout=30,
+                                       deadline=job.deadline if job is not None else None)
         response.raise_for_status()
         logger.info("封面下载成功")
+        cover_cache_store(cover_url, response.content)
         return response.content
     except Exception as e:
         logger.error(f"封面下载失败: {e}")
         return None
 
-def strip_existing_metadata(file_path):
+def strip_existing_metadata(file_path, audio_format=None):
     """删除文件中的所有现有元数据"""
     try:
         logger.info(f"开始清理现有元数据: {file_path}")
         
-        # 检测文件类型
-        file_ext = os.path.splitext(file_path)[1].lower()
+        # 检测文件类型（未识别格式时按扩展名判断）
+        audio_format = audio_format or format_from_extension(file_path)
         
-        if file_ext == '.mp3':
+        if audio_format == 'mp3':
+            from mutagen.id3 import delete
+            from mutagen.mp3 import MP3
             try:
                 delete(file_path)
                 logger.info("MP3 ID3标签删除成功")
@@ -245,7 +1368,8 @@ def strip_existing_metadata(file_path):
                 except:
                     pass
             
-        elif file_ext == '.flac':
+        elif audio_format == 'flac':
+            from mutagen.flac import FLAC
             try:
                 audio = FLAC(file_path)
                 audio.clear()
@@ -254,7 +1378,8 @@ def strip_existing_metadata(file_path):
             except Exception as e:
                 logger.warning(f"清除FLAC标签时出错: {e}")
             
-        elif file_ext in ['.ogg', '.oga']:
+        elif audio_format == 'ogg':
+            from mutagen.oggvorbis import OggVorbis
             try:
                 audio = OggVorbis(file_path)
                 audio.delete()
@@ -263,7 +1388,8 @@ def strip_existing_metadata(file_path):
             except Exception as e:
                 logger.warning(f"清除OGG标签时出错: {e}")
             
-        elif file_ext in ['.m4a', '.mp4']:
+        elif audio_format == 'mp4':
+            from mutagen.mp4 import MP4
             try:
                 audio = MP4(file_path)
                 audio.delete()
@@ -272,7 +1398,8 @@ def strip_existing_metadata(file_path):
             except Exception as e:
                 logger.warning(f"清除MP4标签时出错: {e}")
             
-        elif file_ext == '.wav':
+        elif audio_format == 'wav':
+            from mutagen.wave import WAVE
             try:
                 audio = WAVE(file_path)
                 if hasattr(audio, 'tags') and audio.tags:
@@ -282,7 +1409,8 @@ def strip_existing_metadata(file_path):
             except Exception as e:
                 logger.warning(f"清除WAV标签时出错: {e}")
                 
-        elif file_ext == '.aiff':
+        elif audio_format == 'aiff':
+            from mutagen.aiff import AIFF
             try:
                 audio = AIFF(file_path)
                 if hasattr(audio, 'tags') and audio.tags:
@@ -300,8 +1428,63 @@ def strip_existing_metadata(file_path):
         logger.error(traceback.format_exc())
         return False
 
+def fill_id3_tags(tags, metadata):
+    """把元数据（含封面）写入ID3标签对象"""
+    from mutagen.id3 import TIT2, TPE1, TALB, USLT, APIC, TDRC, COMM
+    
+    encoding = 3  # UTF-8编码
+    
+    # 设置基本元数据
+    if metadata.get('title'):
+        tags.add(TIT2(encoding=encoding, text=metadata['title']))
+    if metadata.get('artist'):
+        tags.add(TPE1(encoding=encoding, text=metadata['artist']))
+    if metadata.get('album'):
+        tags.add(TALB(encoding=encoding, text=metadata['album']))
+    if metadata.get('year'):
+        year_str = str(metadata['year'])
+        if year_str:
+            tags.add(TDRC(encoding=encoding, text=year_str))
+    
+    # 添加歌词
+    if metadata.get('lyrics'):
+        tags.add(USLT(encoding=encoding, lang='eng', desc='Lyrics', text=metadata['lyrics']))
+    
+    # 添加注释
+    if metadata.get('tips'):
+        tags.add(COMM(encoding=encoding, lang='eng', desc='Comment', text=metadata['tips']))
+    
+    # 添加封面
+    if metadata.get('cover_data'):
+        cover_data = metadata['cover_data']
+        # 检测MIME类型
+        mime_type = 'image/jpeg'
+        if cover_data.startswith(b'\x89PNG'):
+            mime_type = 'image/png'
+        
+        tags.add(APIC(
+            encoding=encoding,
+            mime=mime_type,
+            type=3,
+            desc='Cover',
+            data=cover_data
+        ))
+
+def render_id3_tag(metadata):
+    """生成独立的ID3v2.3标签字节（不含填充），用于流式输出时放在音频数据前"""
+    from mutagen.id3 import ID3
+    
+    tags = ID3()
+    fill_id3_tags(tags, metadata)
+    buffer = io.BytesIO()
+    tags.save(buffer, v2_version=3, padding=lambda info: 0)
+    return buffer.getvalue()
+
 def add_metadata_to_mp3(file_path, metadata):
     """向MP3文件添加元数据"""
+    from mutagen.id3 import delete
+    from mutagen.mp3 import MP3
+    
     try:
         logger.info(f"开始处理MP3文件: {file_path}")
         
@@ -326,43 +1509,7 @@ def add_metadata_to_mp3(file_path, metadata):
         audio.add_tags()
         tags = audio.tags
         
-        encoding = 3  # UTF-8编码
-        
-        # 设置基本元数据
-        if metadata.get('title'):
-            tags.add(TIT2(encoding=encoding, text=metadata['title']))
-        if metadata.get('artist'):
-            tags.add(TPE1(encoding=encoding, text=metadata['artist']))
-        if metadata.get('album'):
-            tags.add(TALB(encoding=encoding, text=metadata['album']))
-        if metadata.get('year'):
-            year_str = str(metadata['year'])
-            if year_str:
-                tags.add(TDRC(encoding=encoding, text=year_str))
-        
-        # 添加歌词
-        if metadata.get('lyrics'):
-            tags.add(USLT(encoding=encoding, lang='eng', desc='Lyrics', text=metadata['lyrics']))
-        
-        # 添加注释
-        if metadata.get('tips'):
-            tags.add(COMM(encoding=encoding, lang='eng', desc='Comment', text=metadata['tips']))
-        
-        # 添加封面
-        if metadata.get('cover_data'):
-            cover_data = metadata['cover_data']
-            # 检测MIME类型
-            mime_type = 'image/jpeg'
-            if cover_data.startswith(b'\x89PNG'):
-                mime_type = 'image/png'
-            
-            tags.add(APIC(
-                encoding=encoding,
-                mime=mime_type,
-                type=3,
-                desc='Cover',
-                data=cover_data
-            ))
+        fill_id3_tags(tags, metadata)
         
         audio.save(v2_version=3)
         logger.info("MP3元数据添加成功")
@@ -375,6 +1522,8 @@ def add_metadata_to_mp3(file_path, metadata):
 
 def add_metadata_to_flac(file_path, metadata):
     """向FLAC文件添加元数据"""
+    from mutagen.flac import FLAC, Picture
+    
     try:
         logger.info(f"开始处理FLAC文件: {file_path}")
         audio = FLAC(file_path)
@@ -423,6 +1572,8 @@ def add_metadata_to_flac(file_path, metadata):
 
 def add_metadata_to_ogg(file_path, metadata):
     """向OGG文件添加元数据"""
+    from mutagen.oggvorbis import OggVorbis
+    
     try:
         logger.info(f"开始处理OGG文件: {file_path}")
         audio = OggVorbis(file_path)
@@ -453,8 +1604,108 @@ def add_metadata_to_ogg(file_path, metadata):
         logger.error(traceback.format_exc())
         return False
 
+# 需要向下查找stco/co64的容器原子
+MP4_CONTAINER_ATOMS = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+
+def _mp4_atom_header(data, offset, end):
+    """解析位于offset的原子头，返回 (类型, 头部长度, 原子总长度)"""
+    size, kind = struct.unpack_from('>I4s', data, offset)
+    header_size = 8
+    if size == 1:
+        size = struct.unpack_from('>Q', data, offset + 8)[0]
+        header_size = 16
+    elif size == 0:
+        size = end - offset
+    if size < header_size or offset + size > end:
+        raise ValueError(f"无效的MP4原子: {kind!r}")
+    return kind, header_size, size
+
+def _mp4_top_level_atoms(f, file_size):
+    """列出文件的顶层原子: [(类型, 偏移, 长度)]"""
+    atoms = []
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        kind, _, size = _mp4_atom_header(f.read(16).ljust(16, b'\0'), 0, file_size - offset)
+        atoms.append((kind, offset, size))
+        offset += size
+    return atoms
+
+def _shift_chunk_offsets(moov, start, end, delta):
+    """把moov中所有stco/co64记录的块偏移加上delta，stco放不下时抛出ValueError"""
+    offset = start
+    while offset + 8 <= end:
+        kind, header_size, size = _mp4_atom_header(moov, offset, end)
+        body = offset + header_size
+        if kind in MP4_CONTAINER_ATOMS:
+            _shift_chunk_offsets(moov, body, offset + size, delta)
+        elif kind in (b'stco', b'co64'):
+            # 4字节version/flags之后是条目数和偏移表
+            count = struct.unpack_from('>I', moov, body + 4)[0]
+            table_format = f">{count}{'I' if kind == b'stco' else 'Q'}"
+            values = [value + delta for value in struct.unpack_from(table_format, moov, body + 8)]
+            if kind == b'stco' and values and max(values) > 0xFFFFFFFF:
+                raise ValueError("块偏移超出stco的32位范围")
+            struct.pack_into(table_format, moov, body + 8, *values)
+        offset += size
+
+def _copy_range(src, dst, length):
+    """把src当前位置开始的length字节复制到dst"""
+    buffer = memoryview(get_io_buffer())
+    while length:
+        n = src.readinto(buffer[:min(length, len(buffer))])
+        if not n:
+            raise ValueError("MP4文件被截断")
+        dst.write(buffer[:n])
+        length -= n
+
+def mp4_faststart(file_path):
+    """moov位于mdat之后时把它移到mdat之前并修正块偏移，返回是否移动了moov
+
+    新文件按 [mdat之前的原子][moov][其余原子] 的顺序一次写出后替换原文件；
+    moov已在前面、分片MP4、有多个mdat跨越moov或移动后stco偏移超出32位时不做处理。
+    """
+    with open(file_path, 'rb') as f:
+        atoms = _mp4_top_level_atoms(f, os.fstat(f.fileno()).st_size)
+        kinds = [atom[0] for atom in atoms]
+        if b'moov' not in kinds or b'mdat' not in kinds or b'moof' in kinds:
+            return False
+        moov_index = kinds.index(b'moov')
+        mdat_index = kinds.index(b'mdat')
+        if moov_index < mdat_index or b'mdat' in kinds[moov_index:]:
+            return False
+        
+        # moov插到第一个mdat之前，mdat中的数据整体后移moov的长度
+        _, moov_offset, moov_size = atoms[moov_index]
+        f.seek(moov_offset)
+        moov = bytearray(f.read(moov_size))
+    _, header_size, _ = _mp4_atom_header(moov, 0, moov_size)
+    try:
+        _shift_chunk_offsets(moov, header_size, moov_size, moov_size)
+    except ValueError as e:
+        logger.warning(f"无法移动moov，保持原样: {e}")
+        return False
+    
+    order = atoms[:mdat_index] + [atoms[moov_index]] + atoms[mdat_index:moov_index] + atoms[moov_index + 1:]
+    temp_path = file_path + '.faststart'
+    try:
+        with open(file_path, 'rb') as src, open(temp_path, 'wb') as dst:
+            for kind, offset, size in order:
+                if kind == b'moov':
+                    dst.write(moov)
+                else:
+                    src.seek(offset)
+                    _copy_range(src, dst, size)
+        os.replace(temp_path, file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return True
+
 def add_metadata_to_mp4(file_path, metadata):
     """向MP4文件添加元数据"""
+    from mutagen.mp4 import MP4, MP4Cover
+    
     try:
         logger.info(f"开始处理MP4文件: {file_path}")
         audio = MP4(file_path)
@@ -489,9 +1740,17 @@ def add_metadata_to_mp4(file_path, metadata):
         # 添加封面
         if metadata.get('cover_data'):
             cover_data = metadata['cover_data']
-            audio['covr'] = [MP4.Cover(cover_data)]
+            image_format = MP4Cover.FORMAT_PNG if cover_data.startswith(b'\x89PNG') else MP4Cover.FORMAT_JPEG
+            audio['covr'] = [MP4Cover(cover_data, imageformat=image_format)]
         
+        # moov在末尾时mutagen只改写文件尾部，随后整理布局时一次复制完成，不会把mdat复制两遍
         audio.save()
+        # 标签已经保存，移动moov失败不影响打标签的结果
+        try:
+            if SERVER_SETTINGS['mp4_faststart'] and mp4_faststart(file_path):
+                logger.info("已把moov移到文件开头")
+        except Exception as e:
+            logger.warning(f"移动moov失败，保持原样: {e}")
         logger.info("MP4元数据添加成功")
         return True
         
@@ -502,6 +1761,9 @@ def add_metadata_to_mp4(file_path, metadata):
 
 def add_metadata_to_wav(file_path, metadata):
     """向WAV文件添加元数据"""
+    from mutagen.id3 import TIT2, TPE1, TALB, USLT, TDRC, COMM
+    from mutagen.wave import WAVE
+    
     try:
         logger.info(f"开始处理WAV文件: {file_path}")
         audio = WAVE(file_path)
@@ -537,6 +1799,9 @@ def add_metadata_to_wav(file_path, metadata):
 
 def add_metadata_to_aiff(file_path, metadata):
     """向AIFF文件添加元数据"""
+    from mutagen.id3 import TIT2, TPE1, TALB, USLT, TDRC, COMM
+    from mutagen.aiff import AIFF
+    
     try:
         logger.info(f"开始处理AIFF文件: {file_path}")
         audio = AIFF(file_path)
@@ -570,178 +1835,1805 @@ def add_metadata_to_aiff(file_path, metadata):
         logger.error(traceback.format_exc())
         return False
 
-def add_metadata_to_file(file_path, metadata):
+# 格式名 -> 元数据写入函数；各函数在首次调用时才导入对应的mutagen模块
+FORMAT_WRITERS = {
+    'mp3': add_metadata_to_mp3,
+    'flac': add_metadata_to_flac,
+    'ogg': add_metadata_to_ogg,
+    'mp4': add_metadata_to_mp4,
+    'wav': add_metadata_to_wav,
+    'aiff': add_metadata_to_aiff,
+}
+
+def add_metadata_to_file(file_path, metadata, audio_format=None):
     """根据文件类型添加元数据"""
     try:
+        # 检测文件类型（未识别格式时按扩展名判断）
+        audio_format = audio_format or format_from_extension(file_path)
+        
         # 首先清理现有元数据
-        strip_existing_metadata(file_path)
-        
-        # 检测文件类型
-        file_ext = os.path.splitext(file_path)[1].lower()
-        
-        if file_ext == '.mp3':
-            return add_metadata_to_mp3(file_path, metadata)
-        elif file_ext == '.flac':
-            return add_metadata_to_flac(file_path, metadata)
-        elif file_ext in ['.ogg', '.oga']:
-            return add_metadata_to_ogg(file_path, metadata)
-        elif file_ext in ['.m4a', '.mp4']:
-            return add_metadata_to_mp4(file_path, metadata)
-        elif file_ext == '.wav':
-            return add_metadata_to_wav(file_path, metadata)
-        elif file_ext == '.aiff':
-            return add_metadata_to_aiff(file_path, metadata)
-        else:
-            logger.error(f"不支持的文件格式: {file_ext}")
+        strip_existing_metadata(file_path, audio_format)
+        
+        writer = FORMAT_WRITERS.get(audio_format)
+        if writer is None:
+            logger.error(f"不支持的文件格式: {file_path}")
             return False
+        return writer(file_path, metadata)
             
     except Exception as e:
         logger.error(f"处理文件时出错: {e}")
         logger.error(traceback.format_exc())
         return False
 
-def cleanup_old_files():
-    """清理旧文件"""
-    while True:
-        time.sleep(60)
-        if is_shutting_down:
-            break
-            
-        current_time = time.time()
-        files_to_delete = []
-        
-        for file_id, file_info in list(file_registry.items()):
-            if current_time - file_info['created_time'] > FILE_CLEANUP_TIME:
-                files_to_delete.append((file_id, file_info['path']))
-        
-        for file_id, file_path in files_to_delete:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                del file_registry[file_id]
-                logger.info(f"已清理文件: {file_path}")
-            except Exception as e:
-                logger.error(f"清理文件失败: {e}")
+# 元数据字段 -> 各标签体系中的键
+ID3_FIELD_FRAMES = {'title': 'TIT2', 'artist': 'TPE1', 'album': 'TALB', 'year': 'TDRC', 'lyrics': 'USLT', 'tips': 'COMM'}
+VORBIS_FIELD_KEYS = {'title': 'title', 'artist': 'artist', 'album': 'album', 'year': 'date', 'lyrics': 'lyrics', 'tips': 'comment'}
+MP4_FIELD_KEYS = {'title': '\xa9nam', 'artist': '\xa9ART', 'album': '\xa9alb', 'year': '\xa9day', 'lyrics': '\xa9lyr', 'tips': '\xa9cmt'}
 
-@app.route('/process-music', methods=['POST', 'OPTIONS'])
-def process_music():
-    """处理音乐文件"""
-    if is_shutting_down:
-        return jsonify({'error': '服务器正在关闭'}), 503
-        
-    if request.method == 'OPTIONS':
-        return jsonify({'status': 'ok'})
+def update_metadata_in_file(file_path, delta, audio_format=None):
+    """只修改delta中的字段，封面和其他标签保持不变；值为空字符串时删除该字段
+
+    mutagen保存时优先使用标签中已有的填充空间，改动不大时只需原地改写文件开头。
+    """
+    from mutagen import File
     
     try:
-        # 安全解析JSON数据
+        audio_format = audio_format or format_from_extension(file_path)
+        audio = File(file_path)
+        if audio is None:
+            logger.error(f"无法识别的音频文件: {file_path}")
+            return False
+        
+        if audio_format in ('mp3', 'wav', 'aiff'):
+            if audio.tags is None:
+                audio.add_tags()
+            for field, value in delta.items():
+                audio.tags.delall(ID3_FIELD_FRAMES[field])
+                if value:
+                    fill_id3_tags(audio.tags, {field: value})
+            # 与写入时保持相同的ID3版本
+            if audio_format == 'mp3':
+                audio.save(v2_version=3)
+            else:
+                audio.save()
+        elif audio_format in ('flac', 'ogg', 'mp4'):
+            field_keys = MP4_FIELD_KEYS if audio_format == 'mp4' else VORBIS_FIELD_KEYS
+            if audio.tags is None:
+                audio.add_tags()
+            for field, value in delta.items():
+                key = field_keys[field]
+                if value:
+                    audio[key] = [value]
+                elif key in audio:
+                    del audio[key]
+            audio.save()
+        else:
+            logger.error(f"不支持的文件格式: {file_path}")
+            return False
+        
+        logger.info(f"元数据已更新: {file_path}, 字段: {', '.join(delta)}")
+        return True
+    
+    except Exception as e:
+        logger.error(f"更新元数据失败: {e}")
+        logger.error(traceback.format_exc())
+        return False
+
+def _cover_info(data, mime=None, picture_type=3, width=None, height=None):
+    """封面信息：MIME、大小、校验值（不返回图片内容本身）"""
+    if not mime:
+        mime = 'image/png' if data.startswith(b'\x89PNG') else 'image/jpeg'
+    info = {
+        'mime': mime,
+        'type': picture_type,
+        'size': len(data),
+        'sha256': hashlib.sha256(data).hexdigest()
+    }
+    if width and height:
+        info['width'], info['height'] = width, height
+    return info
+
+def read_file_metadata(file_path, audio_format=None):
+    """读取文件中实际写入的标签、封面和音频流信息"""
+    from mutagen import File
+    
+    audio_format = audio_format or format_from_extension(file_path)
+    audio = File(file_path)
+    if audio is None:
+        raise ValueError(f"无法识别的音频文件: {file_path}")
+    tags = audio.tags
+    fields = {}
+    covers = []
+    
+    if tags is not None and audio_format in ('mp3', 'wav', 'aiff'):
+        for field, frame_id in ID3_FIELD_FRAMES.items():
+            frames = tags.getall(frame_id)
+            if frames:
+                text = frames[0].text
+                fields[field] = text if isinstance(text, str) else '/'.join(str(t) for t in text)
+        covers = [_cover_info(frame.data, frame.mime, frame.type) for frame in tags.getall('APIC')]
+    elif tags is not None and audio_format in ('flac', 'ogg'):
+        for field, key in VORBIS_FIELD_KEYS.items():
+            if key in tags:
+                fields[field] = '/'.join(tags[key])
+        if audio_format == 'flac':
+            pictures = audio.pictures
+        else:
+            from mutagen.flac import Picture
+            pictures = [Picture(base64.b64decode(value)) for value in tags.get('metadata_block_picture', [])]
+        covers = [_cover_info(pic.data, pic.mime, pic.type, pic.width, pic.height) for pic in pictures]
+    elif tags is not None and audio_format == 'mp4':
+        for field, key in MP4_FIELD_KEYS.items():
+            if key in tags:
+                fields[field] = '/'.join(str(v) for v in tags[key])
+        covers = [_cover_info(bytes(cover)) for cover in tags.get('covr', [])]
+    
+    info = audio.info
+    return {
+        'format': audio_format,
+        'tags': fields,
+        'tag_keys': sorted(tags.keys()) if tags is not None else [],
+        'covers': covers,
+        'stream': {
+            'duration': round(getattr(info, 'length', 0) or 0, 3),
+            'bitrate': getattr(info, 'bitrate', None),
+            'sample_rate': getattr(info, 'sample_rate', None),
+            'channels': getattr(info, 'channels', None),
+            'bits_per_sample': getattr(info, 'bits_per_sample', None)
+        }
+    }
+
+METADATA_CACHE_SIZE = 256
+metadata_cache = OrderedDict()  # 文件SHA-256 -> 解析结果（LRU）
+metadata_cache_stats = {'hits': 0, 'misses': 0}
+metadata_cache_lock = threading.Lock()
+
+def cached_file_metadata(file_path, sha256, audio_format=None):
+    """按文件内容的SHA-256缓存解析结果，返回 (结果, 是否命中缓存)"""
+    with metadata_cache_lock:
+        result = metadata_cache.get(sha256)
+        if result is not None:
+            metadata_cache.move_to_end(sha256)
+            metadata_cache_stats['hits'] += 1
+            return result, True
+        metadata_cache_stats['misses'] += 1
+    
+    result = read_file_metadata(file_path, audio_format)
+    with metadata_cache_lock:
+        metadata_cache[sha256] = result
+        while len(metadata_cache) > METADATA_CACHE_SIZE:
+            metadata_cache.popitem(last=False)
+    return result, False
+
+def get_tagging_process_pool():
+    """获取打标签用的进程池（首次使用时创建）"""
+    global tagging_process_pool
+    if tagging_process_pool is None:
+        import multiprocessing
+        workers = SERVER_SETTINGS['tagging_workers'] or os.cpu_count() or 1
+        # 使用spawn避免在多线程的服务器进程中fork
+        tagging_process_pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=configure_server,
+            initargs=(dict(SERVER_SETTINGS),)
+        )
+        logger.info(f"打标签进程池已启动，进程数: {workers}")
+    return tagging_process_pool
+
+def _tag_file_in_process(file_path, metadata, audio_format, cover_ref):
+    """在进程池中执行打标签，封面数据从共享内存读取而不是随任务序列化"""
+    if cover_ref:
+        from multiprocessing import shared_memory
+        shm_name, cover_size = cover_ref
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            metadata = dict(metadata, cover_data=bytes(shm.buf[:cover_size]))
+        finally:
+            # 只关闭映射，共享内存由主进程在任务结束后释放
+            shm.close()
+    return add_metadata_to_file(file_path, metadata, audio_format)
+
+def tag_file(file_path, metadata, audio_format=None, job=None):
+    """按配置的后端为文件添加元数据，返回是否成功；所属请求已取消或超时时不再处理"""
+    if SERVER_SETTINGS['tagging_backend'] != 'process':
+        return metadata_executor.submit(run_if_active, job, add_metadata_to_file,
+                                        file_path, metadata, audio_format).result()
+    
+    if not job_active(job):
+        return False
+    
+    shm = None
+    cover_ref = None
+    cover_data = metadata.get('cover_data')
+    try:
+        if cover_data:
+            from multiprocessing import shared_memory
+            shm = shared_memory.SharedMemory(create=True, size=len(cover_data))
+            shm.buf[:len(cover_data)] = cover_data
+            cover_ref = (shm.name, len(cover_data))
+        task_metadata = {key: value for key, value in metadata.items() if key != 'cover_data'}
+        future = get_tagging_process_pool().submit(
+            _tag_file_in_process, file_path, task_metadata, audio_format, cover_ref
+        )
+        return future.result()
+    except Exception as e:
+        logger.error(f"进程池打标签失败: {e}")
+        logger.error(traceback.format_exc())
+        return False
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+# 输出去重：内容寻址的输出文件及其引用计数
+OUTPUT_DIR_NAME = 'outputs'
+METADATA_FIELDS = ('title', 'artist', 'album', 'year', 'lyrics', 'tips')
+output_store = {}   # 指纹 -> {'path', 'sha256', 'filename', 'refs'}
+request_index = {}  # 请求键(来源URL+元数据+封面URL) -> 指纹
+dedup_lock = threading.Lock()
+file_locks = {}  # file_id -> [锁, 等待及持有者数]，用于串行化同一文件注册记录的读改写
+file_locks_lock = threading.Lock()
+
+@contextmanager
+def file_lock(file_id):
+    """同一file_id的注册记录读改写互斥，不同文件互不阻塞；无人使用的锁随即删除"""
+    with file_locks_lock:
+        entry = file_locks.setdefault(file_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with file_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del file_locks[file_id]
+
+def normalize_field(value):
+    """规范化单个元数据字段：统一为去除首尾空白的NFC字符串"""
+    value = '' if value is None else str(value)
+    return unicodedata.normalize('NFC', value.strip())
+
+def normalize_metadata(data):
+    """规范化全部元数据字段"""
+    return {field: normalize_field(data.get(field, '')) for field in METADATA_FIELDS}
+
+def _canonical_hash(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def request_fingerprint_key(data):
+    """根据请求参数计算请求键，用于在下载前直接命中已有输出"""
+    return _canonical_hash({
+        'url': data['url'],
+        'cover_url': data.get('cover_url') or '',
+        'metadata': normalize_metadata(data)
+    })
+
+def output_fingerprint(source_sha256, metadata, cover_data, audio_format):
+    """输出文件的规范指纹：(来源内容哈希, 规范化元数据, 封面哈希, 格式)"""
+    return _canonical_hash({
+        'source': source_sha256,
+        'format': audio_format,
+        'cover': hashlib.sha256(cover_data).hexdigest() if cover_data else '',
+        'metadata': normalize_metadata(metadata)
+    })
+
+def acquire_output(fingerprint):
+    """命中已有输出时增加引用计数并返回其信息，未命中返回None"""
+    with dedup_lock:
+        output = output_store.get(fingerprint)
+        if output is None or not os.path.exists(output['path']):
+            return None
+        output['refs'] += 1
+        return dict(output)
+
+def lookup_request(key):
+    """按请求键查找已有输出"""
+    with dedup_lock:
+        fingerprint = request_index.get(key)
+    return (fingerprint, acquire_output(fingerprint)) if fingerprint else (None, None)
+
+def store_output(fingerprint, file_path, filename, request_key=None):
+    """把处理完成的文件移入内容寻址存储，返回输出信息（引用计数已加1）
+
+    如果同一指纹的输出已经存在（并发请求同时处理了相同内容），丢弃新文件复用已有输出。
+    """
+    output_dir = os.path.join(TEMP_DIR, OUTPUT_DIR_NAME)
+    os.makedirs(output_dir, exist_ok=True)
+    # 新文件尚未被其他请求看到，在锁外计算校验值，避免并发请求排队等待哈希
+    sha256 = file_sha256(file_path)
+    with dedup_lock:
+        if request_key:
+            request_index[request_key] = fingerprint
+        existing = output_store.get(fingerprint)
+        if existing is not None and os.path.exists(existing['path']):
+            existing['refs'] += 1
+            os.remove(file_path)
+            return dict(existing)
+        stored_path = os.path.join(output_dir, f"{fingerprint}{os.path.splitext(filename)[1]}")
+        os.replace(file_path, stored_path)
+        output = {
+            'path': stored_path,
+            'sha256': sha256,
+            'filename': filename,
+            'refs': 1
+        }
+        output_store[fingerprint] = output
+        return dict(output)
+
+def release_output(fingerprint):
+    """释放一个引用，引用计数归零时删除输出文件"""
+    with dedup_lock:
+        output = output_store.get(fingerprint)
+        if output is None:
+            return
+        output['refs'] -= 1
+        if output['refs'] > 0:
+            return
+        del output_store[fingerprint]
+        for key in [k for k, v in request_index.items() if v == fingerprint]:
+            del request_index[key]
+    if os.path.exists(output['path']):
+        os.remove(output['path'])
+    logger.info(f"已删除无引用的输出文件: {output['path']}")
+
+# ---------------- 注册表与输出文件存储后端 ----------------
+# 多个服务器实例共享注册表和存储后，任意实例都能响应任意file_id的下载请求。
+# 注册表的值在各后端中都是独立的副本，修改记录时必须重新赋值，不能原地修改。
+
+NODE_ID = f"{socket.gethostname()}:{os.getpid()}"  # 记录由哪个实例创建，本地文件只由创建者清理
+
+class SQLiteRegistry(MutableMapping):
+    """保存在SQLite数据库中的文件注册表，同一台机器（或共享磁盘）上的多个进程可以共用"""
+
+    def __init__(self, db_path):
+        import sqlite3
+        
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS files (file_id TEXT PRIMARY KEY, info TEXT NOT NULL)')
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def __getitem__(self, file_id):
+        rows = self._query('SELECT info FROM files WHERE file_id = ?', (file_id,))
+        if not rows:
+            raise KeyError(file_id)
+        return json.loads(rows[0][0])
+
+    def __setitem__(self, file_id, info):
+        self._query('INSERT OR REPLACE INTO files (file_id, info) VALUES (?, ?)', (file_id, json.dumps(info)))
+
+    def __delitem__(self, file_id):
+        with self._lock:
+            if self._conn.execute('DELETE FROM files WHERE file_id = ?', (file_id,)).rowcount == 0:
+                raise KeyError(file_id)
+
+    def __iter__(self):
+        return iter([row[0] for row in self._query('SELECT file_id FROM files')])
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM files')[0][0]
+
+    def items(self):
+        return [(file_id, json.loads(info)) for file_id, info in self._query('SELECT file_id, info FROM files')]
+
+def create_s3_client():
+    """按配置创建S3客户端（需要安装boto3），endpoint_url可指向MinIO等兼容服务"""
+    import boto3
+    
+    return boto3.client(
+        's3',
+        endpoint_url=SERVER_SETTINGS['s3_endpoint_url'] or None,
+        region_name=SERVER_SETTINGS['s3_region'] or None,
+        aws_access_key_id=SERVER_SETTINGS['s3_access_key'] or None,
+        aws_secret_access_key=SERVER_SETTINGS['s3_secret_key'] or None
+    )
+
+class S3Registry(MutableMapping):
+    """以JSON对象形式保存在S3兼容存储中的文件注册表，可跨机器共享"""
+
+    def __init__(self, client, bucket, prefix):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = f"{prefix}registry/"
+
+    def __getitem__(self, file_id):
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self.prefix + file_id)['Body']
+        except self.client.exceptions.NoSuchKey:
+            raise KeyError(file_id)
+        with body:
+            return json.loads(body.read())
+
+    def __setitem__(self, file_id, info):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + file_id,
+                               Body=json.dumps(info).encode('utf-8'), ContentType='application/json')
+
+    def __delitem__(self, file_id):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + file_id)
+
+    def __iter__(self):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key'][len(self.prefix):]
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def items(self):
+        # 列举和读取之间记录可能已被其他实例删除
+        result = []
+        for file_id in list(self):
+            info = self.get(file_id)
+            if info is not None:
+                result.append((file_id, info))
+        return result
+
+class LocalBlobStore:
+    """输出文件的本地存储
+
+    未设置blob_dir时文件只保留在本机的TEMP_DIR中（单实例的默认行为）；
+    设置为多个实例都能访问的共享目录时，处理完成的文件会复制到该目录供其他实例读取。
+    """
+
+    def __init__(self, blob_dir=None):
+        self.blob_dir = blob_dir
+        self.shared = bool(blob_dir)
+        if blob_dir:
+            os.makedirs(blob_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.blob_dir, *key.split('/'))
+
+    def put(self, key, file_path):
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(file_path, target + '.part')
+        os.replace(target + '.part', target)
+
+    def open(self, key):
+        return open(self._path(key), 'rb')
+
+    def fetch(self, key, file_path):
+        shutil.copyfile(self._path(key), file_path)
+
+    def delete(self, key):
+        target = self._path(key)
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.rmdir(os.path.dirname(target))
+        except OSError:
+            pass
+
+class S3BlobStore:
+    """保存在S3兼容存储中的输出文件，可跨机器共享"""
+
+    shared = True
+
+    def __init__(self, client, bucket, prefix):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = f"{prefix}files/"
+
+    def put(self, key, file_path):
+        self.client.upload_file(file_path, self.bucket, self.prefix + key)
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body']
+
+    def fetch(self, key, file_path):
+        self.client.download_file(self.bucket, self.prefix + key, file_path)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+def create_storage():
+    """按配置创建 (注册表, 输出文件存储)，后端不可用时退回本地内存和本地文件"""
+    registry_backend = SERVER_SETTINGS['registry_backend']
+    blob_backend = SERVER_SETTINGS['blob_backend']
+    registry, blob_store = {}, LocalBlobStore(SERVER_SETTINGS['blob_dir'] or None)
+    
+    try:
+        s3_client = None
+        if 's3' in (registry_backend, blob_backend):
+            if not SERVER_SETTINGS['s3_bucket']:
+                raise ValueError('未配置s3_bucket')
+            s3_client = create_s3_client()
+        
+        if registry_backend == 'sqlite':
+            registry = SQLiteRegistry(SERVER_SETTINGS['registry_path'] or os.path.join(TEMP_DIR, 'file_registry.sqlite3'))
+        elif registry_backend == 's3':
+            registry = S3Registry(s3_client, SERVER_SETTINGS['s3_bucket'], SERVER_SETTINGS['s3_prefix'])
+        
+        if blob_backend == 's3':
+            blob_store = S3BlobStore(s3_client, SERVER_SETTINGS['s3_bucket'], SERVER_SETTINGS['s3_prefix'])
+    except Exception as e:
+        logger.error(f"初始化存储后端失败，使用本地存储: {e}")
+        return {}, LocalBlobStore(SERVER_SETTINGS['blob_dir'] or None)
+    
+    logger.info(f"注册表: {type(registry).__name__}, 文件存储: {type(blob_store).__name__}")
+    return registry, blob_store
+
+def publish_output(file_id, file_info):
+    """共享存储可用时上传输出文件，返回带blob_key的新记录"""
+    if not blob_store.shared:
+        return file_info
+    # 键中带内容哈希：修改元数据后上传到新键，不会覆盖其他实例正在转发的旧版本
+    blob_key = f"{file_id}/{file_info['sha256'][:16]}_{file_info['filename']}"
+    blob_store.put(blob_key, file_info['path'])
+    return dict(file_info, blob_key=blob_key)
+
+def fetch_output(file_info, file_path):
+    """把输出文件的副本取回到file_path（优先从共享存储），文件不存在时返回False"""
+    if file_info.get('blob_key'):
+        blob_store.fetch(file_info['blob_key'], file_path)
+        return True
+    if os.path.exists(file_info['path']):
+        shutil.copyfile(file_info['path'], file_path)
+        return True
+    return False
+
+blob_store = LocalBlobStore()  # 由init_app按配置替换
+local_outputs = {}  # 本实例登记的 file_id -> (指纹, 本地路径)，清理时据此释放本地文件
+
+# ---------------- 下载租约与访问统计 ----------------
+# 每个正在进行的下载持有一个租约，租约释放前清理线程不会删除对应的文件。
+download_leases = {}  # 本地文件路径或共享存储键 -> 正在进行的下载数
+file_access = {}      # file_id -> {'downloads': 尚未写入注册表的下载次数, 'last_access': 最后下载时间}
+retired_outputs = []  # 修改元数据时被替换、但仍在被下载的旧文件: (指纹, 路径)
+retired_blobs = []    # 修改元数据时被替换、但仍在被下载的共享存储键
+lease_lock = threading.Lock()
+
+def acquire_lease(resource):
+    with lease_lock:
+        download_leases[resource] = download_leases.get(resource, 0) + 1
+
+def release_lease(resource):
+    with lease_lock:
+        count = download_leases.get(resource, 0) - 1
+        if count > 0:
+            download_leases[resource] = count
+        else:
+            download_leases.pop(resource, None)
+
+def is_leased(resource):
+    with lease_lock:
+        return resource in download_leases
+
+def record_access(file_id):
+    """记录一次下载，累计的次数由清理线程批量写入注册表"""
+    with lease_lock:
+        access = file_access.setdefault(file_id, {'downloads': 0, 'last_access': 0})
+        access['downloads'] += 1
+        access['last_access'] = time.time()
+
+def retire_output(fingerprint, path):
+    """旧文件仍在被下载，等租约全部释放后再由清理线程释放"""
+    with lease_lock:
+        retired_outputs.append((fingerprint, path))
+
+def release_replaced_output(old_info, new_info):
+    """释放被修改元数据替换掉的旧文件和旧共享存储键，仍在被下载的交给清理线程"""
+    if old_info.get('node', NODE_ID) == NODE_ID and old_info['path'] != new_info['path']:
+        if is_leased(old_info['path']):
+            retire_output(old_info.get('fingerprint'), old_info['path'])
+        else:
+            release_job_output(old_info.get('fingerprint'), old_info)
+    blob_key = old_info.get('blob_key')
+    if blob_key and blob_key != new_info.get('blob_key'):
+        if is_leased(blob_key):
+            with lease_lock:
+                retired_blobs.append(blob_key)
+        else:
+            blob_store.delete(blob_key)
+
+def flush_file_access():
+    """把本实例累计的下载次数和最后下载时间写入注册表，各实例据此按同一策略判断热门文件"""
+    with lease_lock:
+        pending = dict(file_access)
+        file_access.clear()
+    for file_id, access in pending.items():
+        # 与修改元数据串行，避免覆盖其写入的记录
+        with file_lock(file_id):
+            file_info = file_registry.get(file_id)
+            if file_info is None:
+                continue
+            file_registry[file_id] = dict(
+                file_info,
+                downloads=file_info.get('downloads', 0) + access['downloads'],
+                last_access=max(file_info.get('last_access', 0), access['last_access'])
+            )
+
+def file_expires_at(file_info):
+    """注册记录的过期时间：热门文件从最后一次下载起保留hot_file_ttl，其余文件从创建起保留FILE_CLEANUP_TIME"""
+    hot_downloads = SERVER_SETTINGS['hot_file_downloads']
+    if hot_downloads > 0 and file_info.get('downloads', 0) >= hot_downloads:
+        last_active = max(file_info['created_time'], file_info.get('last_access', 0))
+        return max(last_active + SERVER_SETTINGS['hot_file_ttl'], file_info['created_time'] + FILE_CLEANUP_TIME)
+    return file_info['created_time'] + FILE_CLEANUP_TIME
+
+def lease_stats():
+    with lease_lock:
+        return {'active': sum(download_leases.values()), 'retired': len(retired_outputs)}
+
+def cleanup_old_files():
+    """清理旧文件"""
+    while True:
+        time.sleep(60)
+        if is_shutting_down:
+            break
+        cleanup_expired_files()
+
+def cleanup_expired_files():
+    """清理一次过期的注册记录和本实例的本地文件"""
+    current_time = time.time()
+    files_to_delete = []
+    
+    try:
+        flush_file_access()
+        registry_items = list(file_registry.items())
+    except Exception as e:
+        logger.error(f"读取注册表失败: {e}")
+        return
+    
+    live_entries = {}
+    for file_id, file_info in registry_items:
+        # 其他实例创建的记录由创建者清理；创建者下线后，再过一个过期时间由任意实例清理
+        is_local = file_info.get('node', NODE_ID) == NODE_ID
+        expires_at = file_expires_at(file_info) + (0 if is_local else FILE_CLEANUP_TIME)
+        # 正在被下载的文件推迟到下载结束后再清理
+        leased = is_leased(file_info['path']) or is_leased(file_info.get('blob_key'))
+        if current_time > expires_at and not leased:
+            files_to_delete.append((file_id, file_info))
+        else:
+            live_entries[file_id] = file_info
+    
+    for file_id, file_info in files_to_delete:
+        try:
+            if file_info.get('blob_key'):
+                blob_store.delete(file_info['blob_key'])
+            del file_registry[file_id]
+            logger.info(f"已清理文件: {file_info['path']}")
+        except Exception as e:
+            logger.error(f"清理文件失败: {e}")
+    
+    cleanup_url_caches()
+    
+    # 释放本实例不再被注册表引用的本地文件（已过期，或已被其他实例接管），正在被下载的除外
+    for file_id, (fingerprint, path) in list(local_outputs.items()):
+        file_info = live_entries.get(file_id)
+        if file_info is not None and file_info.get('node', NODE_ID) == NODE_ID and file_info['path'] == path:
+            continue
+        if is_leased(path):
+            continue
+        try:
+            # 共享的输出文件只释放引用，最后一个引用释放时才删除
+            release_job_output(fingerprint, {'path': path})
+            local_outputs.pop(file_id, None)
+        except Exception as e:
+            logger.error(f"清理文件失败: {e}")
+    
+    cleanup_idempotency_records(live_entries)
+    
+    # 修改元数据时被替换的旧文件，下载全部结束后释放
+    with lease_lock:
+        released = [item for item in retired_outputs if item[1] not in download_leases]
+        retired_outputs[:] = [item for item in retired_outputs if item[1] in download_leases]
+        released_blobs = [key for key in retired_blobs if key not in download_leases]
+        retired_blobs[:] = [key for key in retired_blobs if key in download_leases]
+    for fingerprint, path in released:
+        try:
+            release_job_output(fingerprint, {'path': path})
+        except Exception as e:
+            logger.error(f"清理文件失败: {e}")
+    for blob_key in released_blobs:
+        try:
+            blob_store.delete(blob_key)
+        except Exception as e:
+            logger.error(f"清理文件失败: {e}")
+
+class ProcessingError(Exception):
+    """处理任务失败，status 为对应的HTTP状态码"""
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.status = status
+
+# /process-music 请求体的字段定义: 字段名 -> (是否必需, 允许的类型)
+JOB_FIELDS = {
+    'url': (True, (str,)),
+    'title': (True, (str, int, float)),
+    'artist': (False, (str, int, float)),
+    'album': (False, (str, int, float)),
+    'year': (False, (str, int)),
+    'lyrics': (False, (str,)),
+    'tips': (False, (str,)),
+    'cover_url': (False, (str,)),
+    'timeout': (False, (int, float)),  # 请求总时限（秒），也可以通过请求头X-Request-Timeout指定
+    'mirrors': (False, (list,)),       # 提供相同内容的镜像地址，分块下载时一起使用
+}
+
+MAX_MIRRORS = 8
+
+CONTROL_CHARS_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')  # 保留\t, \n, \r
+
+def sanitize_text(value):
+    """清理字符串中的无效控制字符，非字符串原样返回"""
+    if isinstance(value, str):
+        return CONTROL_CHARS_RE.sub('', value)
+    return value
+
+# 上传模式下音频来自请求体，url可省略，filename用于推断原始文件名
+UPLOAD_JOB_FIELDS = dict(JOB_FIELDS, url=(False, (str,)), filename=(False, (str,)))
+
+def form_field_value(field, value):
+    """表单字段和查询参数总是字符串，只接受数字的字段（如timeout）在校验前转换为数字"""
+    types = UPLOAD_JOB_FIELDS.get(field, (False, ()))[1]
+    if isinstance(value, str) and str not in types and float in types:
+        try:
+            return float(value)
+        except ValueError:
+            pass  # 保留原值，由validate_job_data报告类型无效
+    return value
+
+def safe_filename(name):
+    """去掉路径和文件名中不允许的字符"""
+    name = os.path.basename(str(name).replace('\\', '/'))
+    return re.sub(r'[\\/:*?"<>|\x00-\x1f]', '_', name).strip(' .')
+
+def field_type_valid(field, value, fields=JOB_FIELDS):
+    """字段值的类型是否符合字段定义（布尔值不算数字）"""
+    return not isinstance(value, bool) and isinstance(value, fields[field][1])
+
+def validate_job_data(data, fields=JOB_FIELDS):
+    """一次遍历完成字段校验和字符串清理，返回清理后的任务参数，无效时抛出ProcessingError"""
+    if not isinstance(data, dict):
+        raise ProcessingError('无效的JSON数据', 400)
+    
+    cleaned = dict(data)
+    for field, (required, types) in fields.items():
+        value = data.get(field)
+        if value is None:
+            if required:
+                raise ProcessingError(f'缺少必需字段: {field}', 400)
+            continue
+        if not field_type_valid(field, value, fields):
+            raise ProcessingError(f'字段类型无效: {field}', 400)
+        cleaned[field] = sanitize_text(value)
+    
+    if cleaned.get('url') is not None and urlparse(cleaned['url']).scheme not in ('http', 'https'):
+        raise ProcessingError('无效的音乐文件URL', 400)
+    if cleaned.get('timeout') is not None and not cleaned['timeout'] > 0:
+        raise ProcessingError('无效的超时时间: timeout', 400)
+    mirrors = cleaned.get('mirrors')
+    if mirrors is not None:
+        if len(mirrors) > MAX_MIRRORS or not all(
+                isinstance(mirror, str) and urlparse(mirror).scheme in ('http', 'https') for mirror in mirrors):
+            raise ProcessingError('无效的镜像地址: mirrors', 400)
+        cleaned['mirrors'] = [mirror for mirror in dict.fromkeys(mirrors) if mirror != cleaned.get('url')]
+    return cleaned
+
+def request_job(file_id):
+    """为当前HTTP请求创建任务：请求头X-Request-Timeout（秒）限定总时限，并关联客户端连接用于断开检测"""
+    job = DownloadJob(file_id)
+    header = request.headers.get('X-Request-Timeout')
+    if header:
+        try:
+            timeout = float(header)
+        except ValueError:
+            timeout = 0
+        if not timeout > 0:
+            raise ProcessingError('无效的超时时间: X-Request-Timeout', 400)
+        job.set_timeout(timeout)
+    # 只有werkzeug服务器提供底层连接，其它WSGI服务器下不做断开检测
+    job.client_socket = request.environ.get('werkzeug.socket')
+    return job
+
+def register_output(file_id, fingerprint, output):
+    """在文件注册表中登记处理好的文件（配置了共享存储时先上传）"""
+    local_outputs[file_id] = (fingerprint, output['path'])
+    file_registry[file_id] = publish_output(file_id, {
+        'path': output['path'],
+        'filename': output['filename'],
+        'created_time': time.time(),
+        'sha256': output['sha256'],
+        'source_sha256': output.get('source_sha256'),
+        'fingerprint': fingerprint,
+        'node': NODE_ID
+    })
+
+def output_response_body(file_id, output, deduplicated=False):
+    """/process-music处理成功时的响应内容"""
+    return {
+        'success': True,
+        'download_url': f"http://{request.host}/download/{file_id}",
+        'file_id': file_id,
+        'sha256': output['sha256'],
+        'deduplicated': deduplicated,
+        'message': '文件处理成功'
+    }
+
+def register_output_response(file_id, fingerprint, output, deduplicated=False):
+    """注册处理好的文件并返回/process-music的响应"""
+    register_output(file_id, fingerprint, output)
+    return jsonify(output_response_body(file_id, output, deduplicated))
+
+def run_music_job(data, file_id, job=None):
+    """下载音频、写入元数据，返回 (fingerprint, output, deduplicated)
+    
+    HTTP接口和命令行批处理共用此流程，失败时抛出ProcessingError。
+    job携带请求的时限和客户端连接，下载、封面和打标签各步骤都会检查它。
+    """
+    data = validate_job_data(data)
+    download_job = job or DownloadJob(file_id)
+    download_job.set_timeout(data.get('timeout'))
+    
+    # 下载音频的同时预热封面主机的连接
+    if SERVER_SETTINGS['upstream_warmup'] and data.get('cover_url'):
+        download_executor.submit(upstream_client.warm_up, data['cover_url'])
+    
+    # 相同来源、元数据和封面的请求直接复用已处理的文件，无需下载和打标签
+    request_key = request_fingerprint_key(data) if SERVER_SETTINGS['output_dedup'] else None
+    if request_key:
+        fingerprint, output = lookup_request(request_key)
+        if output is not None:
+            logger.info(f"命中已处理的输出: {fingerprint}")
+            return fingerprint, output, True
+    
+    url_path = urlparse(data['url']).path
+    original_filename = os.path.basename(url_path) or "audio"
+    
+    # 文件路径
+    temp_file_path = os.path.join(TEMP_DIR, f"{file_id}_{original_filename}")
+    
+    # 下载原始文件（使用多线程优化，下载的同时校验长度和MD5，并根据文件头识别格式）
+    # 已预取的来源文件直接从缓存复制，只需要打标签
+    cached_source = source_cache_lookup(data['url'])
+    if cached_source is not None:
+        logger.info(f"命中来源缓存: {data['url']}")
+        shutil.copyfile(cached_source['path'], temp_file_path)
+        download_job.audio_format = cached_source['audio_format']
+        download_job.source_sha256 = cached_source['sha256']
+    elif not download_file(data['url'], temp_file_path, download_job, mirrors=data.get('mirrors') or ()):
+        raise ProcessingError(*download_failure(download_job))
+    
+    # 以文件头识别的格式为准，修正输出文件的扩展名
+    audio_format = download_job.audio_format or format_from_extension(original_filename)
+    original_filename = filename_for_format(original_filename, audio_format)
+    processed_file_path = os.path.join(TEMP_DIR, f"processed_{file_id}_{original_filename}")
+    
+    # 检查文件是否存在且大小合理
+    if not os.path.exists(temp_file_path) or os.path.getsize(temp_file_path) == 0:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise ProcessingError('下载的文件无效')
+    
+    return tag_source_file(data, temp_file_path, processed_file_path, original_filename,
+                           audio_format, download_job.source_sha256, request_key, download_job)
+
+def tag_source_file(data, temp_file_path, processed_file_path, original_filename,
+                    audio_format, source_sha256, request_key=None, job=None, cover_future=None):
+    """为已经落盘的源文件写入元数据，返回 (fingerprint, output, deduplicated)
+    
+    下载和上传两种来源共用此流程；源文件会被移动到processed_file_path或在复用已有输出时删除。
+    cover_future为已经开始的封面下载，没有时在这里开始下载。
+    """
+    # 并行下载封面和处理元数据
+    if cover_future is None:
+        cover_future = download_executor.submit(download_cover, data.get('cover_url'), job)
+    
+    # 等待封面下载完成
+    cover_data = cover_future.result()
+    if not job_active(job):
+        os.remove(temp_file_path)
+        raise ProcessingError(*download_failure(job))
+    
+    # 准备元数据（与去重指纹使用同一份规范化结果）
+    metadata = normalize_metadata(data)
+    metadata['cover_data'] = cover_data
+    
+    # 来源内容相同（例如不同URL指向同一文件）时复用已有输出
+    fingerprint = None
+    if SERVER_SETTINGS['output_dedup'] and source_sha256:
+        fingerprint = output_fingerprint(source_sha256, metadata, cover_data, audio_format)
+        output = acquire_output(fingerprint)
+        if output is not None:
+            os.remove(temp_file_path)
+            if request_key:
+                with dedup_lock:
+                    request_index[request_key] = fingerprint
+            logger.info(f"来源内容与已处理的输出相同: {fingerprint}")
+            return fingerprint, output, True
+    
+    # 移动文件到新路径（同一目录下重命名，无需再复制一遍数据）
+    os.replace(temp_file_path, processed_file_path)
+    
+    # 使用线程池或进程池处理元数据，等待处理完成
+    if not tag_file(processed_file_path, metadata, audio_format, job):
+        if os.path.exists(processed_file_path):
+            os.remove(processed_file_path)
+        if not job_active(job):
+            raise ProcessingError(*download_failure(job))
+        raise ProcessingError('添加元数据失败，可能是不支持的文件格式')
+    
+    if fingerprint:
+        # 存入内容寻址存储，供后续相同请求共享
+        output = store_output(fingerprint, processed_file_path, original_filename, request_key)
+    else:
+        output = {
+            'path': processed_file_path,
+            'sha256': file_sha256(processed_file_path),  # 输出文件的校验值，供客户端核对
+            'filename': original_filename
+        }
+    output['source_sha256'] = source_sha256
+    return fingerprint, output, False
+
+def release_job_output(fingerprint, output):
+    """释放任务产生的输出文件（共享文件只释放引用）"""
+    if fingerprint:
+        release_output(fingerprint)
+    elif os.path.exists(output['path']):
+        os.remove(output['path'])
+
+# ---------------- 预取 ----------------
+PREFETCH_IDLE_WAIT = 30  # 有前台下载时，预取任务最多等待的秒数
+PREFETCH_BATCH_LIMIT = 100  # 最多保留的已完成批次记录数
+prefetch_batches = {}    # 批次ID -> 进度
+prefetch_lock = threading.Lock()
+
+def prefetch_source(url, cover_url=None):
+    """以低优先级把来源文件和封面下载到缓存，返回 'cached' 或 'downloaded'，失败时抛出ProcessingError"""
+    if cover_url:
+        download_cover(cover_url)
+    if source_cache_lookup(url) is not None:
+        return 'cached'
+    
+    # 有前台请求正在下载时先让出带宽
+    deadline = time.monotonic() + PREFETCH_IDLE_WAIT
+    while bandwidth_limiter.foreground_jobs() and time.monotonic() < deadline and not is_shutting_down:
+        time.sleep(0.2)
+    
+    job = DownloadJob(weight=SERVER_SETTINGS['prefetch_weight'], background=True)
+    temp_file_path = os.path.join(TEMP_DIR, f"prefetch_{job.job_id}")
+    try:
+        if not download_file(url, temp_file_path, job, num_threads=SERVER_SETTINGS['prefetch_threads']):
+            raise ProcessingError(*download_failure(job))
+        source_cache_store(url, temp_file_path, job)
+        return 'downloaded'
+    finally:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+
+def _run_prefetch_item(batch_id, index):
+    with prefetch_lock:
+        batch = prefetch_batches.get(batch_id)
+        if batch is None:
+            logger.warning(f"预取批次记录已不存在，跳过: {batch_id}")
+            return
+        item = batch['items'][index]
+        item['status'] = 'running'
+        batch['running'] += 1
+    
+    error = None
+    try:
+        status = prefetch_source(item['url'], item.get('cover_url'))
+    except ProcessingError as e:
+        status, error = 'failed', str(e)
+    except Exception as e:
+        logger.error(f"预取时发生错误: {e}")
+        status, error = 'failed', str(e)
+    
+    with prefetch_lock:
+        item['status'] = status
+        if error:
+            item['error'] = error
+        batch['running'] -= 1
+        batch['failed' if error else 'completed'] += 1
+        if batch['completed'] + batch['failed'] == batch['total']:
+            batch['finished_time'] = time.time()
+    if error:
+        logger.error(f"预取失败: {item['url']}: {error}")
+    else:
+        logger.info(f"预取完成: {item['url']} ({status})")
+
+def parse_prefetch_items(items):
+    """把URL字符串或 {url, cover_url} 对象列表规范化，无效时抛出ProcessingError"""
+    if not isinstance(items, list) or not items:
+        raise ProcessingError('缺少必需字段: items', 400)
+    parsed = []
+    for entry in items:
+        if isinstance(entry, str):
+            entry = {'url': entry}
+        if not isinstance(entry, dict) or not isinstance(entry.get('url'), str) \
+                or urlparse(entry['url']).scheme not in ('http', 'https'):
+            raise ProcessingError(f'无效的预取项: {entry}', 400)
+        cover_url = entry.get('cover_url')
+        parsed.append({'url': entry['url'], 'cover_url': cover_url if isinstance(cover_url, str) else None,
+                       'status': 'queued'})
+    return parsed
+
+def start_prefetch(items):
+    """提交一批预取任务，返回批次ID"""
+    batch_id = str(uuid.uuid4())
+    with prefetch_lock:
+        prefetch_batches[batch_id] = {
+            'batch_id': batch_id,
+            'items': items,
+            'total': len(items),
+            'running': 0,
+            'completed': 0,
+            'failed': 0,
+            'created_time': time.time(),
+            'finished_time': None
+        }
+        # 只保留最近的批次记录，仍有排队或运行中任务的批次不删除
+        finished = sorted((k for k, batch in prefetch_batches.items() if batch['finished_time'] is not None),
+                          key=lambda k: prefetch_batches[k]['created_time'])
+        for old_id in finished[:max(0, len(prefetch_batches) - PREFETCH_BATCH_LIMIT)]:
+            del prefetch_batches[old_id]
+    for index in range(len(items)):
+        prefetch_executor.submit(_run_prefetch_item, batch_id, index)
+    logger.info(f"已提交预取批次 {batch_id}: {len(items)} 项")
+    return batch_id
+
+def prefetch_progress(batch_id):
+    """返回批次进度的快照，批次不存在时返回None"""
+    with prefetch_lock:
+        batch = prefetch_batches.get(batch_id)
+        if batch is None:
+            return None
+        return dict(batch, items=[dict(item) for item in batch['items']])
+
+ID3V1_SIZE = 128  # 文件末尾ID3v1标签的固定长度
+
+def attachment_headers(filename):
+    """生成Content-Disposition响应头，非ASCII文件名按RFC 5987编码"""
+    from urllib.parse import quote
+    
+    try:
+        filename.encode('ascii')
+        return {'Content-Disposition': f'attachment; filename="{filename}"'}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        return {'Content-Disposition': f"attachment; filename=\"{simple}\"; filename*=UTF-8''{quote(filename)}"}
+
+def send_output_once(fingerprint, output):
+    """直接返回处理好的文件，响应结束后释放输出（不登记到文件注册表）"""
+    response = send_file(
+        output['path'],
+        as_attachment=True,
+        download_name=f"processed_{output['filename']}"
+    )
+    response.headers['X-Content-SHA256'] = output['sha256']
+    # send_file的响应直接透传文件，不会调用call_on_close注册的回调，改为包装响应体
+    response.response = ClosingIterator(response.response, lambda: release_job_output(fingerprint, output))
+    return response
+
+def stream_tagged_mp3(response, chunks, tag_header, job):
+    """先输出新的ID3标签，再边下载边输出上游音频（跳过原有的ID3v2/ID3v1标签）
+
+    末尾的128字节一直保留到下载完成，用于判断是否为ID3v1标签；
+    长度或MD5校验失败时不输出最后一块并中断连接，客户端不会收到完整的文件。
+    """
+    md5 = hashlib.md5() if expected_md5(response.headers) else None
+    to_skip = None
+    pending = b''
+    total = 0
+    try:
+        yield tag_header
+        for chunk in chunks:
+            job.ensure_active()
+            if not chunk:
+                continue
+            bandwidth_limiter.consume(job, len(chunk))
+            total += len(chunk)
+            if md5 is not None:
+                md5.update(chunk)
+            if to_skip is None:
+                to_skip = id3v2_tag_size(chunk)
+            if to_skip:
+                skipped = min(to_skip, len(chunk))
+                chunk = chunk[skipped:]
+                to_skip -= skipped
+            if len(chunk) >= ID3V1_SIZE:
+                if pending:
+                    yield pending
+                yield chunk[:-ID3V1_SIZE]
+                pending = chunk[-ID3V1_SIZE:]
+            else:
+                pending += chunk
+                if len(pending) > ID3V1_SIZE:
+                    yield pending[:-ID3V1_SIZE]
+                    pending = pending[-ID3V1_SIZE:]
+        
+        verify_download(response.headers, total, md5)
+        if not (len(pending) == ID3V1_SIZE and pending.startswith(b'TAG')):
+            yield pending
+        logger.info(f"流式返回完成: {job.job_id}, 上游 {total} bytes")
+    except GeneratorExit:
+        logger.warning(f"客户端在传输完成前断开连接: {job.job_id}")
+        raise
+    except Exception as e:
+        logger.error(f"流式返回失败: {e}")
+        raise
+    finally:
+        response.close()
+        bandwidth_limiter.unregister(job)
+
+def tag_streamed_source(data, job, response, chunks, audio_format, cover_future, request_key):
+    """把已经打开的上游响应读完落盘后打标签，非MP3格式无需再向上游请求一次"""
+    original_filename = filename_for_format(os.path.basename(urlparse(data['url']).path) or "audio", audio_format)
+    temp_file_path = os.path.join(TEMP_DIR, f"{job.job_id}_{original_filename}")
+    processed_file_path = os.path.join(TEMP_DIR, f"processed_{job.job_id}_{original_filename}")
+    sha256, md5 = new_hashers(response.headers)
+    hashers = [h for h in (sha256, md5) if h is not None]
+    try:
+        with open(temp_file_path, 'wb') as f:
+            bytes_written = write_chunks_to_file(chunks, f, job, hashers)
+        verify_download(response.headers, bytes_written, md5)
+    except Exception as e:
+        logger.error(f"流式下载失败: {e}")
+        job.error = e
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise ProcessingError(*download_failure(job))
+    finally:
+        response.close()
+        bandwidth_limiter.unregister(job)
+    
+    job.audio_format = audio_format
+    job.source_sha256 = sha256.hexdigest()
+    return tag_source_file(data, temp_file_path, processed_file_path, original_filename,
+                           audio_format, job.source_sha256, request_key, job, cover_future)
+
+def process_music_inline(data, job):
+    """处理音乐并在同一个响应中返回文件内容，不登记也不保留文件
+
+    MP3在封面下载完成后立即发送标签，音频边下载边转发；
+    其他格式的标签位置需要完整文件，沿用同一个上游响应读完后处理再返回，响应结束后删除。
+    """
+    data = validate_job_data(data)
+    job.set_timeout(data.get('timeout'))
+    
+    request_key = request_fingerprint_key(data) if SERVER_SETTINGS['output_dedup'] else None
+    if request_key:
+        fingerprint, output = lookup_request(request_key)
+        if output is not None:
+            logger.info(f"命中已处理的输出: {fingerprint}")
+            return send_output_once(fingerprint, output)
+    
+    # 来源文件已预取时无需再从上游转发
+    if source_cache_lookup(data['url']) is not None:
+        fingerprint, output, _ = run_music_job(data, job.job_id, job)
+        return send_output_once(fingerprint, output)
+    
+    # 封面与音频同时开始下载，封面到达后才能发送标签
+    cover_future = download_executor.submit(download_cover, data.get('cover_url'), job)
+    
+    headers = dict(DEFAULT_HEADERS, **{'Accept-Encoding': 'identity'})
+    bandwidth_limiter.register(job)
+    response = None
+    try:
+        response = upstream_client.get(data['url'], stream=True, headers=headers, timeout=60,
+                                       deadline=job.deadline)
+        response.raise_for_status()
+        job.set_size(int(response.headers.get('content-length', 0) or 0))
+        chunk_size = THROTTLED_READ_SIZE if bandwidth_limiter.rate > 0 else SERVER_SETTINGS['io_buffer_size']
+        chunks = response.iter_content(chunk_size=chunk_size)
+        head = next(chunks, b'')
+        audio_format = sniff_audio_format(head)
+    except Exception as e:
+        if response is not None:
+            response.close()
+        bandwidth_limiter.unregister(job)
+        logger.error(f"流式下载失败: {e}")
+        job.error = e
+        raise ProcessingError(*download_failure(job))
+    
+    if audio_format is None:
+        response.close()
+        bandwidth_limiter.unregister(job)
+        raise ProcessingError('不支持的音频格式', 415)
+    if audio_format != 'mp3':
+        fingerprint, output, _ = tag_streamed_source(data, job, response, itertools.chain([head], chunks),
+                                                     audio_format, cover_future, request_key)
+        return send_output_once(fingerprint, output)
+    
+    metadata = normalize_metadata(data)
+    metadata['cover_data'] = cover_future.result()
+    if not job_active(job):
+        response.close()
+        bandwidth_limiter.unregister(job)
+        raise ProcessingError(*download_failure(job))
+    try:
+        tag_header = render_id3_tag(metadata)
+    except Exception as e:
+        response.close()
+        bandwidth_limiter.unregister(job)
+        logger.error(f"生成ID3标签失败: {e}")
+        raise ProcessingError('添加元数据失败，可能是不支持的文件格式')
+    
+    url_path = urlparse(data['url']).path
+    filename = filename_for_format(os.path.basename(url_path) or "audio", 'mp3')
+    logger.info(f"开始流式返回: {filename}")
+    return Response(
+        stream_tagged_mp3(response, itertools.chain([head], chunks), tag_header, job),
+        mimetype='audio/mpeg',
+        headers=attachment_headers(f"processed_{filename}")
+    )
+
+# ---------------- 幂等键 ----------------
+# 客户端重试时带上相同的Idempotency-Key：原请求仍在处理时等待其结果，已完成时直接返回原结果。
+# 成功的结果保留到对应文件过期为止；失败的结果不保留，之后的重试会重新处理。
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+idempotency_records = {}  # 幂等键 -> {'request_hash', 'done', 'file_id', 'result'}
+idempotency_lock = threading.Lock()
+
+def begin_idempotent_request(key, request_hash):
+    """查找或登记幂等键，返回 (记录, 是否由本请求处理)"""
+    while True:
+        with idempotency_lock:
+            record = idempotency_records.get(key)
+            if record is None:
+                record = {'request_hash': request_hash, 'done': threading.Event(), 'file_id': None, 'result': None}
+                idempotency_records[key] = record
+                return record, True
+        # 结果对应的文件已过期时视为新请求
+        if record['done'].is_set() and record['file_id'] and file_registry.get(record['file_id']) is None:
+            with idempotency_lock:
+                if idempotency_records.get(key) is record:
+                    del idempotency_records[key]
+            continue
+        return record, False
+
+def process_music_idempotent(key, data, file_id, job):
+    """按幂等键处理/process-music请求"""
+    if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise ProcessingError('无效的Idempotency-Key', 400)
+    
+    record, owner = begin_idempotent_request(key, hashlib.sha256(request.get_data()).hexdigest())
+    if not owner:
+        if record['request_hash'] != hashlib.sha256(request.get_data()).hexdigest():
+            raise ProcessingError('Idempotency-Key已用于内容不同的请求', 422)
+        
+        # 等待原请求完成，期间客户端断开或超时则放弃等待
+        logger.info(f"重试请求等待原任务完成: {key}")
+        while not record['done'].wait(CLIENT_CHECK_INTERVAL):
+            if not job_active(job):
+                if isinstance(job.error, DeadlineExceeded):
+                    response = jsonify({'error': '相同Idempotency-Key的请求仍在处理中'})
+                    response.headers['Retry-After'] = '5'
+                    return response, 409
+                raise ProcessingError(*download_failure(job))
+        
+        status, body = record['result']
+        if record['file_id']:
+            body = dict(body, download_url=f"http://{request.host}/download/{record['file_id']}")
+        response = jsonify(body)
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response, status
+    
+    try:
+        fingerprint, output, deduplicated = run_music_job(data, file_id, job)
+        register_output(file_id, fingerprint, output)
+        body = output_response_body(file_id, output, deduplicated)
+        record['file_id'] = file_id
+        record['result'] = (200, body)
+        return jsonify(body)
+    except Exception as e:
+        status = e.status if isinstance(e, ProcessingError) else 500
+        message = str(e) if isinstance(e, ProcessingError) else f'服务器内部错误: {str(e)}'
+        record['result'] = (status, {'error': message})
+        with idempotency_lock:
+            if idempotency_records.get(key) is record:
+                del idempotency_records[key]
+        raise
+    finally:
+        record['done'].set()
+
+def cleanup_idempotency_records(live_file_ids):
+    """删除结果文件已过期的幂等记录"""
+    with idempotency_lock:
+        for key in [key for key, record in idempotency_records.items()
+                    if record['done'].is_set() and record['file_id'] not in live_file_ids]:
+            del idempotency_records[key]
+
+@app.route('/process-music', methods=['POST', 'OPTIONS'])
+def process_music():
+    """处理音乐文件"""
+    if is_shutting_down:
+        return jsonify({'error': '服务器正在关闭'}), 503
+        
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'})
+    
+    try:
+        # 安全解析JSON数据
         try:
-            raw_data = request.get_data(as_text=True)
-            data = safe_json_parse(raw_data)
+            data = safe_json_parse(request.get_data())
         except Exception as e:
             logger.error(f"JSON解析失败: {e}")
             return jsonify({'error': '无效的JSON数据格式'}), 400
         
-        logger.info(f"收到请求: {data.get('title', '未知标题')}")
+        if isinstance(data, dict):
+            logger.info(f"收到请求: {data.get('title', '未知标题')}")
         
-        if not data:
-            return jsonify({'error': '无效的JSON数据'}), 400
+        # 生成唯一文件ID，任务携带请求的时限和客户端连接
+        file_id = str(uuid.uuid4())
+        job = request_job(file_id)
         
-        # 验证必需参数
-        required_fields = ['url', 'title']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({'error': f'缺少必需字段: {field}'}), 400
+        # inline=1 时在本次响应中直接返回文件内容
+        if request.args.get('inline', '').lower() in ('1', 'true', 'yes'):
+            return process_music_inline(data, job)
         
-        # 生成唯一文件ID
-        file_id = str(uuid.uuid4())
-        url_path = urlparse(data['url']).path
-        original_filename = os.path.basename(url_path) or "audio.mp3"
+        # 带Idempotency-Key的重试复用原请求的结果
+        idempotency_key = request.headers.get('Idempotency-Key', '').strip()
+        if idempotency_key:
+            return process_music_idempotent(idempotency_key, data, file_id, job)
         
-        # 文件路径
-        temp_file_path = os.path.join(TEMP_DIR, f"{file_id}_{original_filename}")
-        processed_file_path = os.path.join(TEMP_DIR, f"processed_{file_id}_{original_filename}")
+        fingerprint, output, deduplicated = run_music_job(data, file_id, job)
+        return register_output_response(file_id, fingerprint, output, deduplicated)
+    
+    except ProcessingError as e:
+        return jsonify({'error': str(e)}), e.status
+    
+    except Exception as e:
+        logger.error(f"处理请求时发生错误: {e}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': f'服务器内部错误: {str(e)}'}), 500
+
+class UploadSpool:
+    """上传内容的暂存区：小于阈值时留在内存中，超过阈值后直接写入处理文件，不经过额外的临时文件
+
+    写入时顺带计算SHA-256并保留文件开头用于识别格式。
+    """
+
+    def __init__(self, file_path, threshold):
+        self.file_path = file_path
+        self.threshold = threshold
+        self.size = 0
+        self.head = b''
+        self.sha256 = hashlib.sha256()
+        self._buffer = io.BytesIO()
+        self._file = None
+
+    def write(self, data):
+        self.sha256.update(data)
+        if len(self.head) < SNIFF_SIZE:
+            self.head += bytes(data[:SNIFF_SIZE - len(self.head)])
+        self.size += len(data)
+        if self._file is not None:
+            return self._file.write(data)
+        self._buffer.write(data)
+        if self._buffer.tell() > self.threshold:
+            # 超过阈值，把已缓存的内容写入处理文件，之后直接写文件
+            self._file = open(self.file_path, 'wb')
+            self._file.write(self._buffer.getbuffer())
+            self._buffer = None
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        # 表单解析结束时会把游标移回开头，内容由finish()写出，这里无需处理
+        return 0
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def finish(self):
+        """把内容完整写入处理文件并关闭"""
+        if self._file is None:
+            with open(self.file_path, 'wb') as f:
+                f.write(self._buffer.getbuffer())
+            self._buffer = None
+        else:
+            self._file.close()
+
+    def discard(self):
+        """丢弃已接收的内容"""
+        if self._file is not None:
+            self._file.close()
+        self._buffer = None
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+def receive_upload(file_id):
+    """接收上传的音频，返回 (任务参数, 原始文件名, 暂存区)
+
+    multipart/form-data: 音频放在file字段，元数据放在同名表单字段或metadata字段(JSON)；
+    其他Content-Type: 请求体即音频，元数据放在查询参数或X-Metadata请求头(JSON)。
+    """
+    from werkzeug.formparser import parse_form_data
+    
+    threshold = SERVER_SETTINGS['upload_spool_threshold']
+    spools = []
+    
+    if request.mimetype == 'multipart/form-data':
+        def stream_factory(total_content_length, content_type, filename, content_length=None):
+            spool = UploadSpool(os.path.join(TEMP_DIR, f"upload_{file_id}_{len(spools)}"), threshold)
+            spools.append((filename, spool))
+            return spool
         
-        # 下载原始文件（使用多线程优化）
-        if not download_file(data['url'], temp_file_path):
-            return jsonify({'error': '音乐文件下载失败'}), 500
-        
-        # 检查文件是否存在且大小合理
-        if not os.path.exists(temp_file_path) or os.path.getsize(temp_file_path) == 0:
-            if os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
-            return jsonify({'error': '下载的文件无效'}), 500
-        
-        # 并行下载封面和处理元数据
-        cover_future = download_executor.submit(download_cover, data.get('cover_url'))
-        
-        # 等待封面下载完成
-        cover_data = cover_future.result()
-        
-        # 准备元数据
-        metadata = {
-            'title': data['title'],
-            'artist': data.get('artist', ''),
-            'album': data.get('album', ''),
-            'year': data.get('year', ''),
-            'lyrics': data.get('lyrics', ''),
-            'tips': data.get('tips', ''),
-            'cover_data': cover_data
-        }
+        try:
+            _, form, files = parse_form_data(request.environ, stream_factory=stream_factory,
+                                             max_form_memory_size=threshold)
+        except Exception:
+            for _, spool in spools:
+                spool.discard()
+            raise
+        data = safe_json_parse(form['metadata']) if form.get('metadata') else {}
+        if not isinstance(data, dict):
+            raise ProcessingError('无效的JSON数据', 400)
+        for key, value in form.items():
+            if key != 'metadata':
+                data.setdefault(key, form_field_value(key, value))
+        
+        upload = files.get('file') or next(iter(files.values()), None)
+        chosen = next((spool for _, spool in spools if upload is not None and upload.stream is spool), None)
+        for _, spool in spools:
+            if spool is not chosen:
+                spool.discard()
+        if chosen is None:
+            raise ProcessingError('缺少上传的音频文件: file', 400)
+        chosen.finish()
+        filename = upload.filename
+    else:
+        header = request.headers.get('X-Metadata')
+        data = safe_json_parse(header) if header else {}
+        if not isinstance(data, dict):
+            raise ProcessingError('无效的JSON数据', 400)
+        for key, value in request.args.items():
+            data.setdefault(key, form_field_value(key, value))
+        
+        chosen = UploadSpool(os.path.join(TEMP_DIR, f"upload_{file_id}_0"), threshold)
+        try:
+            chunk_size = SERVER_SETTINGS['io_buffer_size']
+            while True:
+                chunk = request.stream.read(chunk_size)
+                if not chunk:
+                    break
+                chosen.write(chunk)
+            chosen.finish()
+        except Exception:
+            chosen.discard()
+            raise
+        filename = None
+    
+    return data, data.get('filename') or filename, chosen
+
+@app.route('/process-music/upload', methods=['POST', 'OPTIONS'])
+def process_music_upload():
+    """处理直接上传的音乐文件（无需先把文件放到可下载的地址）"""
+    if is_shutting_down:
+        return jsonify({'error': '服务器正在关闭'}), 503
         
-        # 复制文件到新路径
-        shutil.copy2(temp_file_path, processed_file_path)
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'})
+    
+    spool = None
+    try:
+        file_id = str(uuid.uuid4())
+        try:
+            data, filename, spool = receive_upload(file_id)
+        except ProcessingError:
+            raise
+        except Exception as e:
+            logger.error(f"接收上传文件失败: {e}")
+            return jsonify({'error': '上传的数据无效'}), 400
+        
+        data = validate_job_data(data, UPLOAD_JOB_FIELDS)
+        job = request_job(file_id)
+        job.set_timeout(data.get('timeout'))
+        logger.info(f"收到上传: {data['title']}, {spool.size} bytes")
+        if spool.size == 0:
+            raise ProcessingError('上传的文件为空', 400)
+        
+        audio_format = sniff_audio_format(spool.head)
+        if audio_format is None:
+            raise ProcessingError('不支持的音频格式', 415)
+        original_filename = filename_for_format(safe_filename(filename or '') or "audio", audio_format)
+        processed_file_path = os.path.join(TEMP_DIR, f"processed_{file_id}_{original_filename}")
         
-        # 清理原始文件
+        fingerprint, output, deduplicated = tag_source_file(
+            data, spool.file_path, processed_file_path, original_filename,
+            audio_format, spool.sha256.hexdigest(), job=job
+        )
+        spool = None
+        return register_output_response(file_id, fingerprint, output, deduplicated)
+    
+    except ProcessingError as e:
+        return jsonify({'error': str(e)}), e.status
+    
+    except Exception as e:
+        logger.error(f"处理上传时发生错误: {e}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': f'服务器内部错误: {str(e)}'}), 500
+    
+    finally:
+        if spool is not None:
+            spool.discard()
+
+def iter_blob(blob):
+    """分块读取共享存储中的文件，读完后关闭"""
+    try:
+        chunk_size = SERVER_SETTINGS['io_buffer_size']
+        while True:
+            chunk = blob.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        blob.close()
+
+@app.route('/download/<file_id>')
+def download_file_endpoint(file_id):
+    """下载文件"""
+    if is_shutting_down:
+        return jsonify({'error': '服务器正在关闭'}), 503
+        
+    # 先取得租约再打开文件，传输结束（或客户端断开）时释放；
+    # 查找记录和取得租约与修改元数据替换记录串行，替换后旧文件不会再出现新的租约
+    with file_lock(file_id):
+        file_info = file_registry.get(file_id)
+        if file_info is None:
+            return jsonify({'error': '文件不存在或已过期'}), 404
+        path = file_info['path']
+        acquire_lease(path)
+    
+    if os.path.exists(path):
+        try:
+            response = send_file(
+                path,
+                as_attachment=True,
+                download_name=f"processed_{file_info['filename']}"
+            )
+        except Exception:
+            release_lease(path)
+            raise
+        # send_file 的响应直接透传文件，call_on_close 不会被调用，需要包装迭代器
+        response.response = ClosingIterator(response.response, lambda: release_lease(path))
+    elif file_info.get('blob_key'):
+        release_lease(path)
+        # 文件由其他实例处理，从共享存储转发
+        blob_key = file_info['blob_key']
+        acquire_lease(blob_key)
+        try:
+            blob = blob_store.open(blob_key)
+        except Exception as e:
+            release_lease(blob_key)
+            logger.error(f"读取共享存储失败: {e}")
+            return jsonify({'error': '文件不存在'}), 404
+        response = Response(
+            iter_blob(blob),
+            mimetype=mimetypes.guess_type(file_info['filename'])[0] or 'application/octet-stream',
+            headers=attachment_headers(f"processed_{file_info['filename']}")
+        )
+        response.call_on_close(lambda: release_lease(blob_key))
+    else:
+        release_lease(path)
+        return jsonify({'error': '文件不存在'}), 404
+    
+    record_access(file_id)
+    if file_info.get('sha256'):
+        response.headers['X-Content-SHA256'] = file_info['sha256']
+    return response
+
+@app.route('/files/<file_id>/metadata', methods=['GET'])
+def get_file_metadata(file_id):
+    """返回已处理文件中实际写入的标签、封面和音频流信息"""
+    if is_shutting_down:
+        return jsonify({'error': '服务器正在关闭'}), 503
+    
+    file_info = file_registry.get(file_id)
+    if file_info is None:
+        return jsonify({'error': '文件不存在或已过期'}), 404
+    
+    file_path = file_info['path']
+    fetched_path = None
+    try:
+        if not os.path.exists(file_path):
+            # 文件由其他实例处理：缓存未命中时才从共享存储取回
+            with metadata_cache_lock:
+                has_cache = file_info.get('sha256') in metadata_cache
+            if not has_cache:
+                fetched_path = os.path.join(TEMP_DIR, f"inspect_{uuid.uuid4()}")
+                if not fetch_output(file_info, fetched_path):
+                    fetched_path = None
+                    return jsonify({'error': '文件不存在'}), 404
+                file_path = fetched_path
+        
+        sha256 = file_info.get('sha256') or file_sha256(file_path)
+        result, cached = cached_file_metadata(file_path, sha256, format_from_extension(file_info['filename']))
+    except Exception as e:
+        logger.error(f"读取元数据失败: {e}")
+        return jsonify({'error': f'读取元数据失败: {str(e)}'}), 500
+    finally:
+        if fetched_path and os.path.exists(fetched_path):
+            os.remove(fetched_path)
+    
+    return jsonify(dict(result, file_id=file_id, sha256=sha256, cached=cached))
+
+@app.route('/metadata', methods=['GET'])
+def get_url_metadata():
+    """下载指定URL的音频并返回其中的标签、封面和音频流信息，不做任何修改"""
+    if is_shutting_down:
+        return jsonify({'error': '服务器正在关闭'}), 503
+    
+    url = request.args.get('url', '')
+    if urlparse(url).scheme not in ('http', 'https'):
+        return jsonify({'error': '无效的音乐文件URL'}), 400
+    
+    job_id = str(uuid.uuid4())
+    temp_file_path = os.path.join(TEMP_DIR, f"inspect_{job_id}")
+    try:
+        download_job = DownloadJob(job_id)
+        if not download_file(url, temp_file_path, download_job):
+            message, status = download_failure(download_job)
+            return jsonify({'error': message}), status
+        
+        sha256 = download_job.source_sha256 or file_sha256(temp_file_path)
+        audio_format = download_job.audio_format or format_from_extension(urlparse(url).path)
+        result, cached = cached_file_metadata(temp_file_path, sha256, audio_format)
+        return jsonify(dict(result, url=url, sha256=sha256, cached=cached))
+    
+    except Exception as e:
+        logger.error(f"读取元数据失败: {e}")
+        return jsonify({'error': f'读取元数据失败: {str(e)}'}), 500
+    
+    finally:
         if os.path.exists(temp_file_path):
             os.remove(temp_file_path)
+
+METADATA_PATCH_ATTEMPTS = 3  # 修改元数据时注册记录被并发替换的最大重做次数
+PATCHED_RECORD_KEYS = ('path', 'fingerprint', 'node', 'sha256', 'created_time', 'blob_key')
+
+def apply_metadata_patch(file_id, file_info, delta):
+    """在文件副本上应用元数据修改并替换注册记录，返回 (新记录, 是否替换成功)
+
+    记录自读取后已被其他请求替换（路径或校验值变化）时放弃本次修改，返回 (None, False)。
+    """
+    # 原文件可能正在被下载或被其他文件共享（去重），始终在副本上修改
+    file_path = os.path.join(TEMP_DIR, f"processed_{file_id}_{uuid.uuid4().hex[:8]}_{file_info['filename']}")
+    published = None
+    current = None
+    replaced = False
+    try:
+        if file_info.get('node', NODE_ID) == NODE_ID and os.path.exists(file_info['path']):
+            shutil.copyfile(file_info['path'], file_path)
+        elif not fetch_output(file_info, file_path):
+            raise ProcessingError('文件不存在', 404)
+        
+        if not update_metadata_in_file(file_path, delta, format_from_extension(file_info['filename'])):
+            raise ProcessingError('修改元数据失败', 500)
+        
+        # 更新校验值并重新计算过期时间
+        published = publish_output(file_id, dict(
+            file_info, path=file_path, fingerprint=None, node=NODE_ID,
+            sha256=file_sha256(file_path), created_time=time.time()
+        ))
+        
+        with file_lock(file_id):
+            current = file_registry.get(file_id)
+            if current is None:
+                raise ProcessingError('文件不存在或已过期', 404)
+            if (current['path'], current.get('sha256')) != (file_info['path'], file_info.get('sha256')):
+                return None, False
+            # 保留期间由清理线程写入的下载统计
+            new_info = dict(current, **{key: published[key] for key in PATCHED_RECORD_KEYS if key in published})
+            file_registry[file_id] = new_info
+            local_outputs[file_id] = (None, file_path)
+            replaced = True
+    finally:
+        if not replaced:
+            # 删除副本和已上传的新版本；并发修改得到相同内容时当前记录可能正使用同一个键
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            blob_key = published.get('blob_key') if published else None
+            if blob_key and blob_key not in (file_info.get('blob_key'), current and current.get('blob_key')):
+                blob_store.delete(blob_key)
+    
+    release_replaced_output(current, new_info)
+    return new_info, True
+
+@app.route('/files/<file_id>/metadata', methods=['PATCH', 'OPTIONS'])
+def patch_file_metadata(file_id):
+    """只修改已处理文件的部分元数据，无需重新下载和嵌入封面"""
+    if is_shutting_down:
+        return jsonify({'error': '服务器正在关闭'}), 503
+    
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'})
+    
+    try:
+        try:
+            data = safe_json_parse(request.get_data())
+        except Exception as e:
+            logger.error(f"JSON解析失败: {e}")
+            return jsonify({'error': '无效的JSON数据格式'}), 400
         
-        # 使用线程池处理元数据
-        metadata_future = metadata_executor.submit(add_metadata_to_file, processed_file_path, metadata)
-        
-        # 等待元数据处理完成
-        if not metadata_future.result():
-            if os.path.exists(processed_file_path):
-                os.remove(processed_file_path)
-            return jsonify({'error': '添加元数据失败，可能是不支持的文件格式'}), 500
-        
-        # 注册文件
-        file_registry[file_id] = {
-            'path': processed_file_path,
-            'filename': original_filename,
-            'created_time': time.time()
-        }
+        if not data or not isinstance(data, dict):
+            return jsonify({'error': '无效的JSON数据'}), 400
+        unknown_fields = [field for field in data if field not in METADATA_FIELDS]
+        if unknown_fields:
+            return jsonify({'error': f"不支持修改的字段: {', '.join(unknown_fields)}"}), 400
+        # 与 /process-music 使用相同的字段类型；null 或空字符串表示删除该字段
+        invalid_fields = [field for field, value in data.items()
+                          if value is not None and not field_type_valid(field, value)]
+        if invalid_fields:
+            return jsonify({'error': f"字段类型无效: {', '.join(invalid_fields)}"}), 400
+        delta = {field: normalize_field(sanitize_text(value)) for field, value in data.items()}
+        
+        # 在副本上修改、计算校验值并上传，只在替换注册记录时加锁；
+        # 期间记录被其他请求替换时，在新记录上重做
+        for _ in range(METADATA_PATCH_ATTEMPTS):
+            file_info = file_registry.get(file_id)
+            if file_info is None:
+                return jsonify({'error': '文件不存在或已过期'}), 404
+            
+            file_info, replaced = apply_metadata_patch(file_id, file_info, delta)
+            if replaced:
+                break
+        else:
+            return jsonify({'error': '文件正在被并发修改，请稍后重试'}), 409
         
-        download_url = f"http://{request.host}/download/{file_id}"
         return jsonify({
             'success': True,
-            'download_url': download_url,
+            'download_url': f"http://{request.host}/download/{file_id}",
             'file_id': file_id,
-            'message': '文件处理成功'
+            'sha256': file_info['sha256'],
+            'updated_fields': list(delta),
+            'message': '元数据修改成功'
         })
     
+    except ProcessingError as e:
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
-        logger.error(f"处理请求时发生错误: {e}")
+        logger.error(f"修改元数据时发生错误: {e}")
         logger.error(traceback.format_exc())
         return jsonify({'error': f'服务器内部错误: {str(e)}'}), 500
 
-@app.route('/download/<file_id>')
-def download_file_endpoint(file_id):
-    """下载文件"""
+@app.route('/prefetch', methods=['POST', 'OPTIONS'])
+def prefetch():
+    """提交预取任务：把来源文件和封面提前下载到缓存，之后的处理请求只需打标签"""
     if is_shutting_down:
         return jsonify({'error': '服务器正在关闭'}), 503
-        
-    if file_id not in file_registry:
-        return jsonify({'error': '文件不存在或已过期'}), 404
     
-    file_info = file_registry[file_id]
-    if not os.path.exists(file_info['path']):
-        return jsonify({'error': '文件不存在'}), 404
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'})
     
-    return send_file(
-        file_info['path'],
-        as_attachment=True,
-        download_name=f"processed_{file_info['filename']}"
-    )
+    try:
+        data = safe_json_parse(request.get_data())
+    except Exception as e:
+        logger.error(f"JSON解析失败: {e}")
+        return jsonify({'error': '无效的JSON数据格式'}), 400
+    
+    try:
+        items = parse_prefetch_items(data.get('items') if isinstance(data, dict) else data)
+    except ProcessingError as e:
+        return jsonify({'error': str(e)}), e.status
+    
+    batch_id = start_prefetch(items)
+    return jsonify({
+        'success': True,
+        'batch_id': batch_id,
+        'total': len(items),
+        'status_url': f"http://{request.host}/prefetch/{batch_id}"
+    }), 202
+
+@app.route('/prefetch/<batch_id>')
+def prefetch_status(batch_id):
+    """查询预取批次的进度"""
+    progress = prefetch_progress(batch_id)
+    if progress is None:
+        return jsonify({'error': '预取批次不存在'}), 404
+    return jsonify(progress)
 
 @app.route('/shutdown', methods=['POST'])
 def shutdown():
@@ -752,9 +3644,12 @@ def shutdown():
     # 关闭线程池
     download_executor.shutdown(wait=False)
     metadata_executor.shutdown(wait=False)
+    prefetch_executor.shutdown(wait=False, cancel_futures=True)
+    if tagging_process_pool is not None:
+        tagging_process_pool.shutdown(wait=False, cancel_futures=True)
     
-    # 关闭会话
-    download_session.close()
+    # 关闭上游连接
+    upstream_client.close()
     
     func = request.environ.get('werkzeug.server.shutdown')
     if func is None:
@@ -762,6 +3657,102 @@ def shutdown():
     func()
     return jsonify({'status': 'shutting_down', 'message': '服务器正在关闭'})
 
+# 处理请求的耗时统计，供仪表盘计算p95延迟
+LATENCY_SAMPLES = 256
+PROCESSING_ENDPOINTS = ('process_music', 'process_music_upload')
+request_latencies = deque(maxlen=LATENCY_SAMPLES)
+active_requests = 0
+request_metrics_lock = threading.Lock()
+
+@app.before_request
+def start_request_timer():
+    global active_requests
+    if request.endpoint in PROCESSING_ENDPOINTS and request.method == 'POST':
+        request.environ['metrics.started'] = time.monotonic()
+        with request_metrics_lock:
+            active_requests += 1
+
+def record_request_latency(environ):
+    global active_requests
+    started = environ.pop('metrics.started', None)
+    if started is None:
+        return
+    with request_metrics_lock:
+        active_requests -= 1
+        request_latencies.append(time.monotonic() - started)
+
+class RequestMetricsMiddleware:
+    """响应体发送完（或客户端断开）时才记录耗时，流式返回的请求也计入完整的传输时间"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        try:
+            app_iter = self.wsgi_app(environ, start_response)
+        except Exception:
+            record_request_latency(environ)
+            raise
+        if 'metrics.started' not in environ:
+            return app_iter
+        return ClosingIterator(app_iter, lambda: record_request_latency(environ))
+
+app.wsgi_app = RequestMetricsMiddleware(app.wsgi_app)
+
+def latency_percentile(percent):
+    """最近请求耗时的百分位数（秒），没有样本时返回None"""
+    with request_metrics_lock:
+        samples = sorted(request_latencies)
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+def executor_queue_depth(executor):
+    """线程池中排队等待执行的任务数"""
+    work_queue = getattr(executor, '_work_queue', None)
+    return work_queue.qsize() if work_queue is not None else 0
+
+def hit_rate(hits, misses):
+    total = hits + misses
+    return round(hits / total, 3) if total else None
+
+@app.route('/stats')
+def stats():
+    """返回服务器运行统计"""
+    with metadata_cache_lock:
+        metadata_cache_info = dict(metadata_cache_stats, size=len(metadata_cache))
+    return jsonify({
+        'bandwidth': bandwidth_limiter.stats(),
+        'metadata_cache': metadata_cache_info,
+        'url_cache': dict(cache_stats),
+        'upstream': upstream_client.stats(),
+        'downloads': lease_stats()
+    })
+
+@app.route('/stats/summary')
+def stats_summary():
+    """仪表盘轮询用的精简统计，只读取计数器，开销很小"""
+    with metadata_cache_lock:
+        metadata_hits, metadata_misses = metadata_cache_stats['hits'], metadata_cache_stats['misses']
+    p95 = latency_percentile(95)
+    return jsonify({
+        'active_jobs': active_requests,
+        'active_downloads': bandwidth_limiter.foreground_jobs(),
+        'queue_depth': {
+            'download': executor_queue_depth(download_executor),
+            'metadata': executor_queue_depth(metadata_executor),
+            'prefetch': executor_queue_depth(prefetch_executor)
+        },
+        'throughput': int(bandwidth_limiter.throughput()),
+        'cache_hit_rate': {
+            'metadata': hit_rate(metadata_hits, metadata_misses),
+            'source': hit_rate(cache_stats['source_hits'], cache_stats['source_misses']),
+            'cover': hit_rate(cache_stats['cover_hits'], cache_stats['cover_misses'])
+        },
+        'latency_p95': round(p95, 3) if p95 is not None else None,
+        'latency_samples': len(request_latencies)
+    })
+
 @app.route('/status')
 def status():
     """返回服务器状态"""
@@ -774,16 +3765,25 @@ def index():
     return jsonify({
         'status': 'running',
         'endpoints': {
-            'process_music': 'POST /process-music',
+            'process_music': 'POST /process-music[?inline=1]',
+            'process_music_upload': 'POST /process-music/upload',
             'download': 'GET /download/<file_id>',
+            'file_metadata': 'GET /files/<file_id>/metadata',
+            'url_metadata': 'GET /metadata?url=<url>',
+            'patch_metadata': 'PATCH /files/<file_id>/metadata',
+            'prefetch': 'POST /prefetch',
+            'prefetch_status': 'GET /prefetch/<batch_id>',
             'status': 'GET /status',
+            'stats': 'GET /stats',
+            'stats_summary': 'GET /stats/summary',
             'shutdown': 'POST /shutdown'
         }
     })
 
-def init_app(cache_dir=None):
+def init_app(cache_dir=None, settings=None):
     """初始化应用程序"""
-    global TEMP_DIR, logger
+    global TEMP_DIR, logger, upstream_client, download_executor, metadata_executor, prefetch_executor
+    global file_registry, blob_store
     
     # 设置缓存目录
     if cache_dir and os.path.exists(cache_dir):
@@ -799,11 +3799,36 @@ def init_app(cache_dir=None):
         format='%(asctime)s - %(levelname)s - %(message)s',
         handlers=[
             logging.StreamHandler(),
-            logging.FileHandler(os.path.join(TEMP_DIR, 'music_metadata_processor.log'))
+            RotatingFileHandler(os.path.join(TEMP_DIR, 'music_metadata_processor.log'),
+                                maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
         ]
     )
     logger = logging.getLogger(__name__)
     
+    # 应用配置并按配置重建上游客户端
+    configure_server(settings)
+    upstream_client.close()
+    upstream_client = UpstreamClient(
+        pool_per_host=SERVER_SETTINGS['upstream_pool_per_host'],
+        http2=SERVER_SETTINGS['upstream_http2'],
+        failure_threshold=SERVER_SETTINGS['circuit_failure_threshold'],
+        open_seconds=SERVER_SETTINGS['circuit_open_seconds'],
+        negative_ttl=SERVER_SETTINGS['negative_cache_ttl']
+    )
+    
+    bandwidth_limiter.rate = SERVER_SETTINGS['bandwidth_limit_kbps'] * 1024
+    
+    # 按配置创建注册表和输出文件存储
+    file_registry, blob_store = create_storage()
+    
+    # 按配置重建线程池（线程在首次提交任务时才创建，重建开销很小）
+    download_executor.shutdown(wait=False)
+    metadata_executor.shutdown(wait=False)
+    download_executor = ThreadPoolExecutor(max_workers=SERVER_SETTINGS['download_workers'])
+    metadata_executor = ThreadPoolExecutor(max_workers=SERVER_SETTINGS['metadata_workers'])
+    prefetch_executor.shutdown(wait=False)
+    prefetch_executor = ThreadPoolExecutor(max_workers=SERVER_SETTINGS['prefetch_workers'])
+    
     # 启动清理线程
     cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
     cleanup_thread.start()
@@ -811,12 +3836,229 @@ def init_app(cache_dir=None):
     logger.info("应用程序初始化完成")
     return app
 
-def run_server(host='127.0.0.1', port=5000, cache_dir=None):
+def run_server(host='127.0.0.1', port=5000, cache_dir=None, settings=None):
     """运行服务器"""
-    init_app(cache_dir)
+    init_app(cache_dir, settings)
     logger.info(f"服务器启动: http://{host}:{port}")
     logger.info(f"临时目录: {TEMP_DIR}")
     app.run(host=host, port=port, debug=False, threaded=True)
 
+def startup_report(limit=15):
+    """以 -X importtime 在子进程中导入本模块，打印导入耗时排行（仅从源码运行时可用）"""
+    import subprocess
+    
+    if getattr(sys, 'frozen', False):
+        # 打包后的sys.executable是程序本身，不是Python解释器，无法用 -X importtime 导入模块
+        print("--startup-report 只能在从源码运行时使用: python server_main.py --startup-report")
+        return 1
+    
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    module_name = os.path.splitext(os.path.basename(__file__))[0]
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module_name}'],
+        cwd=script_dir, capture_output=True, text=True
+    )
+    
+    # 每行格式: "import time: self [us] | cumulative | imported package"
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3:
+            continue
+        try:
+            self_us, cumulative_us = int(parts[0]), int(parts[1])
+        except ValueError:
+            continue
+        entries.append((parts[2].strip(), self_us, cumulative_us))
+    
+    if result.returncode != 0 or not entries:
+        print(f"导入 {module_name} 失败:\n{result.stderr}")
+        return 1
+    
+    total_us = sum(entry[1] for entry in entries)
+    print(f"导入 {module_name} 共 {len(entries)} 个模块，总耗时 {total_us / 1000:.1f} ms")
+    print(f"\n累计耗时前 {limit} 的模块:")
+    for name, _, cumulative_us in sorted(entries, key=lambda e: e[2], reverse=True)[:limit]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+    print(f"\n自身耗时前 {limit} 的模块:")
+    for name, self_us, _ in sorted(entries, key=lambda e: e[1], reverse=True)[:limit]:
+        print(f"  {self_us / 1000:8.1f} ms  {name}")
+    return 0
+
+def batch_output_name(data, filename, output_dir, used_names):
+    """根据艺术家和标题生成批处理输出文件名，重名时追加序号"""
+    ext = os.path.splitext(filename)[1]
+    title = str(data.get('title') or '').strip()
+    artist = str(data.get('artist') or '').strip()
+    stem = f"{artist} - {title}" if artist else title
+    stem = safe_filename(stem) or os.path.splitext(filename)[0]
+    
+    name = stem + ext
+    counter = 1
+    while name.lower() in used_names or os.path.exists(os.path.join(output_dir, name)):
+        counter += 1
+        name = f"{stem} ({counter}){ext}"
+    used_names.add(name.lower())
+    return name
+
+def run_batch(input_path, output_dir, concurrency=4, cache_dir=None, settings=None):
+    """从JSONL文件批量处理任务，每行一个/process-music请求体，返回失败任务数"""
+    init_app(cache_dir, settings)
+    os.makedirs(output_dir, exist_ok=True)
+    
+    jobs = []
+    with open(input_path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                jobs.append((line_no, safe_json_parse(line)))
+            except Exception as e:
+                jobs.append((line_no, ProcessingError(f'无效的JSON数据格式: {e}', 400)))
+    logger.info(f"批处理开始: {len(jobs)} 个任务, 并发数 {concurrency}")
+    
+    used_names = set()
+    names_lock = threading.Lock()
+    held_outputs = []  # 批处理结束前保留输出，相同任务之间可以复用
+    
+    def process_line(line_no, data):
+        result = {'line': line_no}
+        if isinstance(data, dict):
+            result['id'] = data.get('request_id') or data.get('id')
+        try:
+            if isinstance(data, Exception):
+                raise data
+            fingerprint, output, deduplicated = run_music_job(data, str(uuid.uuid4()))
+            held_outputs.append((fingerprint, output))
+            with names_lock:
+                name = batch_output_name(data, output['filename'], output_dir, used_names)
+            shutil.copyfile(output['path'], os.path.join(output_dir, name))
+            result.update({
+                'success': True,
+                'path': os.path.join(output_dir, name),
+                'sha256': output['sha256'],
+                'deduplicated': deduplicated
+            })
+            logger.info(f"第 {line_no} 行处理完成: {name}")
+        except ProcessingError as e:
+            result.update({'success': False, 'error': str(e), 'status': e.status})
+            logger.error(f"第 {line_no} 行处理失败: {e}")
+        except Exception as e:
+            result.update({'success': False, 'error': str(e), 'status': 500})
+            logger.error(f"第 {line_no} 行处理时发生错误: {e}")
+            logger.error(traceback.format_exc())
+        return result
+    
+    # 批处理任务使用独立的线程池，避免和分块下载争用download_executor造成死锁
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as batch_executor:
+        futures = [batch_executor.submit(process_line, line_no, data) for line_no, data in jobs]
+        for future in as_completed(futures):
+            results.append(future.result())
+    
+    for fingerprint, output in held_outputs:
+        release_job_output(fingerprint, output)
+    
+    results.sort(key=lambda r: r['line'])
+    with open(os.path.join(output_dir, 'results.jsonl'), 'w', encoding='utf-8') as f:
+        for result in results:
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+    
+    failed = sum(1 for r in results if not r['success'])
+    logger.info(f"批处理完成: 成功 {len(results) - failed} 个, 失败 {failed} 个, 结果见 results.jsonl")
+    return failed
+
+def run_prefetch_cli(input_path, cache_dir=None, settings=None):
+    """命令行预取：读取URL列表（每行一个URL或JSON对象），下载到缓存目录并打印进度，返回失败数"""
+    init_app(cache_dir, settings)
+    
+    entries = []
+    with open(input_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                entries.append(safe_json_parse(line) if line.startswith('{') else line)
+    items = parse_prefetch_items(entries)
+    batch_id = start_prefetch(items)
+    
+    while True:
+        progress = prefetch_progress(batch_id)
+        done = progress['completed'] + progress['failed']
+        throughput = bandwidth_limiter.throughput() / (1024 * 1024)
+        print(f"\r预取进度: {done}/{progress['total']}  失败 {progress['failed']}  {throughput:.1f} MB/s", end='', flush=True)
+        if progress['finished_time'] is not None:
+            break
+        time.sleep(1)
+    print()
+    for item in progress['items']:
+        if item['status'] == 'failed':
+            print(f"失败: {item['url']}: {item.get('error')}")
+    return progress['failed']
+
+def load_settings_file(path):
+    """读取config.json格式的配置文件"""
+    if not path:
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def main(argv=None):
+    """命令行入口: python -m server_main [serve|batch|prefetch]"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(prog='python -m server_main', description='音乐元数据处理服务器')
+    parser.add_argument('--startup-report', action='store_true',
+                        help='打印导入耗时报告后退出（仅从源码运行时可用）')
+    parser.add_argument('--config', help='config.json格式的配置文件')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    serve_parser = subparsers.add_parser('serve', help='启动HTTP服务器（默认）')
+    serve_parser.add_argument('--host', help='监听地址，默认127.0.0.1')
+    serve_parser.add_argument('--port', type=int, help='监听端口，默认5000')
+    serve_parser.add_argument('--cache-dir', help='缓存目录，默认使用系统临时目录')
+    serve_parser.add_argument('--download-workers', type=int, help='下载线程数')
+    serve_parser.add_argument('--metadata-workers', type=int, help='打标签线程数')
+    serve_parser.add_argument('--tagging-backend', choices=['thread', 'process'], help='打标签后端')
+    serve_parser.add_argument('--tagging-workers', type=int, help='进程池大小')
+    
+    batch_parser = subparsers.add_parser('batch', help='批量处理JSONL文件中的任务')
+    batch_parser.add_argument('input', help='JSONL文件，每行一个/process-music请求体')
+    batch_parser.add_argument('-o', '--output-dir', required=True, help='输出目录')
+    batch_parser.add_argument('-j', '--concurrency', type=int, default=4, help='同时处理的任务数，默认4')
+    batch_parser.add_argument('--cache-dir', help='缓存目录，默认使用系统临时目录')
+    batch_parser.add_argument('--download-workers', type=int, help='下载线程数')
+    batch_parser.add_argument('--metadata-workers', type=int, help='打标签线程数')
+    batch_parser.add_argument('--tagging-backend', choices=['thread', 'process'], help='打标签后端')
+    batch_parser.add_argument('--tagging-workers', type=int, help='进程池大小')
+    
+    prefetch_parser = subparsers.add_parser('prefetch', help='预取来源文件和封面到缓存目录')
+    prefetch_parser.add_argument('input', help='URL列表文件，每行一个URL或 {"url": ..., "cover_url": ...}')
+    prefetch_parser.add_argument('--cache-dir', help='缓存目录，应与服务器使用的缓存目录相同')
+    prefetch_parser.add_argument('--prefetch-workers', type=int, help='同时预取的文件数')
+    
+    args = parser.parse_args(argv)
+    
+    if args.startup_report:
+        return startup_report()
+    
+    settings = load_settings_file(args.config)
+    # 命令行参数优先于配置文件
+    for key in ('download_workers', 'metadata_workers', 'tagging_backend', 'tagging_workers', 'prefetch_workers'):
+        if getattr(args, key, None) is not None:
+            settings[key] = getattr(args, key)
+    cache_dir = getattr(args, 'cache_dir', None) or settings.get('cache_dir') or None
+    
+    if args.command == 'prefetch':
+        return 1 if run_prefetch_cli(args.input, cache_dir, settings) else 0
+    if args.command == 'batch':
+        return 1 if run_batch(args.input, args.output_dir, args.concurrency, cache_dir, settings) else 0
+    
+    host = getattr(args, 'host', None) or settings.get('host') or '127.0.0.1'
+    port = getattr(args, 'port', None) or int(settings.get('port') or 5000)
+    run_server(host, port, cache_dir, settings)
+    return 0
+
 if __name__ == '__main__':
-    run_server()
\ No newline at end of file
+    sys.exit(main())
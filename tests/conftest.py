@@ -0,0 +1,122 @@
+import os
+import re
+import struct
+import sys
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server_main  # noqa: E402
+
+
+def make_mp3(n_frames=4000):
+    """带ID3v2头的最小MP3：n_frames个静音帧"""
+    frame = b'\xff\xfb\x90\x64' + b'\x00' * (417 - 4)
+    return b'ID3\x03\x00\x00\x00\x00\x00\x0aTIT2\x00\x00\x00\x00\x00\x00' + frame * n_frames
+
+
+def make_flac(n_bytes=2 * 1024 * 1024):
+    """只有STREAMINFO块的FLAC，后接n_bytes字节的帧数据"""
+    info = struct.pack('>HH', 4096, 4096) + b'\x00' * 6
+    info += ((44100 << 44) | (1 << 41) | (15 << 36) | 44100 * 10).to_bytes(8, 'big') + b'\x00' * 16
+    return b'fLaC' + bytes([0x80]) + len(info).to_bytes(3, 'big') + info + b'\xff\xf8' + b'\x00' * n_bytes
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    """模拟上游文件服务器，支持HEAD和Range请求，不存在的路径返回404"""
+    protocol_version = 'HTTP/1.1'
+    files = {}
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        self.requests.append((self.command, self.path))
+        data = self.files.get(self.path.split('?')[0])
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        return data
+
+    def do_HEAD(self):
+        data = self._body()
+        if data is None:
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        data = self._body()
+        if data is None:
+            return
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            size = len(data)
+            start = int(match.group(1))
+            end = int(match.group(2) or size - 1)
+            data = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+@pytest.fixture
+def upstream():
+    """启动模拟上游服务器，返回 (基础URL, 路径->内容 字典, 收到的(方法, 路径)列表)"""
+    files = {}
+    requests = []
+    handler = type('Handler', (UpstreamHandler,), {'files': files, 'requests': requests})
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}', files, requests
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def server(request, tmp_path):
+    """在临时缓存目录中初始化服务器，返回Flask测试客户端；可通过indirect参数传入配置"""
+    defaults = dict(server_main.SERVER_SETTINGS)
+    # 去重索引和元数据缓存是进程级状态，每个测试从空存储开始
+    server_main.output_store.clear()
+    server_main.request_index.clear()
+    server_main.metadata_cache.clear()
+    server_main.init_app(str(tmp_path), dict(getattr(request, 'param', {})))
+    yield server_main.app.test_client()
+    server_main.upstream_client.close()
+    server_main.SERVER_SETTINGS.update(defaults)
+
+
+def idle_slots(url):
+    """该主机连接池中可直接取用的位置数，等于pool_per_host时没有被占用的连接"""
+    adapter = server_main.upstream_client.session_for(url).get_adapter(url)
+    return adapter.poolmanager.connection_from_url(url).pool.qsize()
+
+
+def run_with_timeout(func, timeout=15):
+    """在线程中运行func，超时未返回时测试失败（防止连接池耗尽导致测试永远挂起）"""
+    result = {}
+
+    def target():
+        result['value'] = func()
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), f"{func} 在 {timeout} 秒内没有返回"
+    return result.get('value')
@@ -0,0 +1,21 @@
+import server_main
+
+
+def test_limiter_stats_memory_is_bounded():
+    limiter = server_main.BandwidthLimiter()
+    for _ in range(200000):
+        limiter.consume(None, 1024)
+    assert len(limiter._buckets) <= limiter.STATS_WINDOW + 1
+    assert limiter.total_bytes == 200000 * 1024
+    assert limiter.throughput() > 0
+
+
+def test_limiter_throughput_counts_only_the_window(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(server_main.time, 'monotonic', lambda: clock[0])
+    limiter = server_main.BandwidthLimiter()
+    limiter.consume(None, 5000)
+    assert limiter.throughput() == 5000 / limiter.STATS_WINDOW
+    clock[0] += limiter.STATS_WINDOW + 1
+    limiter.consume(None, 100)
+    assert limiter.throughput() == 100 / limiter.STATS_WINDOW
@@ -0,0 +1,38 @@
+import hashlib
+import json
+
+import server_main
+from conftest import make_mp3
+
+
+def test_batch_writes_outputs_and_results(server, upstream, tmp_path):
+    base, files, requests = upstream
+    files['/song.mp3'] = make_mp3(100)
+    jobs = tmp_path / 'jobs.jsonl'
+    jobs.write_text('\n'.join([
+        json.dumps({'id': 'a', 'url': base + '/song.mp3', 'title': 'Song', 'artist': 'Band'}),
+        json.dumps({'id': 'b', 'url': base + '/song.mp3', 'title': 'Song', 'artist': 'Band'}),
+        '',
+        '{not json',
+        json.dumps({'id': 'c', 'url': base + '/missing.mp3', 'title': 'Gone'}),
+        json.dumps({'id': 'd', 'url': base + '/song.mp3'}),
+    ]) + '\n', encoding='utf-8')
+    out = tmp_path / 'out'
+
+    assert server_main.main(['batch', str(jobs), '-o', str(out), '-j', '1', '--cache-dir', str(tmp_path)]) == 1
+
+    results = [json.loads(line) for line in (out / 'results.jsonl').read_text(encoding='utf-8').splitlines()]
+    assert [r['line'] for r in results] == [1, 2, 4, 5, 6]
+    assert [r['success'] for r in results] == [True, True, False, False, False]
+    assert [r.get('status') for r in results[2:]] == [400, 404, 400]
+    assert [r.get('id') for r in results] == ['a', 'b', None, 'c', 'd']
+
+    # 相同任务共用一次下载，输出按"艺术家 - 标题"命名，重名时追加序号
+    assert sorted(r['deduplicated'] for r in results[:2]) == [False, True]
+    assert sorted(p.name for p in out.iterdir()) == ['Band - Song (2).mp3', 'Band - Song.mp3', 'results.jsonl']
+    for result in results[:2]:
+        with open(result['path'], 'rb') as f:
+            assert hashlib.sha256(f.read()).hexdigest() == result['sha256']
+    assert len([path for method, path in requests if method == 'GET' and path == '/song.mp3']) == 1
+    # 批处理结束后释放共享输出
+    assert server_main.output_store == {}
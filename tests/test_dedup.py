@@ -0,0 +1,69 @@
+import os
+
+import server_main
+from conftest import make_mp3
+
+
+def process(server, url, title='Same'):
+    response = server.post('/process-music', json={'url': url, 'title': title})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_repeated_request_reuses_output_without_download(server, upstream):
+    base, files, requests = upstream
+    files['/song.mp3'] = make_mp3(100)
+
+    first = process(server, base + '/song.mp3')
+    second = process(server, base + '/song.mp3')
+    assert (first['deduplicated'], second['deduplicated']) == (False, True)
+    assert first['sha256'] == second['sha256']
+    assert len([path for method, path in requests if method == 'GET' and path == '/song.mp3']) == 1
+
+    (fingerprint, output), = server_main.output_store.items()
+    assert output['refs'] == 2
+    assert list(server_main.request_index.values()) == [fingerprint]
+    paths = {server_main.file_registry[data['file_id']]['path'] for data in (first, second)}
+    assert paths == {output['path']}
+
+
+def test_same_content_from_other_url_shares_output(server, upstream):
+    base, files, _ = upstream
+    files['/a.mp3'] = files['/b.mp3'] = make_mp3(100)
+
+    process(server, base + '/a.mp3')
+    assert process(server, base + '/b.mp3')['deduplicated']
+    (fingerprint, output), = server_main.output_store.items()
+    assert output['refs'] == 2
+    # 两个请求键都指向同一输出，第三次请求任意一个都不用再下载
+    assert sorted(server_main.request_index.values()) == [fingerprint, fingerprint]
+
+
+def test_output_deleted_when_last_reference_released(server, upstream):
+    base, files, _ = upstream
+    files['/song.mp3'] = make_mp3(100)
+    process(server, base + '/song.mp3')
+    process(server, base + '/song.mp3')
+    (fingerprint, output), = server_main.output_store.items()
+
+    server_main.release_output(fingerprint)
+    assert os.path.exists(output['path'])
+    server_main.release_output(fingerprint)
+    assert not os.path.exists(output['path'])
+    assert server_main.output_store == {}
+    assert server_main.request_index == {}
+
+
+def test_patch_copies_shared_output(server, upstream):
+    base, files, _ = upstream
+    files['/song.mp3'] = make_mp3(100)
+    first = process(server, base + '/song.mp3')
+    second = process(server, base + '/song.mp3')
+
+    response = server.patch(f"/files/{first['file_id']}/metadata", json={'title': 'Changed'})
+    assert response.status_code == 200
+    (fingerprint, output), = server_main.output_store.items()
+    assert output['refs'] == 1
+    assert server_main.file_registry[second['file_id']]['sha256'] == second['sha256']
+    # 修改后的文件不再与原请求对应，新的相同请求仍然复用未修改的输出
+    assert process(server, base + '/song.mp3')['sha256'] == second['sha256']
@@ -0,0 +1,92 @@
+import os
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+pytest.importorskip('PySide6')
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import app_gui  # noqa: E402
+
+
+@pytest.fixture
+def qapp():
+    return app_gui.QApplication.instance() or app_gui.QApplication([])
+
+
+class Signal:
+    def __init__(self):
+        self.values = []
+
+    def emit(self, *args):
+        self.values.append(args)
+
+
+def readiness_probe(ready_after, server_thread=None):
+    """wait_for_server所需的最小窗口对象：第ready_after次检查时服务器就绪"""
+    checks = []
+
+    def check_server_status(quiet=False):
+        checks.append(time.monotonic())
+        return len(checks) >= ready_after
+
+    window = types.SimpleNamespace(check_server_status=check_server_status, server_thread=server_thread,
+                                   server_started=Signal(), SERVER_READY_TIMEOUT=5)
+    return window, checks
+
+
+def test_wait_for_server_polls_with_fast_backoff():
+    window, checks = readiness_probe(ready_after=4)
+    started = time.monotonic()
+    app_gui.MusicMetadataApp.wait_for_server(window)
+    assert window.server_started.values == [(True,)]
+    assert len(checks) == 4
+    # 前几次轮询间隔很短，就绪后一秒内即可检测到，不再固定等待2秒
+    assert time.monotonic() - started < 1
+
+
+def test_wait_for_server_gives_up_when_server_thread_exits():
+    thread = threading.Thread(target=lambda: None)
+    thread.start()
+    thread.join()
+    window, checks = readiness_probe(ready_after=100, server_thread=thread)
+    app_gui.MusicMetadataApp.wait_for_server(window)
+    assert window.server_started.values == [(False,)]
+    assert len(checks) == 1
+
+
+def update_window(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_gui, 'app_dir', lambda: str(tmp_path))
+    window = types.SimpleNamespace(update_checked_at=0, all_versions=[], update_check_running=False,
+                                   UPDATE_CACHE_TTL=app_gui.MusicMetadataApp.UPDATE_CACHE_TTL,
+                                   applied=[])
+    window.update_cache_path = lambda: app_gui.MusicMetadataApp.update_cache_path(window)
+    window.apply_version_list = lambda versions, manual: window.applied.append(versions)
+    return window
+
+
+def test_update_cache_skips_network_check(qapp, tmp_path, monkeypatch):
+    versions = [{'version': '1.0.1'}]
+    window = update_window(tmp_path, monkeypatch)
+    window.update_checked_at = time.time()
+    app_gui.MusicMetadataApp.save_update_cache(window, versions)
+
+    restored = update_window(tmp_path, monkeypatch)
+    app_gui.MusicMetadataApp.load_update_cache(restored)
+    assert restored.all_versions == versions
+    assert restored.update_checked_at == window.update_checked_at
+    qapp.processEvents()
+    assert restored.applied == [versions]
+
+    monkeypatch.setattr(app_gui, 'fetch_version_list', lambda: pytest.fail('缓存有效期内不应请求网络'))
+    app_gui.MusicMetadataApp.start_update_check(restored, manual=False)
+    assert not restored.update_check_running
+
+
+def test_frozen_app_dir_is_next_to_exe(monkeypatch, tmp_path):
+    monkeypatch.setattr(sys, 'frozen', True, raising=False)
+    monkeypatch.setattr(sys, 'executable', str(tmp_path / 'MusicMetadata.exe'))
+    assert app_gui.app_dir() == str(tmp_path)
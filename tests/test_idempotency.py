@@ -0,0 +1,25 @@
+from conftest import make_mp3
+
+
+def test_idempotent_retry_replays_first_result(server, upstream):
+    base, files, requests = upstream
+    files['/song.mp3'] = make_mp3(100)
+    body = {'url': base + '/song.mp3', 'title': 'Once'}
+
+    first = server.post('/process-music', json=body, headers={'Idempotency-Key': 'retry-1'})
+    second = server.post('/process-music', json=body, headers={'Idempotency-Key': 'retry-1'})
+    assert first.status_code == second.status_code == 200
+    assert second.get_json()['file_id'] == first.get_json()['file_id']
+    assert second.headers.get('Idempotent-Replayed') == 'true'
+    assert first.headers.get('Idempotent-Replayed') is None
+    assert len([path for method, path in requests if method == 'GET' and path == '/song.mp3']) == 1
+
+
+def test_idempotency_key_reused_with_different_body(server, upstream):
+    base, files, _ = upstream
+    files['/song.mp3'] = make_mp3(100)
+    server.post('/process-music', json={'url': base + '/song.mp3', 'title': 'A'},
+                headers={'Idempotency-Key': 'retry-2'})
+    response = server.post('/process-music', json={'url': base + '/song.mp3', 'title': 'B'},
+                           headers={'Idempotency-Key': 'retry-2'})
+    assert response.status_code == 422
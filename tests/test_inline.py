@@ -0,0 +1,12 @@
+from conftest import make_flac
+
+
+def test_inline_non_mp3_downloads_source_once(server, upstream):
+    base, files, requests = upstream
+    files['/song.flac'] = make_flac()
+
+    response = server.post('/process-music?inline=1', json={'url': base + '/song.flac', 'title': 'Inline'})
+    body = response.get_data()
+    assert response.status_code == 200
+    assert body.startswith(b'fLaC') and b'Inline' in body
+    assert [method for method, path in requests if path == '/song.flac'] == ['GET']
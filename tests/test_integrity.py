@@ -0,0 +1,85 @@
+import base64
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import server_main
+from conftest import UpstreamHandler, make_mp3
+
+
+def test_verify_download_checks_length_and_md5():
+    data = b'abc' * 100
+    md5 = hashlib.md5(data)
+    headers = {'content-length': str(len(data)), 'content-md5': base64.b64encode(md5.digest()).decode()}
+    server_main.verify_download(headers, len(data), md5)
+    with pytest.raises(server_main.IntegrityError):
+        server_main.verify_download(headers, len(data) - 1, md5)
+    with pytest.raises(server_main.IntegrityError):
+        server_main.verify_download(headers, len(data), hashlib.md5(b'other'))
+
+
+def test_etag_is_not_md5_by_default(monkeypatch):
+    # S3分片上传的ETag形如MD5但不是内容的MD5
+    headers = {'etag': '"' + 'a' * 32 + '"'}
+    assert server_main.expected_md5(headers) is None
+    monkeypatch.setitem(server_main.SERVER_SETTINGS, 'verify_etag', True)
+    assert server_main.expected_md5(headers) == 'a' * 32
+    assert server_main.expected_md5({'etag': 'W/"' + 'a' * 32 + '"'}) is None
+
+
+class IgnoreRangeHandler(UpstreamHandler):
+    """忽略Range请求头，总是返回整个文件"""
+
+    def do_GET(self):
+        del self.headers['Range']
+        super().do_GET()
+
+
+class WrongMD5Handler(UpstreamHandler):
+    """声明的Content-MD5与内容不符"""
+
+    def end_headers(self):
+        self.send_header('Content-MD5', base64.b64encode(hashlib.md5(b'other').digest()).decode())
+        super().end_headers()
+
+
+def serve(handler, files):
+    requests = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), type('Handler', (handler,), {'files': files, 'requests': requests}))
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, f'http://127.0.0.1:{httpd.server_address[1]}', requests
+
+
+@pytest.mark.parametrize('server', [{'min_segment_size': 256 * 1024}], indirect=True)
+def test_range_integrity_failure_falls_back_to_single_stream(server, tmp_path):
+    files = {'/song.mp3': make_mp3(5000)}
+    httpd, base, requests = serve(IgnoreRangeHandler, files)
+    try:
+        job = server_main.DownloadJob()
+        target = tmp_path / 'song.mp3'
+        assert server_main.download_file(base + '/song.mp3', str(target), job)
+        assert target.read_bytes() == files['/song.mp3']
+        assert job.source_sha256 == hashlib.sha256(files['/song.mp3']).hexdigest()
+        # 分块请求返回200（整个文件）视为校验失败，放弃分块下载后单线程下载成功
+        assert len([method for method, _ in requests if method == 'GET']) > 1
+        assert not list(tmp_path.glob('song.mp3.part*'))
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.mark.parametrize('server', [{'min_segment_size': 256 * 1024}], indirect=True)
+def test_md5_mismatch_fails_download(server, tmp_path):
+    files = {'/song.mp3': make_mp3(5000)}
+    httpd, base, _ = serve(WrongMD5Handler, files)
+    try:
+        job = server_main.DownloadJob()
+        assert not server_main.download_file(base + '/song.mp3', str(tmp_path / 'song.mp3'), job)
+        assert isinstance(job.error, server_main.IntegrityError)
+        assert 'MD5' in str(job.error)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
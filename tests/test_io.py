@@ -0,0 +1,43 @@
+import hashlib
+import io
+
+import pytest
+
+import server_main
+from conftest import idle_slots, make_mp3
+
+
+@pytest.mark.parametrize('server', [{'io_buffer_size': 64 * 1024}], indirect=True)
+def test_readinto_copies_response_and_releases_connection(server, upstream):
+    base, files, _ = upstream
+    # 不是缓冲区大小整数倍的内容，覆盖整块写出和最后不满一块两种情况
+    files['/song.mp3'] = make_mp3(1000)
+    response = server_main.upstream_client.get(base + '/song.mp3', stream=True)
+    assert server_main._response_readinto(response) is not None
+
+    out, hasher = io.BytesIO(), hashlib.md5()
+    written = server_main.write_response_to_file(response, out, hashers=(hasher,))
+    assert written == len(files['/song.mp3'])
+    assert out.getvalue() == files['/song.mp3']
+    assert hasher.hexdigest() == hashlib.md5(files['/song.mp3']).hexdigest()
+    assert idle_slots(base) == server_main.upstream_client.pool_per_host
+
+
+def test_compressed_response_is_not_read_raw(server, upstream):
+    base, files, _ = upstream
+    files['/song.mp3'] = make_mp3(10)
+    response = server_main.upstream_client.get(base + '/song.mp3', stream=True)
+    # 压缩的内容需要urllib3解码，不能直接读取底层流
+    response.headers['Content-Encoding'] = 'gzip'
+    assert server_main._response_readinto(response) is None
+    response.close()
+    assert idle_slots(base) == server_main.upstream_client.pool_per_host
+
+
+def test_copy_file_into_uses_buffer(tmp_path):
+    src = tmp_path / 'src.bin'
+    src.write_bytes(bytes(range(256)) * 5000)
+    out, hasher = io.BytesIO(), hashlib.sha256()
+    assert server_main.copy_file_into(str(src), out, (hasher,)) == 256 * 5000
+    assert out.getvalue() == src.read_bytes()
+    assert hasher.hexdigest() == hashlib.sha256(src.read_bytes()).hexdigest()
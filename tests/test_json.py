@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+import server_main
+from conftest import make_mp3
+
+RAW_LYRICS_BODY = '{"url": "http://example.com/a.mp3", "title": "T", "lyrics": "[00:01]line one\n[00:02]line two"}'
+
+
+@pytest.mark.parametrize('backend', ['auto', 'json'])
+def test_parse_accepts_unescaped_control_characters(backend, monkeypatch):
+    monkeypatch.setitem(server_main.SERVER_SETTINGS, 'json_backend', backend)
+    data = server_main.safe_json_parse(RAW_LYRICS_BODY.encode('utf-8'))
+    assert data['lyrics'] == '[00:01]line one\n[00:02]line two'
+
+
+def test_orjson_parses_valid_body_once(monkeypatch):
+    pytest.importorskip('orjson')
+    monkeypatch.setitem(server_main.SERVER_SETTINGS, 'json_backend', 'auto')
+
+    def stdlib_loads(*args, **kwargs):
+        raise AssertionError('合法的请求体不应再用标准库解析')
+
+    monkeypatch.setattr(json, 'loads', stdlib_loads)
+    assert server_main.safe_json_parse(b'{"title": "T", "year": 2001}') == {'title': 'T', 'year': 2001}
+
+
+def test_invalid_json_still_rejected():
+    with pytest.raises(ValueError):
+        server_main.safe_json_parse(b'{"title": ')
+
+
+@pytest.mark.parametrize('data, error', [
+    ({'title': 'T'}, '缺少必需字段: url'),
+    ({'url': 'http://example.com/a.mp3'}, '缺少必需字段: title'),
+    ({'url': 'http://example.com/a.mp3', 'title': {'a': 1}}, '字段类型无效: title'),
+    ({'url': 'http://example.com/a.mp3', 'title': 'T', 'year': True}, '字段类型无效: year'),
+    ({'url': 'http://example.com/a.mp3', 'title': 'T', 'lyrics': 1}, '字段类型无效: lyrics'),
+    ({'url': 'ftp://example.com/a.mp3', 'title': 'T'}, '无效的音乐文件URL'),
+    ({'url': 'http://example.com/a.mp3', 'title': 'T', 'timeout': 0}, '无效的超时时间: timeout'),
+    ({'url': 'http://example.com/a.mp3', 'title': 'T', 'mirrors': ['file:///etc/passwd']}, '无效的镜像地址: mirrors'),
+    (['not', 'an', 'object'], '无效的JSON数据'),
+])
+def test_validate_job_data_rejects(data, error):
+    with pytest.raises(server_main.ProcessingError) as excinfo:
+        server_main.validate_job_data(data)
+    assert str(excinfo.value) == error
+    assert excinfo.value.status == 400
+
+
+def test_validate_job_data_cleans_only_strings():
+    cleaned = server_main.validate_job_data({
+        'url': 'http://example.com/a.mp3',
+        'title': 'Ti\x00tle\x1f',
+        'year': 2001,
+        'lyrics': 'a\tb\r\nc\x07',
+        'mirrors': ['http://example.com/a.mp3', 'http://mirror/a.mp3', 'http://mirror/a.mp3'],
+        'extra': 'kept\x00'
+    })
+    assert cleaned['title'] == 'Title'
+    assert cleaned['year'] == 2001
+    assert cleaned['lyrics'] == 'a\tb\r\nc'
+    # 镜像去重并去掉与主地址相同的项；未定义的字段原样保留
+    assert cleaned['mirrors'] == ['http://mirror/a.mp3']
+    assert cleaned['extra'] == 'kept\x00'
+
+
+def test_process_music_accepts_raw_newlines_and_rejects_bad_types(server, upstream):
+    base, files, _ = upstream
+    files['/a.mp3'] = make_mp3(100)
+    body = RAW_LYRICS_BODY.replace('http://example.com', base)
+    response = server.post('/process-music', data=body.encode('utf-8'), content_type='application/json')
+    assert response.status_code == 200
+
+    response = server.post('/process-music', json={'url': base + '/a.mp3', 'title': True})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == '字段类型无效: title'
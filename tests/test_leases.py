@@ -0,0 +1,84 @@
+import threading
+import time
+
+import server_main
+from conftest import make_mp3
+
+
+def upload(server, title):
+    response = server.post(f'/process-music/upload?title={title}', data=make_mp3(100),
+                           content_type='application/octet-stream')
+    return response.get_json()['file_id']
+
+
+def test_download_waits_for_registry_swap(server):
+    file_id = upload(server, 'Lease')
+    path = server_main.file_registry[file_id]['path']
+    result = {}
+
+    def download():
+        response = server.get(f'/download/{file_id}')
+        result['leased'] = server_main.is_leased(path)
+        result['status'] = response.status_code
+        response.close()
+
+    with server_main.file_lock(file_id):
+        thread = threading.Thread(target=download, daemon=True)
+        thread.start()
+        time.sleep(0.2)
+        # 替换注册记录期间下载不能取得租约
+        assert thread.is_alive()
+        assert not server_main.is_leased(path)
+    thread.join(5)
+    assert result == {'leased': True, 'status': 200}
+    assert not server_main.is_leased(path)
+    assert server_main.file_locks == {}
+
+
+def test_patch_does_not_block_other_downloads(server):
+    locked, other = upload(server, 'A'), upload(server, 'B')
+    with server_main.file_lock(locked):
+        response = server.get(f'/download/{other}')
+        assert response.status_code == 200
+        response.close()
+
+
+def test_leased_file_survives_patch(server):
+    file_id = upload(server, 'Old')
+    old_path = server_main.file_registry[file_id]['path']
+    response = server.get(f'/download/{file_id}')
+
+    patched = server.patch(f'/files/{file_id}/metadata', json={'title': 'New'})
+    assert patched.status_code == 200
+    # 正在进行的下载继续读取旧文件，新的下载取得修改后的文件
+    assert response.get_data() == open(old_path, 'rb').read()
+    response.close()
+    new_path = server_main.file_registry[file_id]['path']
+    assert new_path != old_path
+    assert server.get(f'/download/{file_id}').headers['X-Content-SHA256'] == patched.get_json()['sha256']
+
+    server_main.cleanup_expired_files()
+    assert not server_main.os.path.exists(old_path)
+
+
+def test_concurrent_patch_is_redone_on_new_record(server, monkeypatch):
+    file_id = upload(server, 'Old')
+    update = server_main.update_metadata_in_file
+    calls = []
+
+    def racing_update(file_path, delta, audio_format):
+        calls.append(dict(delta))
+        if len(calls) == 1:
+            # 本次修改进行中，另一个请求先完成了修改
+            assert server.patch(f'/files/{file_id}/metadata', json={'artist': 'Other'}).status_code == 200
+        return update(file_path, delta, audio_format)
+
+    monkeypatch.setattr(server_main, 'update_metadata_in_file', racing_update)
+    response = server.patch(f'/files/{file_id}/metadata', json={'title': 'New'})
+    assert response.status_code == 200
+    assert calls == [{'title': 'New'}, {'artist': 'Other'}, {'title': 'New'}]
+
+    tags = str(server.get(f'/files/{file_id}/metadata').get_json())
+    assert 'New' in tags and 'Other' in tags
+    leftovers = [name for name in server_main.os.listdir(server_main.TEMP_DIR) if name.startswith(f'processed_{file_id}')]
+    assert leftovers == [server_main.os.path.basename(server_main.file_registry[file_id]['path'])]
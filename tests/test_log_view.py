@@ -0,0 +1,81 @@
+import logging
+import os
+
+import pytest
+
+pytest.importorskip('PySide6')
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import app_gui  # noqa: E402
+
+
+@pytest.fixture
+def log_view():
+    app = app_gui.QApplication.instance() or app_gui.QApplication([])
+    view = app_gui.LogView()
+    yield view
+    view.deleteLater()
+    app.processEvents()
+
+
+def shown_lines(view):
+    text = view.text_view.toPlainText()
+    return text.split('\n') if text else []
+
+
+def test_ring_buffer_keeps_latest_entries(log_view):
+    capacity = app_gui.LogView.CAPACITY
+    for i in range(capacity + 50):
+        log_view.add_entry(logging.INFO, f'line {i}')
+    assert len(log_view.entries) == capacity
+    assert log_view.entries[0] == (logging.INFO, 'line 50')
+
+    log_view.flush()
+    lines = shown_lines(log_view)
+    assert len(lines) == capacity
+    assert lines[0] == 'line 50' and lines[-1] == f'line {capacity + 49}'
+    assert not log_view.pending
+
+
+def test_entries_batched_until_flush(log_view):
+    log_view.add_entry(logging.INFO, 'first')
+    log_view.add_entry(logging.INFO, 'second')
+    assert shown_lines(log_view) == []
+    assert log_view.flush_timer.isActive()
+    log_view.flush()
+    assert shown_lines(log_view) == ['first', 'second']
+
+
+def test_level_and_text_filters(log_view):
+    log_view.add_entry(logging.INFO, 'download started')
+    log_view.add_entry(logging.WARNING, 'slow mirror')
+    log_view.add_entry(logging.ERROR, 'download failed')
+    log_view.flush()
+
+    log_view.level_combo.setCurrentIndex([level for _, level in app_gui.LogView.LEVELS].index(logging.WARNING))
+    assert shown_lines(log_view) == ['slow mirror', 'download failed']
+    log_view.filter_edit.setText('DOWNLOAD')
+    assert shown_lines(log_view) == ['download failed']
+
+    # 新日志同样经过过滤
+    log_view.add_entry(logging.ERROR, 'cover failed')
+    log_view.add_entry(logging.ERROR, 'download retry')
+    log_view.flush()
+    assert shown_lines(log_view) == ['download failed', 'download retry']
+
+    log_view.level_combo.setCurrentIndex(0)
+    log_view.filter_edit.setText('')
+    assert len(shown_lines(log_view)) == 5
+
+
+def test_log_handler_feeds_view(log_view):
+    handler = app_gui.QtLogHandler()
+    handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+    handler.emitter.record_emitted.connect(log_view.add_entry)
+    logger = logging.getLogger('test_log_view')
+    logger.addHandler(handler)
+    try:
+        logger.error('boom')
+    finally:
+        logger.removeHandler(handler)
+    assert list(log_view.entries) == [(logging.ERROR, 'ERROR boom')]
@@ -0,0 +1,57 @@
+import server_main
+from conftest import make_mp3
+
+
+def upload(server, query):
+    response = server.post(f'/process-music/upload?{query}', data=make_mp3(100),
+                           content_type='application/octet-stream')
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_file_metadata_reports_tags_and_stream(server):
+    file_id = upload(server, 'title=Song&artist=Band&year=2001')['file_id']
+    first = server.get(f'/files/{file_id}/metadata').get_json()
+    assert first['format'] == 'mp3'
+    assert first['tags'] == {'title': 'Song', 'artist': 'Band', 'year': '2001'}
+    assert first['stream']['sample_rate'] == 44100 and first['stream']['duration'] > 0
+    assert first['covers'] == []
+    assert first['cached'] is False
+
+    second = server.get(f'/files/{file_id}/metadata').get_json()
+    assert second['cached'] is True
+    assert second['tags'] == first['tags']
+
+    assert server.get('/files/unknown/metadata').status_code == 404
+
+
+def test_metadata_cache_follows_content_after_patch(server, monkeypatch):
+    uploaded = upload(server, 'title=Old')
+    file_id = uploaded['file_id']
+    assert server.get(f'/files/{file_id}/metadata').get_json()['tags']['title'] == 'Old'
+
+    patched = server.patch(f'/files/{file_id}/metadata', json={'title': 'New'}).get_json()
+    assert patched['sha256'] != uploaded['sha256']
+    after = server.get(f'/files/{file_id}/metadata').get_json()
+    # 缓存按内容哈希索引：修改后的文件重新解析，不会返回旧标签
+    assert after['cached'] is False
+    assert after['sha256'] == patched['sha256']
+    assert after['tags']['title'] == 'New'
+
+    reads = []
+    read = server_main.read_file_metadata
+    monkeypatch.setattr(server_main, 'read_file_metadata', lambda *args: reads.append(args) or read(*args))
+    assert server.get(f'/files/{file_id}/metadata').get_json()['cached'] is True
+    assert reads == []
+
+
+def test_url_metadata_downloads_without_modifying(server, upstream):
+    base, files, _ = upstream
+    files['/song.mp3'] = make_mp3(100)
+    response = server.get('/metadata', query_string={'url': base + '/song.mp3'})
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['url'] == base + '/song.mp3'
+    assert data['format'] == 'mp3'
+    assert server.get('/metadata', query_string={'url': base + '/missing.mp3'}).status_code == 404
+    assert server.get('/metadata', query_string={'url': 'file:///etc/passwd'}).status_code == 400
@@ -0,0 +1,53 @@
+import struct
+
+import server_main
+
+
+def atom(kind, payload):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def chunk_offset_atom(kind, offsets):
+    code = 'I' if kind == b'stco' else 'Q'
+    return atom(kind, struct.pack(f'>II{len(offsets)}{code}', 0, len(offsets), *offsets))
+
+
+def parse_chunk_offsets(data, kind):
+    index = data.index(kind)
+    count = struct.unpack_from('>I', data, index + 8)[0]
+    return list(struct.unpack_from(f">{count}{'I' if kind == b'stco' else 'Q'}", data, index + 12))
+
+
+def test_mp4_faststart_moves_moov_and_shifts_offsets(tmp_path):
+    ftyp = atom(b'ftyp', b'M4A \x00\x00\x00\x00M4A mp42isom')
+    samples = [b'sample-one', b'sample-two!', b'sample-three']
+    mdat_payload = b''.join(samples)
+    offsets = [len(ftyp) + 8 + sum(len(s) for s in samples[:i]) for i in range(len(samples))]
+    stbl = atom(b'stbl', chunk_offset_atom(b'stco', offsets[:2]) + chunk_offset_atom(b'co64', offsets[2:]))
+    moov = atom(b'moov', atom(b'trak', atom(b'mdia', atom(b'minf', stbl))))
+    path = tmp_path / 'song.m4a'
+    path.write_bytes(ftyp + atom(b'mdat', mdat_payload) + moov)
+
+    assert server_main.mp4_faststart(str(path))
+    data = path.read_bytes()
+    assert data.index(b'moov') < data.index(b'mdat')
+    new_offsets = parse_chunk_offsets(data, b'stco') + parse_chunk_offsets(data, b'co64')
+    assert new_offsets == [offset + len(moov) for offset in offsets]
+    for offset, sample in zip(new_offsets, samples):
+        assert data[offset:offset + len(sample)] == sample
+
+    # moov已在前面时不再改写
+    assert not server_main.mp4_faststart(str(path))
+    assert path.read_bytes() == data
+
+
+def test_mp4_faststart_leaves_file_when_stco_would_overflow(tmp_path):
+    ftyp = atom(b'ftyp', b'M4A \x00\x00\x00\x00M4A mp42isom')
+    stbl = atom(b'stbl', chunk_offset_atom(b'stco', [0xFFFFFFF0]))
+    moov = atom(b'moov', atom(b'trak', atom(b'mdia', atom(b'minf', stbl))))
+    original = ftyp + atom(b'mdat', b'audio') + moov
+    path = tmp_path / 'huge.m4a'
+    path.write_bytes(original)
+
+    assert not server_main.mp4_faststart(str(path))
+    assert path.read_bytes() == original
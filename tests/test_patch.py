@@ -0,0 +1,30 @@
+import pytest
+
+from conftest import make_mp3
+
+
+def upload(server, query='title=Old&album=Album'):
+    response = server.post(f'/process-music/upload?{query}', data=make_mp3(100),
+                           content_type='application/octet-stream')
+    assert response.status_code == 200
+    return response.get_json()['file_id']
+
+
+@pytest.mark.parametrize('body', [{'title': {'a': 1}}, {'year': True}, {'lyrics': 3}, {'artist': ['A']}])
+def test_patch_rejects_invalid_types(server, body):
+    file_id = upload(server)
+    response = server.patch(f'/files/{file_id}/metadata', json=body)
+    assert response.status_code == 400
+    assert '字段类型无效' in response.get_json()['error']
+
+
+def test_patch_updates_and_deletes_fields(server):
+    file_id = upload(server)
+    response = server.patch(f'/files/{file_id}/metadata', json={'title': 'New', 'year': 2001, 'album': ''})
+    assert response.status_code == 200
+    assert sorted(response.get_json()['updated_fields']) == ['album', 'title', 'year']
+
+    tags = server.get(f'/files/{file_id}/metadata').get_json()
+    assert 'New' in str(tags)
+    assert '2001' in str(tags)
+    assert 'Album' not in str(tags)
@@ -0,0 +1,35 @@
+import threading
+import time
+
+import server_main
+
+
+def fake_batch(batch_id, created_time, finished):
+    return {'batch_id': batch_id, 'items': [{'url': 'http://example.invalid/a', 'status': 'queued'}],
+            'total': 1, 'running': 0, 'completed': 1 if finished else 0, 'failed': 0,
+            'created_time': created_time, 'finished_time': created_time if finished else None}
+
+
+def test_pending_batch_survives_eviction(server, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(server_main, 'prefetch_source', lambda url, cover_url=None: release.wait(5) and 'cached')
+    monkeypatch.setattr(server_main, 'prefetch_batches', {})
+    server_main.prefetch_batches['pending'] = fake_batch('pending', 0, finished=False)
+    for i in range(server_main.PREFETCH_BATCH_LIMIT):
+        server_main.prefetch_batches[f'done{i}'] = fake_batch(f'done{i}', i + 1, finished=True)
+
+    batch_id = server_main.start_prefetch(server_main.parse_prefetch_items(['http://example.invalid/b']))
+    release.set()
+
+    assert 'pending' in server_main.prefetch_batches
+    assert 'done0' not in server_main.prefetch_batches
+    assert len(server_main.prefetch_batches) == server_main.PREFETCH_BATCH_LIMIT
+    deadline = time.monotonic() + 5
+    while server_main.prefetch_progress(batch_id)['finished_time'] is None:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_item_of_evicted_batch_is_skipped(monkeypatch):
+    monkeypatch.setattr(server_main, 'prefetch_batches', {})
+    assert server_main._run_prefetch_item('gone', 0) is None
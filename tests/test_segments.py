@@ -0,0 +1,60 @@
+import threading
+from http.server import ThreadingHTTPServer
+
+import server_main
+from conftest import UpstreamHandler, make_mp3
+
+
+def test_segment_queue_requeues_failed_segment():
+    segments = server_main.SegmentQueue([(0, 9), (10, 19)])
+    first = segments.take()
+    second = segments.take()
+    segments.done(first, False)
+    # 失败的分块放回队首，由其它来源重试
+    assert segments.take() == first
+    segments.done(first, True)
+    segments.done(second, True)
+    assert segments.take() is None
+    assert segments.remaining() == 0
+
+
+def test_segment_queue_abort_wakes_waiting_workers():
+    segments = server_main.SegmentQueue([(0, 9)])
+    segments.take()
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(segments.take()), daemon=True)
+    waiter.start()
+    segments.abort()
+    waiter.join(5)
+    assert result == [None]
+
+
+class RangeForbiddenHandler(UpstreamHandler):
+    """HEAD正常但拒绝所有分块请求的镜像"""
+
+    def do_GET(self):
+        self.requests.append((self.command, self.path))
+        self.send_response(403)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def test_parallel_download_fails_over_from_broken_mirror(server, upstream, tmp_path, monkeypatch):
+    base, files, _ = upstream
+    files['/song.mp3'] = make_mp3(6000)
+    monkeypatch.setitem(server_main.SERVER_SETTINGS, 'min_segment_size', 64 * 1024)
+    mirror_requests = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), type('Handler', (RangeForbiddenHandler,),
+                                                       {'files': files, 'requests': mirror_requests}))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    mirror = f'http://127.0.0.1:{httpd.server_address[1]}/song.mp3'
+    target = tmp_path / 'song.mp3'
+    try:
+        job = server_main.DownloadJob()
+        assert server_main.download_file_parallel(base + '/song.mp3', str(target), num_threads=4,
+                                                  job=job, mirrors=[mirror])
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    assert target.read_bytes() == files['/song.mp3']
+    assert ('GET', '/song.mp3') in mirror_requests
@@ -0,0 +1,20 @@
+import pytest
+
+import server_main
+from conftest import make_flac, make_mp3
+
+
+@pytest.mark.parametrize('head, expected', [
+    (make_mp3(1), 'mp3'),
+    (b'\xff\xfb\x90\x64' + b'\x00' * 60, 'mp3'),
+    (make_flac(64), 'flac'),
+    (b'OggS' + b'\x00' * 24 + b'\x01vorbis' + b'\x00' * 32, 'ogg'),
+    (b'OggS' + b'\x00' * 24 + b'OpusHead' + b'\x00' * 32, None),
+    (b'\x00\x00\x00\x20ftypM4A ' + b'\x00' * 24, 'mp4'),
+    (b'RIFF\x00\x00\x00\x00WAVEfmt ', 'wav'),
+    (b'FORM\x00\x00\x00\x00AIFFCOMM', 'aiff'),
+    (b'\xff\xf1\x50\x80' + b'\x00' * 60, None),  # ADTS AAC
+    (b'<!DOCTYPE html><html>', None),
+])
+def test_sniff_audio_format(head, expected):
+    assert server_main.sniff_audio_format(head) == expected
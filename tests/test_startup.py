@@ -0,0 +1,16 @@
+import sys
+
+import server_main
+
+
+def test_startup_report_lists_imports(capsys):
+    assert server_main.main(['--startup-report']) in (0, None)
+    output = capsys.readouterr().out
+    assert '累计耗时前' in output
+    assert 'flask' in output
+
+
+def test_startup_report_refuses_frozen_build(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'frozen', True, raising=False)
+    assert server_main.startup_report() == 1
+    assert '只能在从源码运行时使用' in capsys.readouterr().out
@@ -0,0 +1,24 @@
+import server_main
+from conftest import make_mp3
+
+
+def test_streamed_request_latency_recorded_when_body_closes(server, upstream, monkeypatch):
+    base, files, _ = upstream
+    files['/song.mp3'] = make_mp3(100)
+    monkeypatch.setattr(server_main, 'request_latencies', server_main.deque(maxlen=server_main.LATENCY_SAMPLES))
+    # 测试客户端不会自动关闭其它用例未读取的响应，计数从零开始
+    monkeypatch.setattr(server_main, 'active_requests', 0)
+
+    response = server.post('/process-music?inline=1', json={'url': base + '/song.mp3', 'title': 'Stream'},
+                           buffered=False)
+    assert response.status_code == 200
+    # 响应体尚未发送，请求仍在进行中
+    summary = server.get('/stats/summary').get_json()
+    assert summary['active_jobs'] == 1
+    assert summary['latency_samples'] == 0
+
+    assert response.get_data().startswith(b'ID3')
+    response.close()
+    summary = server.get('/stats/summary').get_json()
+    assert summary['active_jobs'] == 0
+    assert summary['latency_samples'] == 1
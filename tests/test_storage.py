@@ -0,0 +1,120 @@
+import logging
+import os
+import time
+
+import pytest
+
+import server_main
+from conftest import make_mp3
+
+
+def upload(server, title='Stored'):
+    response = server.post(f'/process-music/upload?title={title}', data=make_mp3(100),
+                           content_type='application/octet-stream')
+    assert response.status_code == 200
+    return response.get_json()['file_id']
+
+
+def test_sqlite_registry_shared_between_instances(tmp_path):
+    db_path = str(tmp_path / 'registry.sqlite3')
+    first, second = server_main.SQLiteRegistry(db_path), server_main.SQLiteRegistry(db_path)
+
+    first['a'] = {'path': '/tmp/a.mp3', 'downloads': 1}
+    assert second['a'] == {'path': '/tmp/a.mp3', 'downloads': 1}
+    second['a'] = dict(second['a'], downloads=2)
+    assert first.get('a')['downloads'] == 2
+    assert list(first) == ['a'] and len(second) == 1
+
+    del second['a']
+    assert 'a' not in first
+    with pytest.raises(KeyError):
+        del first['a']
+
+
+@pytest.mark.parametrize('server', [{'registry_backend': 'sqlite'}], indirect=True)
+def test_sqlite_registry_expiry_seen_by_other_instance(server):
+    assert isinstance(server_main.file_registry, server_main.SQLiteRegistry)
+    other = server_main.SQLiteRegistry(server_main.file_registry.db_path)
+    local_id, remote_id, orphan_id = upload(server, 'Local'), upload(server, 'Remote'), upload(server, 'Orphan')
+    path = other[local_id]['path']
+
+    expired = time.time() - server_main.FILE_CLEANUP_TIME - 10
+    other[local_id] = dict(other[local_id], created_time=expired)
+    # 其他实例创建的记录由创建者清理；超过两倍过期时间（创建者已下线）才由本实例清理
+    other[remote_id] = dict(other[remote_id], created_time=expired, node='other-host:1')
+    other[orphan_id] = dict(other[orphan_id], created_time=expired - server_main.FILE_CLEANUP_TIME,
+                            node='other-host:1')
+
+    server_main.cleanup_expired_files()
+    assert sorted(other) == [remote_id]
+    assert not os.path.exists(path)
+
+
+def test_unusable_backend_falls_back_to_local(tmp_path, monkeypatch, caplog):
+    monkeypatch.setitem(server_main.SERVER_SETTINGS, 'registry_backend', 'sqlite')
+    monkeypatch.setitem(server_main.SERVER_SETTINGS, 'registry_path', str(tmp_path / 'missing' / 'registry.sqlite3'))
+    with caplog.at_level(logging.ERROR):
+        registry, blob_store = server_main.create_storage()
+    assert registry == {}
+    assert isinstance(blob_store, server_main.LocalBlobStore) and not blob_store.shared
+    assert '初始化存储后端失败' in caplog.text
+
+
+def test_s3_backend_without_bucket_falls_back_to_local(monkeypatch, caplog):
+    monkeypatch.setitem(server_main.SERVER_SETTINGS, 'registry_backend', 's3')
+    monkeypatch.setitem(server_main.SERVER_SETTINGS, 'blob_backend', 's3')
+    monkeypatch.setitem(server_main.SERVER_SETTINGS, 's3_bucket', '')
+    with caplog.at_level(logging.ERROR):
+        registry, blob_store = server_main.create_storage()
+    assert registry == {}
+    assert isinstance(blob_store, server_main.LocalBlobStore)
+    assert '未配置s3_bucket' in caplog.text
+
+
+S3_SETTINGS = {'registry_backend': 's3', 'blob_backend': 's3', 's3_bucket': 'music', 's3_region': 'us-east-1'}
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """moto模拟的S3，需在server之前请求"""
+    moto = pytest.importorskip('moto')
+    boto3 = pytest.importorskip('boto3')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='music')
+        yield client
+
+
+def s3_keys(client):
+    return sorted(obj['Key'] for obj in client.list_objects_v2(Bucket='music').get('Contents', []))
+
+
+@pytest.mark.parametrize('server', [S3_SETTINGS], indirect=True)
+def test_s3_registry_and_blob_store(s3, server):
+    assert isinstance(server_main.file_registry, server_main.S3Registry)
+    assert isinstance(server_main.blob_store, server_main.S3BlobStore)
+    file_id = upload(server)
+    info = server_main.file_registry[file_id]
+    assert s3_keys(s3) == sorted([f'music-metadata/registry/{file_id}', f"music-metadata/files/{info['blob_key']}"])
+
+    # 模拟由其他实例处理的文件：本机没有副本，从共享存储转发
+    server_main.file_registry[file_id] = dict(info, node='other-host:1', path='/nonexistent/file.mp3')
+    response = server.get(f'/download/{file_id}')
+    assert response.status_code == 200
+    with open(info['path'], 'rb') as f:
+        assert response.get_data() == f.read()
+    response.close()
+
+    # 修改元数据后上传为新版本，旧版本随即删除
+    patched = server.patch(f'/files/{file_id}/metadata', json={'title': 'Patched'})
+    assert patched.status_code == 200
+    new_info = server_main.file_registry[file_id]
+    assert new_info['blob_key'] != info['blob_key']
+    assert f"music-metadata/files/{info['blob_key']}" not in s3_keys(s3)
+    assert f"music-metadata/files/{new_info['blob_key']}" in s3_keys(s3)
+
+    del server_main.file_registry[file_id]
+    assert file_id not in server_main.file_registry
+    assert server_main.file_registry.items() == []
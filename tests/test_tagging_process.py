@@ -0,0 +1,63 @@
+import hashlib
+from multiprocessing import shared_memory
+
+import pytest
+
+import server_main
+from conftest import make_mp3
+
+COVER = b'\xff\xd8\xff\xe0' + b'\x00' * 2048
+
+
+@pytest.fixture
+def process_pool():
+    yield
+    if server_main.tagging_process_pool is not None:
+        server_main.tagging_process_pool.shutdown()
+        server_main.tagging_process_pool = None
+
+
+@pytest.mark.parametrize('server', [{'tagging_backend': 'process', 'tagging_workers': 1}], indirect=True)
+def test_process_backend_tags_with_shared_memory_cover(server, upstream, process_pool, monkeypatch):
+    base, files, _ = upstream
+    files['/song.mp3'] = make_mp3(100)
+    files['/cover.jpg'] = COVER
+    created = []
+
+    class RecordingSharedMemory(shared_memory.SharedMemory):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            created.append(self.name)
+
+    monkeypatch.setattr(shared_memory, 'SharedMemory', RecordingSharedMemory)
+    response = server.post('/process-music', json={'url': base + '/song.mp3', 'title': 'Proc',
+                                                   'cover_url': base + '/cover.jpg'})
+    assert response.status_code == 200
+    assert server_main.tagging_process_pool is not None
+
+    metadata = server.get(f"/files/{response.get_json()['file_id']}/metadata").get_json()
+    assert 'Proc' in str(metadata)
+    assert hashlib.sha256(COVER).hexdigest() in str(metadata)
+
+    # 任务结束后主进程释放了共享内存
+    assert len(created) == 1
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=created[0])
+
+
+@pytest.mark.parametrize('server', [{'tagging_backend': 'process', 'tagging_workers': 1}], indirect=True)
+def test_process_backend_releases_shared_memory_on_failure(server, tmp_path, process_pool, monkeypatch):
+    created = []
+
+    class RecordingSharedMemory(shared_memory.SharedMemory):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            created.append(self.name)
+
+    monkeypatch.setattr(shared_memory, 'SharedMemory', RecordingSharedMemory)
+    broken = tmp_path / 'broken.mp3'
+    broken.write_bytes(b'not audio')
+    assert not server_main.tag_file(str(broken), {'title': 'X', 'cover_data': COVER}, 'mp3')
+    assert len(created) == 1
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=created[0])
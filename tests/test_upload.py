@@ -0,0 +1,25 @@
+import io
+
+from conftest import make_mp3
+
+
+def test_upload_query_timeout_is_coerced(server):
+    response = server.post('/process-music/upload?title=Up&timeout=20', data=make_mp3(100),
+                           content_type='application/octet-stream')
+    assert response.status_code == 200, response.get_json()
+
+
+def test_upload_form_timeout_is_coerced(server):
+    response = server.post('/process-music/upload', content_type='multipart/form-data', data={
+        'title': 'Up',
+        'timeout': '2.5',
+        'file': (io.BytesIO(make_mp3(100)), 'song.mp3'),
+    })
+    assert response.status_code == 200, response.get_json()
+
+
+def test_upload_rejects_non_numeric_timeout(server):
+    response = server.post('/process-music/upload?title=Up&timeout=soon', data=make_mp3(100),
+                           content_type='application/octet-stream')
+    assert response.status_code == 400
+    assert 'timeout' in response.get_json()['error']
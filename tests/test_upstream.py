@@ -0,0 +1,99 @@
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import server_main
+from conftest import UpstreamHandler, idle_slots, make_mp3, run_with_timeout
+
+
+def test_failed_requests_do_not_exhaust_host_pool(server, upstream, tmp_path):
+    base, files, _ = upstream
+    files['/ok.mp3'] = make_mp3(100)
+    pool_size = server_main.upstream_client.pool_per_host
+
+    for i in range(pool_size + 2):
+        assert not run_with_timeout(
+            lambda: server_main.download_file_single(f'{base}/missing{i}.mp3', str(tmp_path / f'missing{i}')))
+    assert idle_slots(base) == pool_size
+
+    target = tmp_path / 'ok.mp3'
+    assert run_with_timeout(lambda: server_main.download_file_single(base + '/ok.mp3', str(target)))
+    assert target.read_bytes() == files['/ok.mp3']
+
+
+@pytest.mark.parametrize('server', [{'min_segment_size': 256 * 1024}], indirect=True)
+def test_rejected_format_releases_segment_connections(server, upstream):
+    base, files, _ = upstream
+    files['/voice.ogg'] = b'OggS' + b'\x00' * (2 * 1024 * 1024)
+    files['/ok.mp3'] = make_mp3(100)
+
+    response = run_with_timeout(lambda: server.post('/process-music', json={'url': base + '/voice.ogg', 'title': 'T'}))
+    assert response.status_code == 415
+    assert idle_slots(base) == server_main.upstream_client.pool_per_host
+
+    response = run_with_timeout(lambda: server.post('/process-music', json={'url': base + '/ok.mp3', 'title': 'T'}))
+    assert response.status_code == 200
+
+
+class RootErrorHandler(UpstreamHandler):
+    """站点根路径返回503的上游（很多CDN如此）"""
+
+    def do_HEAD(self):
+        if self.path == '/':
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        super().do_HEAD()
+
+
+def test_warm_up_failures_do_not_open_breaker(server, upstream):
+    base, files, _ = upstream
+    files['/ok.mp3'] = make_mp3(100)
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), type('Handler', (RootErrorHandler,), {'files': files}))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    cdn = f'http://127.0.0.1:{httpd.server_address[1]}'
+    try:
+        client = server_main.upstream_client
+        for _ in range(client.breaker.failure_threshold + 1):
+            client._warmed.clear()
+            client.warm_up(cdn + '/ok.mp3')
+        assert not client.breaker.is_open(client._host_key(cdn))
+        assert client.available(cdn + '/ok.mp3')
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+class ForbiddenHandler(UpstreamHandler):
+    """/private/ 下的路径返回403"""
+
+    def _body(self):
+        if self.path.startswith('/private/'):
+            self.requests.append((self.command, self.path))
+            self.send_response(403)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        return super()._body()
+
+
+def test_negative_cache_keeps_upstream_status(server):
+    requests = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), type('Handler', (ForbiddenHandler,), {'files': {}, 'requests': requests}))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{httpd.server_address[1]}/private/song.mp3'
+    try:
+        client = server_main.upstream_client
+        assert client.head(url).status_code == 403
+        with pytest.raises(server_main.UpstreamUnavailable) as error:
+            client.head(url)
+        assert error.value.status == 403
+        assert len(requests) == 1
+
+        response = server.post('/process-music', json={'url': url, 'title': 'T'})
+        assert response.status_code == 404
+    finally:
+        httpd.shutdown()
+        httpd.server_close()